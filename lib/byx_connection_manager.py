@@ -3,30 +3,86 @@
 
 import os
 import glob
+import time
 import logging
+import pyroute2
 import threading
+import subprocess
 import configparser
+from gi.repository import GLib
 from byx_common import ByxState
+from byx_stage_graph import ByxStageGraph
+from byx_probe_scheduler import ByxProbeScheduler
+from byx_connection_registry import ByxConnectionRegistry
 from byx_common import ByxNetworkType
 from byx_ntfac_group import ByxNtfacGroup
+from byx_ntfac_group import ByxPersistentNtfacSet
 
 
 class ByxConnectionManager:
 
+    # make-before-break switching ("--switch-mode=make-before-break"):
+    #   1. the better connection is activated by its plugin in background, current connection is untouched
+    #   2. its default gateway is verified reachable
+    #   3. the ntfac group of current connection is taken over, default route, connection nameservers,
+    #      gateways and firewall rules are switched in one batch, which is the outage window. the default
+    #      route is replaced in place, not deleted and added again
+    #   4. the old connection is deactivated
+    # the ntfac group can only be taken over when both connections have the same ntfacs, otherwise
+    # break-before-make is used.
+    #
+    # hot-standby ("--standby-mode"): the best connection of another network type is kept activated by
+    # its plugin, with interface up and address acquired, but without routes and nameservers, which
+    # are only installed by the ntfac group. a default route added by the plugin through the standby
+    # interface is deleted as soon as the plugin has activated it, before the gateway is verified, the
+    # ntfac group installs it again on cut-over. the connection is not kept standby if it can't be deleted.
+    # when current connection fails, or standby connection becomes the better one, it takes over the
+    # ntfac group the same way as make-before-break.
+    # standby time is accounted per connection together with its billing type, in mode "auto"
+    # connections billed by time are never kept standby.
+
     def __init__(self, param):
         self.param = param
-        self.connList = []
+        self.registry = ByxConnectionRegistry()
         self.curConn = None
+        self.switchConn = None                  # connection being prepared for make-before-break switching
+
+        self.switchCount = 0
+        self.switchFallbackCount = 0            # break-before-make is used in make-before-break mode
+        self.lastOutage = None                  # milliseconds, outage window of the last make-before-break switching
+
+        self.standbyConn = None                 # connection being prepared or prepared for failover
+        self.standbyStartTime = None            # when standby connection is prepared
+        self.standbyCostDict = dict()           # dict<connection-id, dict>, standby cost
+        self.failoverCount = 0
+        self.lastFailoverOutage = None          # milliseconds
 
         # create connection list
         self._loadConnectionList(self.param.varConnectionDir)
         self._loadConnectionList(self.param.etcConnectionDir)
 
+        # connection-independent ntfacs run all the time, they are attached to the ntfac group of the current connection
+        ntfacNameList = []
+        for fn in glob.glob(os.path.join(self.param.etcNtfacDir, "*.ntfac")):
+            cfg = configparser.SafeConfigParser()
+            cfg.read(fn)
+            ntfacNameList.append(cfg.get("main", "name"))
+        self.persistentNtfacSet = ByxPersistentNtfacSet(self.param, ntfacNameList)
+
+        self.probeScheduler = ByxProbeScheduler(self.param, self.registry.connList)
+        self.probeScheduler.probe()
+
     def dispose(self):
+        self.probeScheduler.dispose()
+        if self.standbyConn is not None:
+            self._cancelStandby(False)
+        if self.switchConn is not None:
+            self._cancelSwitch(False)
         if self.curConn is not None:
-            self._deactivateConn(self.curConn)
-        for conn in self.connList:
+            self._deactivateConn(self.curConn, False)
+        for conn in self.registry.connList:
             conn.dispose()
+        self.persistentNtfacSet.dispose()
 
     def get_state(self):
         if self.curConn is not None:
@@ -38,7 +94,7 @@ class ByxConnectionManager:
             return ByxState.IDLE
 
     def get_connection_id_list(self):
-        return [x.id for x in self.connList]
+        return self.registry.get_id_list()
 
     def get_current_connection_id(self):
         if self.curConn is not None:
@@ -63,10 +119,12 @@ class ByxConnectionManager:
         if self.curConn is not None:
             self._deactivateConn(self.curConn, False)
         self._activateConn(conn, True)
+        self._updateStandby()
 
     def deactivate(self):
         if self.curConn is not None:
             self._deactivateConn(self.curConn, False)
+        self._updateStandby()
 
     def get_managed_interface_list(self):
         if self.curConn is not None:
@@ -75,13 +133,47 @@ class ByxConnectionManager:
                     return self.curConn.activeInfo["managed-interfaces"]
         return []
 
+    def get_activation_timing(self):
+        # timing of the current or the last activation of the current connection
+        if self.curConn is None or self.curConn.activateGraph is None:
+            return None
+        ret = self.curConn.activateGraph.get_timing()
+        ret["connection"] = self.curConn.id
+        return ret
+
+    def get_statistics(self):
+        ret = dict()
+        if self.curConn is not None and self.curConn.ntfacGroup is not None:
+            ret["ntfac-group"] = self.curConn.ntfacGroup.get_statistics()
+        ret["persistent-ntfac"] = self.persistentNtfacSet.get_statistics()
+        ret["probe"] = self.probeScheduler.get_statistics()
+        ret["registry"] = self.registry.get_statistics()
+        ret["switch"] = {
+            "make-before-break": self.switchCount,
+            "fallback": self.switchFallbackCount,
+            "last-outage": self.lastOutage,
+        }
+        ret["standby"] = {
+            "connection": self.standbyConn.id if self.standbyConn is not None else None,
+            "prepared": self.standbyStartTime is not None,
+            "failover": self.failoverCount,
+            "last-outage": self.lastFailoverOutage,
+            "cost": dict(),
+        }
+        for connId, cost in self.standbyCostDict.items():
+            ret["standby"]["cost"][connId] = dict(cost)
+        if self.standbyStartTime is not None:
+            ret["standby"]["cost"][self.standbyConn.id]["time"] += int(time.monotonic() - self.standbyStartTime)
+        return ret
+
     def _getConnectionById(self, connection_id):
-        for conn in self.connList:
-            if conn.id == connection_id:
-                return conn
-        return None
+        return self.registry.get(connection_id)
 
     def on_config_changed(self):
+        self._onConfigChanged()
+        self._updateStandby()
+
+    def _onConfigChanged(self):
         cfg = self.param.config
 
         # network is disabled, deactivate current connection
@@ -102,47 +194,226 @@ class ByxConnectionManager:
 
     def on_connection_available(self, connection):
         logging.info("Connection %s becomes available." % (connection.id))
+        self.probeScheduler.on_result(connection)
 
         connection.isAvailable = True
         connection.unavailableReason = None
+        self.registry.update(connection)
 
         # new connection has higher priority, switch to it
         if self.curConn is not None and not self.curConn.manualActive:
             if _connPriorityCmp(connection, self.curConn) > 0 and connection.autoActivate:
-                if self.param.get_enable_network_type(connection.networkType):
-                    self._deactivateConn(self.curConn, False)
-                    self._activateConn(connection, False)
+                if self.param.config.get_enable_network_type(connection.networkType):
+                    self._switchConn(connection)
+                    self._updateStandby()
                     return
 
         # no current connection, try to select and activate the new connection
         if self.curConn is None:
             self._selectAndActivate()
-            return
+
+        self._updateStandby()
 
     def on_connection_unavailable(self, connection, reason):
         logging.info("Connection %s becomes unavailable." % (connection.id))
+        self.probeScheduler.on_result(connection)
+
+        if self.switchConn == connection:
+            self._cancelSwitch(True)
+        if self.standbyConn == connection:
+            self._cancelStandby(True)
 
         bHasOldConn = False
         if self.curConn == connection:
             bHasOldConn = True
-            self._deactivateConn(connection, False)
+            if self._isStandbyReady():
+                try:
+                    self._failover()
+                except Exception:
+                    logging.error("Failed to fail over from connection %s." % (connection.id), exc_info=True)
+                    self._deactivateConn(connection, False)
+            else:
+                self._deactivateConn(connection, False)
 
         connection.isAvailable = False
         connection.unavailableReason = reason
+        self.registry.update(connection)
 
         if self.curConn is None and bHasOldConn:
             self._selectAndActivate()
 
+        self._updateStandby()
+
     def _activateConn(self, connection, manualActive):
         assert self.curConn is None
+        if self.standbyConn == connection:
+            self._cancelStandby(False)          # no ntfac group to take over, activate it from the beginning
         self.curConn = connection
         self.curConn.activate(manualActive)
 
     def _deactivateConn(self, connection, alreadyUnavailable):
         assert self.curConn is not None and connection == self.curConn
+        if self.switchConn is not None:
+            self._cancelSwitch(False)
         self.curConn.deactivate(alreadyUnavailable)
         self.curConn = None
 
+    def _switchConn(self, connection):
+        if self.standbyConn == connection:
+            if self._isStandbyReady():
+                self._promoteStandby()
+                return
+            self._cancelStandby(False)          # still being prepared
+
+        if self.param.switchMode == "make-before-break":
+            if self.switchConn is not None:
+                if _connPriorityCmp(connection, self.switchConn) <= 0:
+                    return
+                self._cancelSwitch(False)
+            if self.curConn.ntfacGroup is not None and connection.ntfacDict.keys() == self.curConn.ntfacDict.keys():
+                self.switchConn = connection
+                self.switchConn.prepare(self._onConnPrepared)
+                logging.info("Switching from connection %s to %s, preparing." % (self.curConn.id, connection.id))
+                return
+            self.switchFallbackCount += 1
+
+        self._deactivateConn(self.curConn, False)
+        self._activateConn(connection, False)
+
+    def _cancelSwitch(self, alreadyUnavailable):
+        self.switchConn.cancel_prepare(alreadyUnavailable)
+        logging.info("Switching to connection %s cancelled." % (self.switchConn.id))
+        self.switchConn = None
+
+    def _onConnPrepared(self, connection, thread, bSuccess):
+        try:
+            if self.switchConn is not connection or connection.prepareThread is not thread:
+                return False                    # cancelled
+            connection.prepareThread = None
+            self.switchConn = None
+
+            if not bSuccess:
+                connection.cancel_prepare(False)
+                return False
+
+            oldConnId = self.curConn.id
+            self.lastOutage = self._cutOver(connection, False)
+            self.switchCount += 1
+            logging.info("Switched from connection %s to %s, outage window %d milliseconds." % (oldConnId, connection.id, self.lastOutage))
+            self._updateStandby()
+        except Exception:
+            logging.error("Error occured in connection prepared callback", exc_info=True)
+        return False
+
+    def _cutOver(self, connection, alreadyUnavailable):
+        # prepared connection takes over the ntfac group of current connection, returns outage window in milliseconds,
+        # which is the batch replacing the default route and switching the other routes of the connection
+        # the group is kept by current connection if it fails, the prepared connection is released then
+        oldConn = self.curConn
+        group = oldConn.ntfacGroup
+        startTime = time.monotonic()
+        try:
+            group.change_active_info(connection.activeInfo)
+        except BaseException:
+            connection.cancel_prepare(False)
+            raise
+        ret = int((time.monotonic() - startTime) * 1000)
+        oldConn.ntfacGroup = None
+        connection.take_over(group)
+        self.curConn = connection
+
+        oldConn.deactivate(alreadyUnavailable, bKeepResolvConf=True)
+        return ret
+
+    def _updateStandby(self):
+        # keep the best candidate standby
+        def _filter(conn):
+            if conn == self.switchConn:
+                return False
+            if conn.ntfacDict.keys() != self.curConn.ntfacDict.keys():
+                return False                    # can't take over the ntfac group
+            if self.param.standbyMode == "auto" and conn.plugin.business_attributes.get("billing") == "time":
+                return False
+            return True
+
+        best = None
+        if self.param.standbyMode != "off" and self.curConn is not None and self.param.config.get_enable():
+            for netType in [ByxNetworkType.WIRED, ByxNetworkType.WIRELESS, ByxNetworkType.MOBILE]:
+                if netType == self.curConn.networkType:
+                    continue                    # it would fail together with current connection
+                if not self.param.config.get_enable_network_type(netType):
+                    continue
+                conn = self.registry.get_best(netType, _filter)
+                if conn is not None and (best is None or _connPriorityCmp(conn, best) > 0):
+                    best = conn
+
+        if best == self.standbyConn:
+            return
+        if self.standbyConn is not None:
+            self._cancelStandby(False)
+        if best is not None:
+            self.standbyConn = best
+            self.standbyConn.prepare(self._onStandbyPrepared, bStandby=True)
+            logging.info("Preparing connection %s as standby." % (best.id))
+
+    def _isStandbyReady(self):
+        return self.standbyStartTime is not None and self.curConn is not None and self.curConn.ntfacGroup is not None
+
+    def _cancelStandby(self, alreadyUnavailable):
+        self._accountStandby()
+        self.standbyConn.cancel_prepare(alreadyUnavailable)
+        logging.info("Standby connection %s released." % (self.standbyConn.id))
+        self.standbyConn = None
+
+    def _promoteStandby(self):
+        self._accountStandby()
+        connection = self.standbyConn
+        self.standbyConn = None
+        oldConnId = self.curConn.id
+        self.lastOutage = self._cutOver(connection, False)
+        self.switchCount += 1
+        logging.info("Switched from connection %s to standby connection %s, outage window %d milliseconds." % (oldConnId, connection.id, self.lastOutage))
+
+    def _failover(self):
+        # current connection is already deactivated by its plugin
+        self._accountStandby()
+        connection = self.standbyConn
+        self.standbyConn = None
+        oldConnId = self.curConn.id
+        self.lastFailoverOutage = self._cutOver(connection, True)
+        self.failoverCount += 1
+        logging.info("Failed over from connection %s to standby connection %s, outage window %d milliseconds." % (oldConnId, connection.id, self.lastFailoverOutage))
+
+    def _accountStandby(self):
+        if self.standbyStartTime is not None:
+            self.standbyCostDict[self.standbyConn.id]["time"] += int(time.monotonic() - self.standbyStartTime)
+            self.standbyStartTime = None
+
+    def _onStandbyPrepared(self, connection, thread, bSuccess):
+        try:
+            if self.standbyConn is not connection or connection.prepareThread is not thread:
+                return False                    # cancelled
+            connection.prepareThread = None
+
+            if not bSuccess:
+                # not retried until availability changes
+                connection.cancel_prepare(False)
+                self.standbyConn = None
+                return False
+
+            if connection.id not in self.standbyCostDict:
+                self.standbyCostDict[connection.id] = {
+                    "billing": connection.plugin.business_attributes.get("billing"),
+                    "time": 0,                  # seconds
+                    "count": 0,
+                }
+            self.standbyCostDict[connection.id]["count"] += 1
+            self.standbyStartTime = time.monotonic()
+            logging.info("Connection %s is standby." % (connection.id))
+        except Exception:
+            logging.error("Error occured in standby prepared callback", exc_info=True)
+        return False
+
     def _selectAndActivate(self):
         assert self.curConn is None
         if not self.param.config.get_enable():
@@ -150,10 +421,9 @@ class ByxConnectionManager:
         for netType in [ByxNetworkType.WIRED, ByxNetworkType.WIRELESS, ByxNetworkType.MOBILE]:
             if not self.param.config.get_enable_network_type(netType):
                 continue
-            tlist = [x for x in self.connList if x.networkType == netType and x.autoActivate]
-            if len(tlist) > 0:
-                tlist.sort(_connPriorityCmp)
-                self._activateConn(tlist[0], False)
+            conn = self.registry.get_best(netType)
+            if conn is not None:
+                self._activateConn(conn, False)
                 return
 
     def _loadConnectionList(self, connDir):
@@ -161,7 +431,7 @@ class ByxConnectionManager:
             for fn in os.listdir(connDir):
                 path = os.path.join(connDir, fn)
                 if os.path.isdir(path):
-                    self.connList.append(_Connection(self, path))
+                    self.registry.add(_Connection(self, path))
 
 
 class _Connection:
@@ -181,7 +451,9 @@ class _Connection:
         self.isAvailable = False
         self.unavailableReason = None
         self.manualActive = None
-        self.activeThread = None
+        self.activateThread = None
+        self.activateGraph = None           # stages of the last activation, kept for timing
+        self.prepareThread = None           # activation for make-before-break switching
         self.activeInfo = None              # valid when connection is active
         self.ntfacGroup = None              # valid when connection is active
 
@@ -191,7 +463,7 @@ class _Connection:
 
         cfg = configparser.SafeConfigParser()
         cfg.read(fn)
-        self._initStaticData(fn, cfg)
+        self._initStaticData(path, fn, cfg)
         self._initNtfacDict(path)
 
         self.plugin = None
@@ -204,10 +476,10 @@ class _Connection:
             modname = modname[len(self.pObj.param.libDir + "/"):]
             modname = modname.replace("/", ".")
             exec("from %s import Plugin" % (modname))
-            code = ""
+            code = ""                          # callbacks can be called in availability test workers, they are handled in main loop
             code += "Plugin(self.pObj.param.tmpDir, path,"
-            code += "       lambda: self.pObj.on_connection_available(self),"
-            code += "       lambda reason: self.pObj.on_connection_unavailable(self, reason))"
+            code += "       lambda: GLib.idle_add(self.pObj.on_connection_available, self),"
+            code += "       lambda reason: GLib.idle_add(self.pObj.on_connection_unavailable, self, reason))"
             self.plugin = eval(code)
 
         assert self.plugin.network_type in [ByxNetworkType.WIRED, ByxNetworkType.WIRELESS, ByxNetworkType.MOBILE]
@@ -215,7 +487,7 @@ class _Connection:
             self.networkType = self.plugin.network_type
 
     def dispose(self):
-        assert self.activeThread is None
+        assert self.activateThread is None
         assert self.activeInfo is None
         assert self.ntfacGroup is None
         self.plugin.dispose()
@@ -224,13 +496,41 @@ class _Connection:
         assert self.activeInfo is None and self.activateThread is None
         self.manualActive = manualActive
         self.activateThread = _ConnActivateThread(self)
+        self.activateGraph = self.activateThread.graph
         self.activateThread.start()
 
-    def deactivate(self, alreadyUnavailable):
-        if self.activateThread is not None:
-            self.activateThread.stop()
-            self.activateThread.join()
+    def prepare(self, callback, bStandby=False):
+        # activate by plugin only, callback(connection, thread, bSuccess) is called in main loop,
+        # default routes added by the plugin are deleted for standby connection
+        assert self.activeInfo is None and self.activateThread is None and self.prepareThread is None
+        self.prepareThread = _ConnPrepareThread(self, callback, bStandby)
+        self.activateGraph = self.prepareThread.graph
+        self.prepareThread.start()
+
+    def cancel_prepare(self, alreadyUnavailable):
+        t = self.prepareThread
+        if t is not None:
+            t.stop()
+            t.join()
+            self.prepareThread = None
+        if self.activeInfo is not None:
+            self.activeInfo = None
+            if not alreadyUnavailable:
+                self.plugin.deactivate()
+
+    def take_over(self, ntfacGroup):
+        # prepared connection becomes active with the ntfac group of the old connection
+        self.ntfacGroup = ntfacGroup
+        self.manualActive = False
+
+    def deactivate(self, alreadyUnavailable, bKeepResolvConf=False):
+        t = self.activateThread               # set to None when the thread reports its result
+        if t is not None:
+            t.stop()
+            t.join()
             self.activateThread = None
+            if t.group is not None:
+                t.group.dispose()               # the result is not reported yet, it is dropped
 
         if self.ntfacGroup is not None:
             self.ntfacGroup.dispose()
@@ -239,14 +539,15 @@ class _Connection:
         self.activeInfo = None
         if not alreadyUnavailable:
             self.plugin.deactivate()
-        with open("/etc/resolv.conf", "w") as f:
-            f.write("")
+        if not bKeepResolvConf:
+            with open("/etc/resolv.conf", "w") as f:
+                f.write("")
         self.manualActive = None
 
         logging.info("Connection %s deactivated." % (self.id))
 
-    def _initStaticData(self, fn, cfg):
-        self.id = os.path.basename(fn)
+    def _initStaticData(self, path, fn, cfg):
+        self.id = os.path.basename(path)                 # name of the profile directory, fn is always connection.ini
         if cfg.has_option("main", "name"):
             self.name = cfg.get("main", "name")
         if cfg.has_option("main", "priority"):
@@ -274,37 +575,144 @@ class _Connection:
 
 class _ConnActivateThread(threading.Thread):
 
-    def __init__(self, param, pObj):
-        self.param = param
+    # activation stages, independent stages run concurrently:
+    #
+    #   resolv-conf
+    #   connection  ----+
+    #   nameserver  ----+--> main-entity --> ntfac
+    #   gateway     ----+
+    #
+    # level 2 nameserver and gateway manager are started while the plugin is activating the
+    # connection, which usually waits for the link and DHCP.
+    #
+    # the ntfac group shares objects with main loop callbacks, so it is created, started and disposed
+    # in main loop, stages hand the work over by ByxStageGraph.call_in_main_loop(). the result is reported
+    # in main loop, a group not taken by the connection then is disposed by _Connection.deactivate().
+
+    def __init__(self, pObj):
+        threading.Thread.__init__(self)
+        self.param = pObj.pObj.param
         self.pObj = pObj
-        self.bStop = False
+        self.graph = ByxStageGraph()
+        self.group = None
 
     def run(self):
+        conn = self.pObj
+        bSuccess = False
         try:
-            # manipulate /etc/resolv.conf
-            with open("/etc/resolv.conf", "w") as f:
-                f.write("# Generated by bombyx\n")
-                f.write("nameserver 127.0.0.1\n")
-            if self.bStop:
-                return
+            self.group = self.graph.call_in_main_loop(lambda: ByxNtfacGroup(self.param, conn.ntfacDict, conn.pObj.persistentNtfacSet))
+            group = self.group
+            self.graph.add_stage("resolv-conf", self._writeResolvConf)
+            self.graph.add_stage("connection", self._activateConnection, [], conn.plugin.cancel_activate)
+            self.graph.add_stage("nameserver", lambda: self.graph.call_in_main_loop(group.start_nameserver))
+            self.graph.add_stage("gateway", lambda: self.graph.call_in_main_loop(group.start_gateway))
+            self.graph.add_stage("main-entity", lambda: self.graph.call_in_main_loop(lambda: group.set_active_info(conn.activeInfo)), ["connection", "nameserver", "gateway"])
+            self.graph.add_stage("ntfac", self._startNtfacs, ["main-entity"], group.cancel_start)
+            self.graph.run()
+            bSuccess = True
+        except ByxStageGraph.CancelledException:
+            logging.info("Activation of connection %s cancelled." % (conn.id))
+        except Exception:
+            logging.error("Failed to activate connection %s." % (conn.id), exc_info=True)
+        GLib.idle_add(self._onFinished, bSuccess)
 
-            # manipulate connection
-            self.pObj.activeInfo = self.pObj.plugin.do_activate()
-            if self.bStop:
-                return
+    def stop(self):
+        self.graph.cancel()
 
-            # manipulate ntfac group
-            self.pObj.ntfacGroup = ByxNtfacGroup(self.param, self.pObj.activeInfo, self.pObj.ntfacDict)
-            if self.bStop:
-                return
+    def _onFinished(self, bSuccess):
+        conn = self.pObj
+        try:
+            if conn.activateThread is not self:
+                return False                    # deactivated, the group is disposed by it
+            conn.activateThread = None
+            if bSuccess:
+                conn.ntfacGroup = self.group
+                logging.info("Connection %s activated in %d milliseconds." % (conn.id, self.graph.get_timing()["total"]))
+            elif self.group is not None:
+                self.group.dispose()
+        except Exception:
+            logging.error("Error occured in activation finished callback", exc_info=True)
+        return False
+
+    def _startNtfacs(self):
+        self.graph.call_in_main_loop(self.group.start_ntfacs)
+        self.group.wait_ntfacs_ready()
+        self.graph.call_in_main_loop(self.group.attach_persistent_ntfacs)
+
+    def _writeResolvConf(self):
+        with open("/etc/resolv.conf", "w") as f:
+            f.write("# Generated by bombyx\n")
+            f.write("nameserver 127.0.0.1\n")
 
-            logging.info("Connection %s activated." % (self.pObj.id))
-        finally:
-            self.pObj.activateThread = None
+    def _activateConnection(self):
+        self.pObj.activeInfo = self.pObj.plugin.do_activate()
+
+
+class _ConnPrepareThread(threading.Thread):
+
+    def __init__(self, pObj, callback, bStandby):
+        threading.Thread.__init__(self)
+        self.param = pObj.pObj.param
+        self.pObj = pObj
+        self.callback = callback
+        self.bStandby = bStandby
+        self.graph = ByxStageGraph()
+
+    def run(self):
+        bSuccess = False
+        try:
+            self.graph.add_stage("connection", self._activateConnection, [], self.pObj.plugin.cancel_activate)
+            if self.bStandby:
+                self.graph.add_stage("standby-route", lambda: self.graph.call_in_main_loop(self._deleteDefaultRoutes), ["connection"])
+            self.graph.add_stage("verify", self._verifyGateway, ["connection"])
+            self.graph.run()
+            bSuccess = True
+        except ByxStageGraph.CancelledException:
+            pass
+        except Exception:
+            logging.error("Failed to prepare connection %s." % (self.pObj.id), exc_info=True)
+        GLib.idle_add(self.callback, self.pObj, self, bSuccess)
 
     def stop(self):
-        self.bStop = True
-        self.pObj.cancel_activate()
+        self.graph.cancel()
+
+    def _activateConnection(self):
+        self.pObj.activeInfo = self.pObj.plugin.do_activate()
+
+    def _deleteDefaultRoutes(self):
+        # standby connection must not take traffic, the default route the plugin may have added is deleted
+        if "default-gateway" not in self.pObj.activeInfo:
+            return
+        idx = self.param.netlink.get_ifindex(self.pObj.activeInfo["default-gateway"][1])
+        if idx is None:
+            return
+        opList = []
+        for msg in self.param.netlink.get_routes():
+            if msg["dst_len"] == 0 and msg.get_attr("RTA_OIF") == idx:
+                opList.append(("del", "0.0.0.0/0", msg.get_attr("RTA_GATEWAY"), idx))
+        for err in self.param.netlink.route_batch(opList):
+            if err not in [0, 3]:       # message: No such process
+                raise pyroute2.netlink.exceptions.NetlinkError(err)
+        if len(opList) > 0:
+            logging.info("%d default routes of standby connection %s deleted." % (len(opList), self.pObj.id))
+
+    def _verifyGateway(self):
+        if "default-gateway" not in self.pObj.activeInfo:
+            return
+        nexthop, interface = self.pObj.activeInfo["default-gateway"]
+        if nexthop is None:
+            if self.param.netlink.get_ifindex(interface) is None:
+                raise Exception("interface %s does not exist" % (interface))
+            return
+        cmd = ["/bin/ping", "-q", "-n", "-c", "1", "-W", "1"]
+        if interface is not None:
+            cmd += ["-I", interface]
+        for i in range(0, 3):
+            if self.graph.is_cancelled():
+                return
+            if subprocess.run(cmd + [nexthop], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+                return
+        raise Exception("gateway %s is not reachable" % (nexthop))
 
 
 def _connPriorityCmp(conn1, conn2):
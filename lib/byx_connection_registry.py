@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import heapq
+
+
+class ByxConnectionRegistry:
+
+    # connections indexed by id, and a heap of candidates for every network type. candidates are
+    # the connections which are available and auto-activated, the best one has the highest priority,
+    # ties are broken by id.
+    #
+    # an entry is not removed from heap when its connection changes, a new entry is pushed and the
+    # old one becomes stale, stale entries are dropped when they reach the top, and all of them are
+    # dropped when they outnumber the valid ones.
+
+    COMPACT_THRESHOLD = 64
+
+    def __init__(self):
+        self.connList = []                      # list<connection>, in loading order
+        self.connDict = dict()                  # dict<id, connection>
+        self.heapDict = dict()                  # dict<network-type, list<entry>>, entry is (-priority, id, network-type)
+        self.entryDict = dict()                 # dict<id, entry>, the valid entry of every candidate
+        self.staleCount = 0
+
+    def add(self, conn):
+        assert conn.id not in self.connDict
+        self.connList.append(conn)
+        self.connDict[conn.id] = conn
+        self.update(conn)
+
+    def get(self, id):
+        return self.connDict.get(id)
+
+    def get_id_list(self):
+        return [x.id for x in self.connList]
+
+    def update(self, conn):
+        # must be called after isAvailable, autoActivate, priority or networkType of conn changes
+        oldEntry = self.entryDict.get(conn.id)
+        if conn.isAvailable and conn.autoActivate:
+            entry = (-(conn.priority if conn.priority is not None else 0), conn.id, conn.networkType)
+            if entry == oldEntry:
+                return
+            self.entryDict[conn.id] = entry
+            heapq.heappush(self.heapDict.setdefault(conn.networkType, []), entry)
+        else:
+            if oldEntry is None:
+                return
+            del self.entryDict[conn.id]
+
+        if oldEntry is not None:
+            self.staleCount += 1
+            if self.staleCount > len(self.entryDict) + self.COMPACT_THRESHOLD:
+                self._compact()
+
+    def get_best(self, networkType, filterFunc=None):
+        """Returns the best candidate of networkType accepted by filterFunc, or None"""
+
+        heap = self.heapDict.get(networkType, [])
+        ret = None
+        rejectList = []
+        while len(heap) > 0:
+            entry = heap[0]
+            if self.entryDict.get(entry[1]) is not entry:
+                heapq.heappop(heap)
+                self.staleCount -= 1
+                continue
+            conn = self.connDict[entry[1]]
+            if filterFunc is None or filterFunc(conn):
+                ret = conn
+                break
+            rejectList.append(heapq.heappop(heap))
+        for entry in rejectList:
+            heapq.heappush(heap, entry)
+        return ret
+
+    def get_statistics(self):
+        return {
+            "connection": len(self.connList),
+            "candidate": len(self.entryDict),
+            "stale": self.staleCount,
+        }
+
+    def _compact(self):
+        self.heapDict = dict()
+        for entry in self.entryDict.values():
+            self.heapDict.setdefault(entry[2], []).append(entry)
+        for heap in self.heapDict.values():
+            heapq.heapify(heap)
+        self.staleCount = 0
@@ -10,9 +10,13 @@ from dbus.mainloop.glib import DBusGMainLoop
 from byx_util import ByxUtil
 from byx_util import CallingPointManager
 from byx_util import PluginManager
+from byx_util import PortAllocator
 from byx_dbus import DbusMainObject
 from byx_dbus import DbusIpForwardObject
 from byx_common import ByxConfig
+from byx_netlink import ByxNetlink
+from byx_firewall import ByxIptablesFirewall
+from byx_firewall import ByxNftablesFirewall
 from byx_traffic_manager import ByxTrafficManager
 from byx_connection_manager import ByxConnectionManager
 
@@ -29,12 +33,19 @@ class ByxDaemon:
             logging.getLogger().setLevel(ByxUtil.getLoggingLevel(self.param.logLevel))
             logging.info("Program begins.")
 
-            # manipulate iptables
-            if not self.param.abortOnError:
-                ByxUtil.iptablesSetEmpty()
+            # manipulate iptables or nftables
+            if self.param.firewallBackend == "nftables":
+                if not self.param.abortOnError:
+                    ByxUtil.nftablesSetEmpty()
+                else:
+                    if not ByxUtil.nftablesIsEmpty():
+                        raise Exception("nftables is not empty, bombyx use nftables exclusively")
             else:
-                if not ByxUtil.iptablesIsEmpty():
-                    raise Exception("iptables is not empty, bombyx use iptables exclusively")
+                if not self.param.abortOnError:
+                    ByxUtil.iptablesSetEmpty()
+                else:
+                    if not ByxUtil.iptablesIsEmpty():
+                        raise Exception("iptables is not empty, bombyx use iptables exclusively")
 
             # load configuration
             self.param.config = ByxConfig(self.param)
@@ -51,6 +62,7 @@ class ByxDaemon:
             # start supporting managers
             self.param.callingPointManager = CallingPointManager()
             self.param.pluginManager = PluginManager(self.param.libPluginDir)
+            self.param.portAllocator = PortAllocator()
 
             # start DBUS API server
             self.param.dbusMainObject = DbusMainObject(self.param)
@@ -58,6 +70,11 @@ class ByxDaemon:
             logging.info("DBUS-API server started.")
 
             # business initialize
+            self.param.netlink = ByxNetlink(self.param)
+            if self.param.firewallBackend == "nftables":
+                self.param.firewall = ByxNftablesFirewall(self.param)
+            else:
+                self.param.firewall = ByxIptablesFirewall(self.param)
             self.param.trafficManager = ByxTrafficManager(self.param)
             self.param.connectionManager = ByxConnectionManager(self.param)
             self.param.daemon = self
@@ -72,6 +89,15 @@ class ByxDaemon:
             if self.param.connectionManager is not None:
                 self.param.connectionManager.dispose()
                 self.param.connectionManager = None
+            if self.param.trafficManager is not None:
+                self.param.trafficManager.dispose()
+                self.param.trafficManager = None
+            if self.param.firewall is not None:
+                self.param.firewall.dispose()
+                self.param.firewall = None
+            if self.param.netlink is not None:
+                self.param.netlink.dispose()
+                self.param.netlink = None
             logging.shutdown()
 
     def _sigHandlerINT(self, signum):
@@ -21,6 +21,8 @@ from byx_common import ByxState
 #   (state:int,health:int)      GetState()
 #   info:json                   GetActiveConnection()
 #   info:json                   GetConnections()
+#   info:json                   GetStatistics()
+#   info:json                   GetActivationTiming()
 #
 # Methods:
 #   void            Enable()
@@ -75,6 +77,18 @@ class DbusMainObject(dbus.service.Object):
             ret.append(self.param.connectionManager.get_connection_data(cid))
         return json.dumps(ret)
 
+    @dbus.service.method('org.fpemud.Bombyx', out_signature='s')
+    def GetStatistics(self):
+        ret = dict()
+        ret["netlink"] = self.param.netlink.get_statistics()
+        ret["traffic-manager"] = self.param.trafficManager.get_statistics()
+        ret["connection-manager"] = self.param.connectionManager.get_statistics()
+        return json.dumps(ret)
+
+    @dbus.service.method('org.fpemud.Bombyx', out_signature='s')
+    def GetActivationTiming(self):
+        return json.dumps(self.param.connectionManager.get_activation_timing())
+
     @dbus.service.method('org.fpemud.Bombyx')
     def Enable(self):
         self.param.config.set_enable(True)
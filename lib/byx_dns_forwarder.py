@@ -0,0 +1,1024 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import time
+import socket
+import struct
+import random
+import logging
+import collections
+from gi.repository import GLib
+
+
+class ByxDnsForwarder:
+
+    # in-process alternative of ByxDnsmasq, runs in the GLib main loop:
+    #   1. upstream servers are selected by the longest matching domain suffix in a trie,
+    #      servers of the same domain are tried in order, like "strict-order" of dnsmasq
+    #   2. answers are kept in a LRU cache with TTL, which is not flushed when upstream servers change
+    #   3. every upstream server has a small pool of connected UDP sockets
+    #   4. latency and failures are recorded for every upstream server
+    #
+    # it has the same interface as ByxDnsmasq, only "resolv-file", "no-resolv", "addn-hosts", "hostsdir"
+    # and "domain-needed" in base config are used. changing config never restarts anything.
+
+    CACHE_SIZE = 4096
+    QUERY_TIMEOUT = 2000                # milliseconds, for every upstream server
+    NEGATIVE_TTL = 60                   # seconds, for negative answers without SOA record
+    POOL_SIZE = 4                       # sockets for every upstream server
+    CHECK_INTERVAL = 1                  # seconds, resolv-file and hosts files are checked for changes at most once in this interval
+
+    def __init__(self, param, name):
+        self.param = param
+        self.name = name
+        self.logger = logging.getLogger(self.__module__ + "." + self.__class__.__name__)
+
+        self.port = None
+        self.baseCfg = None
+        self.domainIndex = None
+
+        self.resolvFile = None
+        self.bDomainNeeded = False
+        self.fileCheckTime = None
+        self.resolvFileSig = None
+        self.hostsTable = None                  # _HostsTable, None if no "addn-hosts" or "hostsdir"
+
+        self.domainDict = dict()                # dict<domain, list<upstream-key>>, upstream-key is (address, port)
+        self.domainUpstreamDict = dict()        # dict<upstream-key, count>, reference count of upstreams in self.domainDict
+        self.trie = _DomainTrie()
+        self.defaultList = []                   # list<upstream-key>, from domain index
+        self.resolvList = []                    # list<upstream-key>, from resolv-file
+        self.upstreamDict = dict()              # dict<upstream-key, _Upstream>
+        self.pendingDict = dict()               # dict<(socket, id), _Query>
+        self.cache = _AnswerCache(self.CACHE_SIZE, self.NEGATIVE_TTL)
+
+        self.udpSock = None
+        self.tcpSock = None
+        self.watchList = []
+        self.tcpClientSet = set()
+        self.tcpExchangeSet = set()
+        self.answerCallbackList = []            # list<(callback, flush-callback)>
+        self.heldReplyList = []                 # list<(_Query, data)>, answers waiting for the flush callbacks
+        self.flushIdle = None
+
+        self.queryCount = 0
+        self.localAnswerCount = 0
+        self.configUpdateCount = 0
+
+    def start(self, baseCfg, domainIndex):
+        assert self.udpSock is None
+        self.port = self.param.portAllocator.reserve(self.name)
+        try:
+            self.udpSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udpSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.udpSock.setblocking(False)
+            self.udpSock.bind(("127.0.0.1", self.port))
+            self.watchList.append(GLib.io_add_watch(self.udpSock.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, self._onUdpReceive))
+
+            self.tcpSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.tcpSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.tcpSock.setblocking(False)
+            self.tcpSock.bind(("127.0.0.1", self.port))
+            self.tcpSock.listen(16)
+            self.watchList.append(GLib.io_add_watch(self.tcpSock.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, self._onTcpAccept))
+
+            self.param.portAllocator.release(self.name)            # we own the port now
+            self._applyConfig(baseCfg, domainIndex)
+        except BaseException:
+            self.stop()
+            raise
+
+    def stop(self):
+        for watch in self.watchList:
+            GLib.source_remove(watch)
+        self.watchList = []
+        for query in self.pendingDict.values():
+            GLib.source_remove(query.timer)
+        self.pendingDict = dict()
+        if self.flushIdle is not None:
+            GLib.source_remove(self.flushIdle)
+            self.flushIdle = None
+        self.heldReplyList = []
+        for obj in list(self.tcpClientSet) + list(self.tcpExchangeSet):
+            obj.close()
+        for upstream in self.upstreamDict.values():
+            upstream.close()
+        self.upstreamDict = dict()
+        if self.tcpSock is not None:
+            self.tcpSock.close()
+            self.tcpSock = None
+        if self.udpSock is not None:
+            self.udpSock.close()
+            self.udpSock = None
+        self.param.portAllocator.release(self.name)
+        self.port = None
+
+    def add_answer_callback(self, callback, flushCallback):
+        # callback(qname, list<(rtype, address, ttl)>) is called with the A/AAAA records of every
+        # upstream answer, it returns True if it has queued work for the answer. such answers are held,
+        # flushCallback() is called once per main loop iteration, then the held answers are sent to client.
+        self.answerCallbackList.append((callback, flushCallback))
+
+    def remove_answer_callback(self, callback):
+        self.answerCallbackList = [x for x in self.answerCallbackList if x[0] != callback]
+
+    def get_port(self):
+        return self.port
+
+    def is_running(self):
+        return self.udpSock is not None
+
+    def set_config(self, baseCfg, domainIndex):
+        assert self.udpSock is not None
+        self._applyConfig(baseCfg, domainIndex)
+        self.configUpdateCount += 1
+
+    def reload_hosts(self, fileList=None):
+        # the same as SIGHUP to dnsmasq, but only the changed hosts files are read, and the cache is kept,
+        # fileList is the hosts files changed, or None if unknown
+        assert self.udpSock is not None
+        if self.hostsTable is not None:
+            self.hostsTable.refresh(fileList)
+
+    def get_statistics(self):
+        return {
+            "query": self.queryCount,
+            "local-answer": self.localAnswerCount,
+            "config-update": self.configUpdateCount,
+            "hosts": self.hostsTable.get_statistics() if self.hostsTable is not None else None,
+            "domain-rule": self.domainIndex.get_statistics() if self.domainIndex is not None else None,
+            "cache": self.cache.get_statistics(),
+            "upstream": {"%s#%d" % k: v.get_statistics() for k, v in self.upstreamDict.items()},
+        }
+
+    def _applyConfig(self, baseCfg, domainIndex):
+        if baseCfg != self.baseCfg:
+            self.baseCfg = baseCfg
+            self.resolvFile = "/etc/resolv.conf"            # default of dnsmasq
+            hostsPath = None
+            self.bDomainNeeded = False
+            for line in baseCfg.split("\n"):
+                line = line.strip()
+                if line.startswith("resolv-file="):
+                    self.resolvFile = line[len("resolv-file="):]
+                elif line == "no-resolv":
+                    self.resolvFile = None
+                elif line.startswith("addn-hosts="):
+                    hostsPath = line[len("addn-hosts="):]
+                elif line.startswith("hostsdir="):
+                    hostsPath = line[len("hostsdir="):]
+                elif line == "domain-needed":
+                    self.bDomainNeeded = True
+            self.fileCheckTime = None
+            self.resolvFileSig = None
+            self.resolvList = []
+            self.hostsTable = _HostsTable(hostsPath) if hostsPath is not None else None
+            self._checkFiles()
+
+        # the owner updates the same domain index, only the rules it reports as changed are updated in the trie
+        if domainIndex is self.domainIndex:
+            changeDict = domainIndex.pop_changes()
+        else:
+            domainIndex.pop_changes()
+            changeDict = {x: None for x in self.domainDict if x not in domainIndex.get_rules()}
+            changeDict.update(domainIndex.get_rules())
+            self.domainIndex = domainIndex
+
+        bChanged = False
+        for domain, serverTuple in changeDict.items():
+            upstreamList = [_Helper.parseServer(x) for x in serverTuple] if serverTuple is not None else None
+            oldList = self.domainDict.get(domain)
+            if upstreamList == oldList:
+                continue
+            if oldList is not None:
+                for key in oldList:
+                    self.domainUpstreamDict[key] -= 1
+                    if self.domainUpstreamDict[key] == 0:
+                        del self.domainUpstreamDict[key]
+                del self.domainDict[domain]
+                self.trie.remove(domain)
+            if upstreamList is not None:
+                for key in upstreamList:
+                    self.domainUpstreamDict[key] = self.domainUpstreamDict.get(key, 0) + 1
+                self.domainDict[domain] = upstreamList
+                self.trie.set(domain, upstreamList)
+            bChanged = True
+
+        defaultList = [_Helper.parseServer(x) for x in domainIndex.get_default_server_list()]
+        if defaultList != self.defaultList:
+            self.defaultList = defaultList
+            bChanged = True
+
+        if bChanged:
+            self._gcUpstreams()
+
+    def _checkFiles(self):
+        now = time.monotonic()
+        if self.fileCheckTime is not None and now - self.fileCheckTime < self.CHECK_INTERVAL:
+            return
+        self.fileCheckTime = now
+
+        if self.resolvFile is not None:
+            sig = _Helper.fileSig(self.resolvFile)
+            if sig != self.resolvFileSig:
+                self.resolvFileSig = sig
+                self.resolvList = _Helper.readResolvFile(self.resolvFile)
+                self._gcUpstreams()
+
+        if self.hostsTable is not None:
+            self.hostsTable.refresh()
+
+    def _gcUpstreams(self):
+        keySet = set(self.defaultList) | set(self.resolvList) | set(self.domainUpstreamDict.keys())
+        for key in list(self.upstreamDict.keys()):
+            if key not in keySet:
+                self.upstreamDict.pop(key).close()      # pending queries on it fail over when timeout
+
+    def _onUdpReceive(self, source, cb_condition):
+        try:
+            for i in range(0, 64):
+                try:
+                    data, addr = self.udpSock.recvfrom(65535)
+                except BlockingIOError:
+                    break
+                self._handleQuery(data, lambda resp, addr=addr: self.udpSock.sendto(resp, addr), False)
+        except Exception:
+            self.logger.error("Error occured in UDP receive callback", exc_info=True)
+        return True
+
+    def _onTcpAccept(self, source, cb_condition):
+        try:
+            conn, addr = self.tcpSock.accept()
+            self.tcpClientSet.add(_TcpClient(self, conn))
+        except BlockingIOError:
+            pass
+        except Exception:
+            self.logger.error("Error occured in TCP accept callback", exc_info=True)
+        return True
+
+    def _handleQuery(self, data, replyFunc, bTcp):
+        try:
+            qname, qtype, qclass, qend = _DnsMessage.parseQuestion(data)
+        except ValueError:
+            return                                          # malformed, drop it
+        if data[2] & 0x80:
+            return                                          # not a query
+        self.queryCount += 1
+        self._checkFiles()
+
+        # answer from hosts files
+        addressList = self.hostsTable.lookup(qname) if self.hostsTable is not None else None
+        if addressList is not None and qclass == 1 and qtype in [1, 28]:
+            family = socket.AF_INET if qtype == 1 else socket.AF_INET6
+            answerList = []
+            for address in addressList:
+                try:
+                    answerList.append((qtype, socket.inet_pton(family, address)))
+                except OSError:
+                    pass
+            replyFunc(_DnsMessage.buildReply(data, qend, 0, answerList))
+            self.localAnswerCount += 1
+            return
+
+        # don't forward plain names
+        if self.bDomainNeeded and "." not in qname:
+            replyFunc(_DnsMessage.buildReply(data, qend, 3, []))
+            return
+
+        # answer from cache, an answer is only returned to queries with the same DNSSEC bits, so that a
+        # client asking for signatures is not given an answer without them. the cached answer may be
+        # fetched by TCP or for a bigger EDNS payload size, it is truncated if the UDP client can't take it.
+        try:
+            cd, edns, do, udpSize = _DnsMessage.parseQueryFlags(data, qend)
+        except ValueError:
+            return                                          # malformed, drop it
+        key = (qname, qtype, qclass, cd, edns, do)
+        udpLimit = None if bTcp else udpSize
+        resp = self.cache.get(key, time.monotonic())
+        if resp is not None:
+            resp[0:2] = data[0:2]
+            replyFunc(_DnsMessage.fitUdp(bytes(resp), udpLimit))
+            return
+
+        # forward
+        upstreamList = self.trie.lookup(qname)
+        if upstreamList is None:
+            upstreamList = list(collections.OrderedDict.fromkeys(self.defaultList + self.resolvList))
+            if len(upstreamList) == 0:
+                replyFunc(_DnsMessage.buildReply(data, qend, 5, []))           # REFUSED, no upstream server
+                return
+        elif len(upstreamList) == 0:
+            replyFunc(_DnsMessage.buildReply(data, qend, 3, []))               # NXDOMAIN, local-only domain
+            return
+        self._sendQuery(_Query(data, qend, key, upstreamList, replyFunc, bTcp, udpLimit))
+
+    def _sendQuery(self, query):
+        key = query.upstreamList[query.index]
+        if key not in self.upstreamDict:
+            self.upstreamDict[key] = _Upstream(key, self.POOL_SIZE, self._onUpstreamReceive)
+        upstream = self.upstreamDict[key]
+
+        try:
+            sock = upstream.get_socket()
+            while True:
+                qid = random.randint(0, 0xFFFF)
+                if (sock, qid) not in self.pendingDict:
+                    break
+            buf = bytearray(query.data)
+            struct.pack_into("!H", buf, 0, qid)
+            sock.send(buf)
+        except OSError:
+            upstream.errorCount += 1
+            self._nextUpstream(query)
+            return
+
+        query.upstream = upstream
+        query.sock = sock
+        query.qid = qid
+        query.sendTime = time.monotonic()
+        query.timer = GLib.timeout_add(self.QUERY_TIMEOUT, self._onQueryTimeout, query)
+        self.pendingDict[(sock, qid)] = query
+        upstream.queryCount += 1
+
+    def _nextUpstream(self, query):
+        query.index += 1
+        if query.index < len(query.upstreamList):
+            self._sendQuery(query)
+        else:
+            query.replyFunc(_DnsMessage.buildReply(query.data, query.qend, 2, []))     # SERVFAIL
+
+    def _onQueryTimeout(self, query):
+        try:
+            del self.pendingDict[(query.sock, query.qid)]
+            query.upstream.timeoutCount += 1
+            self._nextUpstream(query)
+        except Exception:
+            self.logger.error("Error occured in query timeout callback", exc_info=True)
+        return False
+
+    def _onUpstreamReceive(self, source, cb_condition, sock):
+        try:
+            for i in range(0, 64):
+                try:
+                    data = sock.recv(65535)
+                except BlockingIOError:
+                    break
+                except OSError:
+                    continue                                # ICMP error of a previous query
+                if len(data) < 12:
+                    continue
+                query = self.pendingDict.get((sock, struct.unpack_from("!H", data, 0)[0]))
+                if query is None:
+                    continue
+                try:
+                    if _DnsMessage.parseQuestion(data)[:3] != query.key[:3]:
+                        continue                            # not the answer of our question
+                except ValueError:
+                    continue
+                del self.pendingDict[(sock, query.qid)]
+                GLib.source_remove(query.timer)
+                self._onAnswer(query, data)
+        except Exception:
+            self.logger.error("Error occured in upstream receive callback", exc_info=True)
+        return True
+
+    def _onAnswer(self, query, data):
+        query.upstream.record_answer(time.monotonic() - query.sendTime)
+
+        rcode = data[3] & 0x0F
+        if rcode in [2, 5] and query.index + 1 < len(query.upstreamList):
+            self._nextUpstream(query)                       # SERVFAIL or REFUSED, try next server
+            return
+
+        if data[2] & 0x02:
+            # truncated, client retries by TCP itself if it is a UDP client
+            if query.bTcp:
+                self.tcpExchangeSet.add(_TcpExchange(self, query.upstream.key, query.data, self.QUERY_TIMEOUT,
+                                                     lambda resp: self._onTcpAnswer(query, data, resp)))
+                return
+        elif rcode in [0, 3]:
+            self.cache.put(query.key, data, time.monotonic())
+
+        self._reply(query, data)
+
+    def _onTcpAnswer(self, query, udpData, data):
+        if data is not None and len(data) >= 12 and (data[3] & 0x0F) in [0, 3]:
+            self.cache.put(query.key, data, time.monotonic())
+            self._reply(query, data)
+        else:
+            self._reply(query, udpData)
+
+    def _reply(self, query, data):
+        if len(self.answerCallbackList) > 0 and (data[3] & 0x0F) == 0:
+            bHold = False
+            try:
+                addrList = _DnsMessage.parseAddresses(data)
+                if len(addrList) > 0:
+                    for callback, flushCallback in self.answerCallbackList:
+                        bHold |= bool(callback(query.key[0], addrList))
+            except Exception:
+                self.logger.error("Error occured in answer callback", exc_info=True)
+            if bHold:
+                # idle priority is lower than read callbacks, so all the answers already received are flushed together
+                self.heldReplyList.append((query, data))
+                if self.flushIdle is None:
+                    self.flushIdle = GLib.idle_add(self._onFlushIdle)
+                return
+        self._sendReply(query, data)
+
+    def _onFlushIdle(self):
+        self.flushIdle = None
+        try:
+            for callback, flushCallback in self.answerCallbackList:
+                flushCallback()
+        except Exception:
+            self.logger.error("Error occured in answer flush callback", exc_info=True)
+        replyList = self.heldReplyList
+        self.heldReplyList = []
+        for query, data in replyList:
+            try:
+                self._sendReply(query, data)
+            except Exception:
+                self.logger.error("Error occured in answer flush callback", exc_info=True)
+        return False
+
+    def _sendReply(self, query, data):
+        buf = bytearray(data)
+        buf[0:2] = query.data[0:2]
+        query.replyFunc(_DnsMessage.fitUdp(bytes(buf), query.udpLimit))
+
+
+class _Query:
+
+    def __init__(self, data, qend, key, upstreamList, replyFunc, bTcp, udpLimit):
+        self.data = data
+        self.qend = qend
+        self.key = key                          # (qname, qtype, qclass, cd, edns, do), key of answer cache
+        self.upstreamList = upstreamList
+        self.replyFunc = replyFunc
+        self.bTcp = bTcp
+        self.udpLimit = udpLimit                # bytes, biggest answer the UDP client takes, None for TCP client
+        self.index = 0                          # index of current upstream server
+
+        self.upstream = None
+        self.sock = None
+        self.qid = None
+        self.sendTime = None
+        self.timer = None
+
+
+class _Upstream:
+
+    def __init__(self, key, poolSize, callback):
+        self.key = key
+        self.poolSize = poolSize
+        self.callback = callback
+        self.sockList = []
+        self.watchList = []
+        self.nextIndex = 0
+
+        self.queryCount = 0
+        self.answerCount = 0
+        self.timeoutCount = 0
+        self.errorCount = 0
+        self.latencySum = 0.0
+        self.latencyMax = 0.0
+
+    def get_socket(self):
+        if len(self.sockList) < self.poolSize:
+            family = socket.AF_INET6 if ":" in self.key[0] else socket.AF_INET
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            sock.connect(self.key)
+            self.watchList.append(GLib.io_add_watch(sock.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, self.callback, sock))
+            self.sockList.append(sock)
+            return sock
+
+        self.nextIndex = (self.nextIndex + 1) % len(self.sockList)
+        return self.sockList[self.nextIndex]
+
+    def record_answer(self, latency):
+        self.answerCount += 1
+        self.latencySum += latency
+        self.latencyMax = max(self.latencyMax, latency)
+
+    def close(self):
+        for watch in self.watchList:
+            GLib.source_remove(watch)
+        self.watchList = []
+        for sock in self.sockList:
+            sock.close()
+        self.sockList = []
+
+    def get_statistics(self):
+        return {
+            "query": self.queryCount,
+            "answer": self.answerCount,
+            "timeout": self.timeoutCount,
+            "error": self.errorCount,
+            "latency-avg-ms": round(self.latencySum * 1000 / self.answerCount, 3) if self.answerCount > 0 else None,
+            "latency-max-ms": round(self.latencyMax * 1000, 3),
+        }
+
+
+class _TcpClient:
+
+    # the socket is non-blocking, replies which can't be sent at once are queued and sent when
+    # the socket is writable, so a slow client never blocks the main loop
+
+    MAX_OUTPUT = 256 * 1024                     # bytes, a client not reading its replies is dropped
+
+    def __init__(self, parent, conn):
+        self.parent = parent
+        self.conn = conn
+        self.conn.setblocking(False)
+        self.buf = bytearray()
+        self.outBuf = bytearray()
+        self.watch = GLib.io_add_watch(self.conn.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self._onReceive)
+        self.outWatch = None
+
+    def close(self):
+        if self.watch is not None:
+            GLib.source_remove(self.watch)
+            self.watch = None
+        if self.outWatch is not None:
+            GLib.source_remove(self.outWatch)
+            self.outWatch = None
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        self.parent.tcpClientSet.discard(self)
+
+    def send(self, data):
+        if self.conn is None:
+            return                              # client has gone
+        self.outBuf += struct.pack("!H", len(data)) + data
+        if len(self.outBuf) > self.MAX_OUTPUT:
+            self.close()
+        elif self.outWatch is None:
+            self._flush()
+
+    def _flush(self):
+        try:
+            n = self.conn.send(self.outBuf)
+            del self.outBuf[:n]
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.close()
+            return
+        if len(self.outBuf) > 0 and self.outWatch is None:
+            self.outWatch = GLib.io_add_watch(self.conn.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_OUT, self._onWritable)
+
+    def _onWritable(self, source, cb_condition):
+        self.outWatch = None                    # source is removed by returning False, _flush() adds it again if needed
+        try:
+            self._flush()
+        except Exception:
+            self.parent.logger.error("Error occured in TCP client write callback", exc_info=True)
+        return False
+
+    def _onReceive(self, source, cb_condition):
+        try:
+            data = self.conn.recv(65535)
+        except OSError:
+            data = b''
+        if len(data) == 0:
+            self.watch = None                   # source is removed by returning False
+            self.close()
+            return False
+
+        self.buf += data
+        while len(self.buf) >= 2:
+            n = struct.unpack_from("!H", self.buf, 0)[0]
+            if len(self.buf) < 2 + n:
+                break
+            msg = bytes(self.buf[2:2 + n])
+            del self.buf[:2 + n]
+            self.parent._handleQuery(msg, self.send, True)
+        return True
+
+
+class _TcpExchange:
+
+    # one query to an upstream server by TCP, for truncated answers
+
+    def __init__(self, parent, key, data, timeout, callback):
+        self.parent = parent
+        self.callback = callback
+        self.outBuf = struct.pack("!H", len(data)) + data
+        self.inBuf = bytearray()
+
+        self.sock = socket.socket(socket.AF_INET6 if ":" in key[0] else socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        self.sock.connect_ex(key)
+        self.watch = GLib.io_add_watch(self.sock.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_OUT | GLib.IO_HUP | GLib.IO_ERR, self._onWritable)
+        self.timer = GLib.timeout_add(timeout, self._onTimeout)
+
+    def close(self):
+        if self.watch is not None:
+            GLib.source_remove(self.watch)
+            self.watch = None
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+            self.timer = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.parent.tcpExchangeSet.discard(self)
+
+    def _onWritable(self, source, cb_condition):
+        try:
+            n = self.sock.send(self.outBuf)
+            self.outBuf = self.outBuf[n:]
+            if len(self.outBuf) > 0:
+                return True
+            self.watch = GLib.io_add_watch(self.sock.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self._onReadable)
+        except OSError:
+            self.watch = None
+            self._finish(None)
+        return False
+
+    def _onReadable(self, source, cb_condition):
+        try:
+            data = self.sock.recv(65535)
+        except BlockingIOError:
+            return True
+        except OSError:
+            data = b''
+        self.inBuf += data
+        if len(data) == 0:
+            self.watch = None
+            self._finish(None)
+            return False
+        if len(self.inBuf) >= 2 and len(self.inBuf) >= 2 + struct.unpack_from("!H", self.inBuf, 0)[0]:
+            self.watch = None
+            self._finish(bytes(self.inBuf[2:2 + struct.unpack_from("!H", self.inBuf, 0)[0]]))
+            return False
+        return True
+
+    def _onTimeout(self):
+        self.timer = None
+        self._finish(None)
+        return False
+
+    def _finish(self, data):
+        self.close()
+        try:
+            self.callback(data)
+        except Exception:
+            self.parent.logger.error("Error occured in TCP exchange callback", exc_info=True)
+
+
+class _HostsTable:
+
+    # records of a hosts file or a directory of hosts files. a directory is only listed again when
+    # its own mtime changes, which is the case when files in it are created, removed or replaced by
+    # rename, and then only files whose inode, mtime or size changed are re-read. the writer can
+    # also tell which files are changed, so that only these files are read.
+
+    def __init__(self, path):
+        self.path = path
+        self.dirSig = None
+        self.fileDict = dict()                  # dict<filename, (sig, list<(name, address)>)>
+        self.nameDict = dict()                  # dict<name, list<address>>
+        self.readCount = 0
+
+    def lookup(self, name):
+        return self.nameDict.get(name)
+
+    def refresh(self, fnList=None):
+        if fnList is not None:
+            for fn in fnList:
+                self._readFile(fn, False)
+            self.dirSig = _Helper.fileSig(self.path)            # changes are made by the caller itself
+            return
+
+        dirSig = _Helper.fileSig(self.path)
+        if dirSig is None:
+            fnList = []
+        elif os.path.isdir(self.path):
+            if dirSig == self.dirSig:
+                return
+            fnList = [os.path.join(self.path, x) for x in os.listdir(self.path)]
+        else:
+            fnList = [self.path]
+        self.dirSig = dirSig
+
+        fnSet = set(fnList)
+        for fn in list(self.fileDict.keys()):
+            if fn not in fnSet:
+                self._readFile(fn, False)
+        for fn in fnList:
+            self._readFile(fn, True)
+
+    def get_statistics(self):
+        return {
+            "file": len(self.fileDict),
+            "name": len(self.nameDict),
+            "file-read": self.readCount,
+        }
+
+    def _readFile(self, fn, bCheckSig):
+        sig = _Helper.fileSig(fn)
+        old = self.fileDict.get(fn)
+        if bCheckSig and old is not None and old[0] == sig:
+            return
+        if old is not None:
+            self._removeRecords(old[1])
+            del self.fileDict[fn]
+        if sig is None:
+            return
+        recordList = _Helper.readHostsFile(fn)
+        for name, address in recordList:
+            self.nameDict.setdefault(name, []).append(address)
+        self.fileDict[fn] = (sig, recordList)
+        self.readCount += 1
+
+    def _removeRecords(self, recordList):
+        for name, address in recordList:
+            addressList = self.nameDict[name]
+            addressList.remove(address)
+            if len(addressList) == 0:
+                del self.nameDict[name]
+
+
+class _AnswerCache:
+
+    # LRU cache of answers, entries expire by the smallest TTL in the answer,
+    # TTLs are decreased by the time the answer stays in cache when it is returned
+
+    def __init__(self, maxSize, negativeTtl):
+        self.maxSize = maxSize
+        self.negativeTtl = negativeTtl
+        self.itemDict = collections.OrderedDict()       # dict<key, (insert-time, expire-time, data, list<(ttl-offset, ttl)>)>
+        self.hitCount = 0
+        self.missCount = 0
+
+    def get(self, key, now):
+        item = self.itemDict.get(key)
+        if item is None:
+            self.missCount += 1
+            return None
+        insertTime, expireTime, data, ttlList = item
+        if now >= expireTime:
+            del self.itemDict[key]
+            self.missCount += 1
+            return None
+        self.itemDict.move_to_end(key)
+        self.hitCount += 1
+
+        elapsed = int(now - insertTime)
+        ret = bytearray(data)
+        for offset, ttl in ttlList:
+            struct.pack_into("!I", ret, offset, max(ttl - elapsed, 0))
+        return ret
+
+    def put(self, key, data, now):
+        try:
+            ttlList, ttl = _DnsMessage.parseTtl(data, self.negativeTtl)
+        except ValueError:
+            return
+        if ttl <= 0:
+            return
+        self.itemDict[key] = (now, now + ttl, bytes(data), ttlList)
+        self.itemDict.move_to_end(key)
+        while len(self.itemDict) > self.maxSize:
+            self.itemDict.popitem(last=False)
+
+    def get_statistics(self):
+        return {
+            "size": len(self.itemDict),
+            "hit": self.hitCount,
+            "miss": self.missCount,
+        }
+
+
+class _DomainTrie:
+
+    # domain labels are stored from the top level domain down,
+    # lookup returns the value of the longest matching domain suffix
+
+    def __init__(self):
+        self.root = [dict(), None]              # [dict<label, node>, value]
+
+    def set(self, domain, value):
+        node = self.root
+        for label in reversed(domain.split(".")):
+            node = node[0].setdefault(label, [dict(), None])
+        node[1] = value
+
+    def remove(self, domain):
+        pathList = []
+        node = self.root
+        for label in reversed(domain.split(".")):
+            pathList.append((node, label))
+            node = node[0].get(label)
+            if node is None:
+                return
+        node[1] = None
+
+        for parent, label in reversed(pathList):
+            child = parent[0][label]
+            if child[1] is not None or len(child[0]) > 0:
+                break
+            del parent[0][label]
+
+    def lookup(self, name):
+        ret = None
+        node = self.root
+        for label in reversed(name.split(".")):
+            node = node[0].get(label)
+            if node is None:
+                break
+            if node[1] is not None:
+                ret = node[1]
+        return ret
+
+
+class _DnsMessage:
+
+    @staticmethod
+    def readName(data, off):
+        """Returns (name, offset-after-name)"""
+
+        labelList = []
+        end = None
+        jumps = 0
+        while True:
+            if off >= len(data):
+                raise ValueError("name out of range")
+            n = data[off]
+            if n & 0xC0 == 0xC0:
+                if off + 1 >= len(data) or jumps > 32:
+                    raise ValueError("invalid compression pointer")
+                if end is None:
+                    end = off + 2
+                off = ((n & 0x3F) << 8) | data[off + 1]
+                jumps += 1
+                continue
+            if n & 0xC0 != 0:
+                raise ValueError("invalid label")
+            off += 1
+            if n == 0:
+                break
+            if off + n > len(data):
+                raise ValueError("label out of range")
+            labelList.append(data[off:off + n].decode("ascii", errors="replace"))
+            off += n
+        if end is None:
+            end = off
+        return (".".join(labelList).lower(), end)
+
+    @staticmethod
+    def parseQuestion(data):
+        """Returns (qname, qtype, qclass, offset-after-question)"""
+
+        if len(data) < 12:
+            raise ValueError("message too short")
+        if struct.unpack_from("!H", data, 4)[0] != 1:
+            raise ValueError("question count is not 1")
+        qname, off = _DnsMessage.readName(data, 12)
+        if off + 4 > len(data):
+            raise ValueError("question out of range")
+        qtype, qclass = struct.unpack_from("!HH", data, off)
+        return (qname, qtype, qclass, off + 4)
+
+    @staticmethod
+    def parseQueryFlags(data, qend):
+        """Returns (cd, edns, do, udp-size), edns is False if the query has no OPT record,
+           udp-size is the biggest UDP answer the client takes"""
+
+        anCount, nsCount, arCount = struct.unpack_from("!HHH", data, 6)
+        cd = bool(data[3] & 0x10)
+        off = qend
+        for i in range(0, anCount + nsCount + arCount):
+            name, off = _DnsMessage.readName(data, off)
+            if off + 10 > len(data):
+                raise ValueError("record out of range")
+            rtype, rclass, ttl, rdlen = struct.unpack_from("!HHIH", data, off)
+            if rtype == 41 and i >= anCount + nsCount:
+                return (cd, True, bool(ttl & 0x8000), max(rclass, 512))       # DO bit is in the extended flags of OPT record, payload size in its class
+            off += 10 + rdlen
+        return (cd, False, False, 512)
+
+    @staticmethod
+    def parseTtl(data, negativeTtl):
+        """Returns (list<(ttl-offset, ttl)>, cache-ttl)"""
+
+        qname, qtype, qclass, off = _DnsMessage.parseQuestion(data)
+        anCount, nsCount, arCount = struct.unpack_from("!HHH", data, 6)
+
+        ttlList = []
+        minTtl = None
+        soaTtl = None
+        for i in range(0, anCount + nsCount + arCount):
+            name, off = _DnsMessage.readName(data, off)
+            if off + 10 > len(data):
+                raise ValueError("record out of range")
+            rtype, rclass, ttl, rdlen = struct.unpack_from("!HHIH", data, off)
+            if off + 10 + rdlen > len(data):
+                raise ValueError("record data out of range")
+            if rtype != 41:                                 # OPT record has no TTL
+                ttlList.append((off + 4, ttl))
+                minTtl = ttl if minTtl is None else min(minTtl, ttl)
+            if rtype == 6 and anCount <= i < anCount + nsCount and rdlen >= 20:
+                soaTtl = min(ttl, struct.unpack_from("!I", data, off + 10 + rdlen - 4)[0])          # RFC 2308
+            off += 10 + rdlen
+
+        if (data[3] & 0x0F) == 3 or anCount == 0:
+            return (ttlList, soaTtl if soaTtl is not None else negativeTtl)
+        return (ttlList, minTtl)
+
+    @staticmethod
+    def parseAddresses(data):
+        """Returns list<(rtype, address, ttl)> of the A/AAAA records in answer section"""
+
+        qname, qtype, qclass, off = _DnsMessage.parseQuestion(data)
+        anCount = struct.unpack_from("!H", data, 6)[0]
+
+        ret = []
+        for i in range(0, anCount):
+            name, off = _DnsMessage.readName(data, off)
+            if off + 10 > len(data):
+                raise ValueError("record out of range")
+            rtype, rclass, ttl, rdlen = struct.unpack_from("!HHIH", data, off)
+            off += 10
+            if off + rdlen > len(data):
+                raise ValueError("record data out of range")
+            if rtype == 1 and rdlen == 4:
+                ret.append((rtype, socket.inet_ntop(socket.AF_INET, data[off:off + 4]), ttl))
+            elif rtype == 28 and rdlen == 16:
+                ret.append((rtype, socket.inet_ntop(socket.AF_INET6, data[off:off + 16]), ttl))
+            off += rdlen
+        return ret
+
+    @staticmethod
+    def fitUdp(data, udpLimit):
+        """Returns data, or its header and question with TC bit if it is bigger than udpLimit, the client retries by TCP"""
+
+        if udpLimit is None or len(data) <= udpLimit:
+            return data
+        qend = _DnsMessage.parseQuestion(data)[3]
+        ret = bytearray(data[:4]) + struct.pack("!HHHH", 1, 0, 0, 0) + data[12:qend]
+        ret[2] |= 0x02
+        return bytes(ret)
+
+    @staticmethod
+    def buildReply(query, qend, rcode, answerList):
+        """answerList is list<(type, rdata)>, answers are for the question name with TTL 0"""
+
+        flags = 0x8000 | (query[2] & 0x79) << 8 | 0x0080 | rcode           # QR, opcode and RD of query, RA
+        ret = bytearray(struct.pack("!HHHHHH", struct.unpack_from("!H", query, 0)[0], flags, 1, len(answerList), 0, 0))
+        ret += query[12:qend]
+        for rtype, rdata in answerList:
+            ret += struct.pack("!HHHIH", 0xC00C, rtype, 1, 0, len(rdata)) + rdata
+        return bytes(ret)
+
+
+class _Helper:
+
+    @staticmethod
+    def parseServer(server):
+        # "address#port" or "address"
+        tl = server.split("#")
+        if len(tl) > 1:
+            return (tl[0], int(tl[1]))
+        return (tl[0], 53)
+
+    @staticmethod
+    def fileSig(path):
+        try:
+            st = os.stat(path)
+            return (st.st_ino, st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    @staticmethod
+    def readResolvFile(path):
+        ret = []
+        try:
+            with open(path) as f:
+                for line in f.read().split("\n"):
+                    tl = line.split()
+                    if len(tl) >= 2 and tl[0] == "nameserver":
+                        ret.append((tl[1], 53))
+        except OSError:
+            pass
+        return ret
+
+    @staticmethod
+    def readHostsFile(fn):
+        """Returns list<(name, address)>"""
+
+        ret = []
+        try:
+            with open(fn) as f:
+                for line in f.read().split("\n"):
+                    tl = line.split("#")[0].split()
+                    for name in tl[1:]:
+                        ret.append((name.lower(), tl[0]))
+        except OSError:
+            pass
+        return ret
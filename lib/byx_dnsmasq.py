@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import dbus
+import signal
+import logging
+import subprocess
+from byx_util import ByxUtil
+
+
+class ByxDnsmasq:
+
+    # upstream servers are changed through the D-Bus interface (SetDomainServers) of the
+    # running dnsmasq, so that its listening port and its cache survive nameserver changes.
+    # the process is only restarted when the base config changes.
+    #
+    # the listening port is reserved by param.portAllocator, and held until dnsmasq appears on D-Bus,
+    # which means it has bound its sockets. restarts keep the same port, unless others have taken
+    # it while dnsmasq was down, then a new port is used and get_port() returns it.
+
+    DBUS_PATH = "/uk/org/thekelleys/dnsmasq"
+
+    def __init__(self, param, name):
+        self.param = param
+        self.name = name
+        self.cfgFile = os.path.join(self.param.tmpDir, "%s.conf" % (name))
+        self.pidFile = os.path.join(self.param.tmpDir, "%s.pid" % (name))
+        self.dbusName = "org.fpemud.Bombyx.Dnsmasq.%s" % (name.replace("-", "_"))
+        self.logger = logging.getLogger(self.__module__ + "." + self.__class__.__name__)
+
+        self.port = None
+        self.baseCfg = None
+        self.domainIndex = None
+        self.fingerprint = None                 # fingerprint of the domain index pushed
+
+        self.proc = None
+        self.dbusWatch = None
+        self.dbusOwner = None                   # valid when dnsmasq has registered itself on D-Bus
+
+        self.restartCount = 0
+        self.restartAvoidedCount = 0
+        self.pushSkippedCount = 0
+        self.hostsReloadCount = 0
+
+    def start(self, baseCfg, domainIndex):
+        assert self.proc is None
+        self.port = self.param.portAllocator.reserve(self.name)
+        self.baseCfg = baseCfg
+        self.domainIndex = domainIndex
+        self.fingerprint = domainIndex.get_fingerprint()
+        domainIndex.pop_changes()                                   # the whole index is pushed
+        try:
+            self.dbusWatch = dbus.SystemBus().watch_name_owner(self.dbusName, self._onNameOwnerChanged)
+            self._runDnsmasq()
+        except BaseException:
+            self.stop()
+            raise
+
+    def stop(self):
+        if self.dbusWatch is not None:
+            self.dbusWatch.cancel()
+            self.dbusWatch = None
+        self._stopDnsmasq()
+        self.port = None
+
+    def get_port(self):
+        return self.port
+
+    def is_running(self):
+        return self.proc is not None
+
+    def set_config(self, baseCfg, domainIndex):
+        """Apply new config, restart dnsmasq only if base config is changed"""
+
+        assert self.proc is not None
+
+        # the owner may update the same domain index, so its fingerprint is compared to the one pushed
+        domainIndex.pop_changes()                                   # the whole index is pushed
+        if baseCfg != self.baseCfg:
+            self.baseCfg = baseCfg
+            self.domainIndex = domainIndex
+            self.fingerprint = domainIndex.get_fingerprint()
+            self._stopDnsmasq()
+            self._reservePortAgain()
+            self._runDnsmasq()
+            self.restartCount += 1
+            return
+
+        if domainIndex.get_fingerprint() != self.fingerprint:
+            self.domainIndex = domainIndex
+            self.fingerprint = domainIndex.get_fingerprint()
+            self._pushServerList()
+            self.restartAvoidedCount += 1
+            self.logger.debug("Upstream servers of %s updated in place, %d restarts avoided." % (self.name, self.restartAvoidedCount))
+        else:
+            self.pushSkippedCount += 1
+
+    def reload_hosts(self, fileList=None):
+        # dnsmasq watches "hostsdir" by inotify and reads only the changed files, nothing to do then.
+        # otherwise it re-reads all the "addn-hosts" on SIGHUP, fileList is not used, it also clears its cache
+        assert self.proc is not None
+        if any([x.startswith("hostsdir=") for x in self.baseCfg.split("\n")]):
+            return
+        try:
+            with open(self.pidFile) as f:
+                pid = int(f.read())
+        except (OSError, ValueError):
+            return                  # not ready yet, hosts files would be read when it starts
+        os.kill(pid, signal.SIGHUP)
+        self.hostsReloadCount += 1
+
+    def get_statistics(self):
+        return {
+            "restart": self.restartCount,
+            "restart-avoided": self.restartAvoidedCount,
+            "push-skipped": self.pushSkippedCount,
+            "hosts-reload": self.hostsReloadCount,
+            "domain-rule": self.domainIndex.get_statistics() if self.domainIndex is not None else None,
+        }
+
+    def _runDnsmasq(self):
+        with open(self.cfgFile, "w") as f:
+            f.write(self.baseCfg)
+
+        cmd = "/usr/sbin/dnsmasq"
+        cmd += " --keep-in-foreground"
+        cmd += " --port=%d" % (self.port)
+        cmd += " --conf-file=\"%s\"" % (self.cfgFile)
+        cmd += " --pid-file=%s" % (self.pidFile)
+        cmd += " --enable-dbus=%s" % (self.dbusName)
+        self.proc = subprocess.Popen(cmd, shell=True, universal_newlines=True)
+
+        # upstream servers are pushed in self._onNameOwnerChanged() when dnsmasq appears on D-Bus
+
+    def _reservePortAgain(self):
+        try:
+            self.param.portAllocator.reserve(self.name, self.port)
+        except Exception:
+            oldPort = self.port
+            self.port = self.param.portAllocator.reserve(self.name)
+            self.logger.warning("Port %d of %s is taken by others, use port %d." % (oldPort, self.name, self.port))
+
+    def _stopDnsmasq(self):
+        if self.proc is not None:
+            self.proc.terminate()
+            self.proc.wait()
+            self.proc = None
+        self.dbusOwner = None
+        self.param.portAllocator.release(self.name)
+        ByxUtil.forceDelete(self.pidFile)
+        ByxUtil.forceDelete(self.cfgFile)
+
+    def _pushServerList(self):
+        if self.dbusOwner is None:
+            return                  # would be pushed when dnsmasq appears on D-Bus
+        obj = dbus.SystemBus().get_object(self.dbusName, self.DBUS_PATH)
+        obj.SetDomainServers(dbus.Array(self.domainIndex.iter_server_list(), signature="s"),
+                             dbus_interface=self.dbusName,
+                             reply_handler=lambda: None,
+                             error_handler=self._onPushError)
+
+    def _onNameOwnerChanged(self, owner):
+        if owner != "":
+            self.dbusOwner = owner
+            self.param.portAllocator.release(self.name)         # dnsmasq has bound its sockets
+            self._pushServerList()
+        else:
+            self.dbusOwner = None
+
+    def _onPushError(self, e):
+        self.logger.error("Failed to set upstream servers of %s, restart it (%s)." % (self.name, e))
+        try:
+            if self.proc is not None:
+                self._stopDnsmasq()
+                self._reservePortAgain()
+                self._runDnsmasq()
+                self.restartCount += 1
+        except Exception:
+            self.logger.error("Error occured in push error callback", exc_info=True)
@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import hashlib
+
+
+class ByxDomainIndex:
+
+    # compiled domain rules of a level 2 nameserver:
+    #   1. a rule is dropped if the rule of its nearest parent domain has the same nameservers,
+    #      they resolve the same way with or without it
+    #   2. rules are emitted in dnsmasq server format by generator, no big buffer is built
+    #   3. the fingerprint of the compacted rules tells whether the effective mapping changed,
+    #      so that pushing an unchanged config can be skipped entirely
+    #   4. the index is kept by its owner and updated by update() with the changed domains only,
+    #      only these domains and their sub-domains are compacted again, the fingerprint is a xor of
+    #      rule hashes so it is updated by rule, and the changed rules are returned by pop_changes()
+
+    def __init__(self, defaultServerList, domainDict):
+        # defaultServerList is list<"server#port">, domainDict is dict<domain, list<"server#port">>
+
+        self.defaultServerList = []
+        self.domainDict = dict()                    # dict<domain, tuple<"server#port">>, not compacted
+        self.subDomainDict = dict()                 # dict<domain, set<domain>>, sub-domains in self.domainDict of every parent domain
+        self.ruleDict = dict()                      # dict<domain, tuple<"server#port">>, compacted
+        self.ruleHash = 0                           # xor of the hashes of all the rules
+        self.changeDict = dict()                    # dict<domain, tuple<"server#port">>, value is None if rule is removed
+        self.beforeCount = 0
+        self.fingerprint = None
+
+        self.set_default_server_list(defaultServerList)
+        self.update(domainDict)
+        self.changeDict = dict()
+
+    def get_default_server_list(self):
+        return self.defaultServerList
+
+    def set_default_server_list(self, defaultServerList):
+        if list(defaultServerList) != self.defaultServerList:
+            self.defaultServerList = list(defaultServerList)
+            self.fingerprint = None
+
+    def update(self, domainDict):
+        # domainDict is dict<domain, list<"server#port">>, value is None if domain is removed
+
+        checkSet = set()
+        for domain, serverList in domainDict.items():
+            domain = domain.strip(".").lower()
+            oldTuple = self.domainDict.get(domain)
+            newTuple = tuple(serverList) if serverList is not None else None
+            if newTuple == oldTuple:
+                continue
+
+            if oldTuple is not None:
+                self.beforeCount -= len(oldTuple)
+            if newTuple is not None:
+                self.beforeCount += len(newTuple)
+                self.domainDict[domain] = newTuple
+                if oldTuple is None:
+                    for parent in _Helper.parentDomains(domain):
+                        self.subDomainDict.setdefault(parent, set()).add(domain)
+            else:
+                del self.domainDict[domain]
+                for parent in _Helper.parentDomains(domain):
+                    subSet = self.subDomainDict[parent]
+                    subSet.remove(domain)
+                    if len(subSet) == 0:
+                        del self.subDomainDict[parent]
+
+            checkSet.add(domain)
+            checkSet |= self.subDomainDict.get(domain, set())
+
+        for domain in checkSet:
+            self._updateRule(domain)
+
+    def pop_changes(self):
+        """Returns dict<domain, tuple<"server#port">> of the rules changed since last call, value is None if rule is removed"""
+
+        ret = self.changeDict
+        self.changeDict = dict()
+        return ret
+
+    def get_rules(self):
+        """Returns dict<domain, tuple<"server#port">>"""
+        return self.ruleDict
+
+    def iter_server_list(self):
+        for server in self.defaultServerList:
+            yield server
+        for domain, serverTuple in self.ruleDict.items():
+            for server in serverTuple:
+                yield "/%s/%s" % (domain, server)
+
+    def get_fingerprint(self):
+        if self.fingerprint is None:
+            h = hashlib.sha1()
+            for server in self.defaultServerList:
+                h.update(server.encode("utf-8"))
+                h.update(b"\n")
+            h.update(b"\n")
+            h.update(("%040x" % (self.ruleHash)).encode("utf-8"))
+            self.fingerprint = h.hexdigest()
+        return self.fingerprint
+
+    def get_statistics(self):
+        return {
+            "before": self.beforeCount,
+            "after": sum([len(x) for x in self.ruleDict.values()]),
+        }
+
+    def _updateRule(self, domain):
+        serverTuple = self.domainDict.get(domain)
+        if serverTuple is not None:
+            for parent in _Helper.parentDomains(domain):
+                if parent in self.domainDict:
+                    if self.domainDict[parent] == serverTuple:
+                        serverTuple = None
+                    break
+
+        oldTuple = self.ruleDict.get(domain)
+        if serverTuple == oldTuple:
+            return
+        if oldTuple is not None:
+            self.ruleHash ^= _Helper.ruleHash(domain, oldTuple)
+            del self.ruleDict[domain]
+        if serverTuple is not None:
+            self.ruleHash ^= _Helper.ruleHash(domain, serverTuple)
+            self.ruleDict[domain] = serverTuple
+        self.changeDict[domain] = serverTuple
+        self.fingerprint = None
+
+
+class _Helper:
+
+    @staticmethod
+    def parentDomains(domain):
+        # parent domains from the nearest one
+        while "." in domain:
+            domain = domain.split(".", 1)[1]
+            yield domain
+
+    @staticmethod
+    def ruleHash(domain, serverTuple):
+        data = "/%s/%s\n" % (domain, "/".join(serverTuple))
+        return int.from_bytes(hashlib.sha1(data.encode("utf-8")).digest(), "big")
@@ -0,0 +1,258 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import time
+import logging
+import subprocess
+from byx_util import ByxUtil
+
+
+class ByxDomainRoute:
+
+    # domain based gateway selection:
+    #   1. every route target (nexthop, interface) gets a slot, a slot is a fwmark, a routing table with
+    #      only one default route to the target, an "ip rule fwmark -> table", and an nftables set of
+    #      destination addresses whose packets are marked
+    #   2. addresses in DNS answers of the domains bound to a target are added into the set of that
+    #      target, with the DNS TTL as timeout, so the sets only contain the destinations in use and
+    #      prune themselves
+    #
+    # answers are reported by ByxDnsForwarder, the addresses are queued, and ByxDnsForwarder calls flush()
+    # once per main loop iteration before it sends the answers held meanwhile, so all the addresses of an
+    # iteration are added in one nftables transaction, and the first packet to a new address is already
+    # routed by its slot, a connection starting on the main table route would break when it moves to
+    # another gateway.
+    # dnsmasq adds the addresses by itself through "nftset=",
+    # they expire by the default timeout of the set instead of the DNS TTL.
+    # only IPv4 addresses are used, the same as the other route tables.
+
+    MARK_BASE = 0x2000                  # fwmark and routing table id of the first slot
+    MAX_SLOT = 256
+    RULE_PRIORITY = 9000                # before the rules of ByxFwmarkRouteTable
+    MIN_TIMEOUT = 60                    # seconds, short TTL is raised to it, so that connections are not broken soon
+    DEFAULT_TIMEOUT = 3600              # seconds, for addresses added by dnsmasq
+    NFT_FAMILY = "ip"
+    NFT_TABLE = "bombyx_domain"
+
+    def __init__(self, param):
+        self.param = param
+        self.logger = logging.getLogger(self.__module__ + "." + self.__class__.__name__)
+
+        self.domainDict = dict()                # dict<domain, target>
+        self.slotDict = dict()                  # dict<target, slot>
+        self.slotRetrySet = set()               # set<slot>, slots whose default route failed to be installed
+        self.elemDict = dict()                  # dict<slot, dict<address, (domain, expire-time)>>, addresses in the set of slot
+        self.pendingElemDict = dict()           # dict<(slot, address), (domain, timeout, bReplace, bNew)>, added in flush()
+
+        self.learnCount = 0
+        self.refreshCount = 0
+        self.flushCount = 0
+
+        buf = ""
+        buf += "table %s %s\n" % (self.NFT_FAMILY, self.NFT_TABLE)           # make sure the table exists before deleting it
+        buf += "delete table %s %s\n" % (self.NFT_FAMILY, self.NFT_TABLE)
+        buf += "table %s %s {\n" % (self.NFT_FAMILY, self.NFT_TABLE)
+        buf += "    chain prerouting {\n"
+        buf += "        type filter hook prerouting priority -160; policy accept;\n"       # before ByxFwmarkRouteTable
+        buf += "    }\n"
+        buf += "    chain output {\n"
+        buf += "        type route hook output priority -160; policy accept;\n"
+        buf += "    }\n"
+        buf += "}\n"
+        ByxUtil.nftablesApply(buf)
+
+        self.param.netlink.add_event_callback(self._onNetlinkEvent)
+
+    def dispose(self):
+        self.param.netlink.remove_event_callback(self._onNetlinkEvent)
+
+        for slot in self.slotDict.values():
+            self.__removeSlotRoute(slot)
+        self.slotDict = dict()
+        self.elemDict = dict()
+        self.pendingElemDict = dict()
+        ByxUtil.nftablesApply("delete table %s %s\n" % (self.NFT_FAMILY, self.NFT_TABLE))
+
+    def set_domain_dict(self, domainDict):
+        """domainDict is dict<domain, target>"""
+
+        self.flush()                            # queued addresses belong to the old slots
+
+        self.domainDict = {k.strip(".").lower(): tuple(v) for k, v in domainDict.items()}
+        targetSet = set(self.domainDict.values())
+        now = time.monotonic()
+        buf = ""
+
+        # release slots of the targets which are not used any more
+        freeSlotList = []
+        for target in list(self.slotDict.keys()):
+            if target not in targetSet:
+                freeSlotList.append(self.slotDict.pop(target))
+
+        # allocate slots for new targets
+        for target in targetSet:
+            if target not in self.slotDict:
+                slot = self.__newSlot(target)
+                self.slotDict[target] = slot
+                self.elemDict[slot] = dict()
+                buf += "add set %s %s %s { type ipv4_addr; flags timeout; timeout %ds; }\n" % (self.NFT_FAMILY, self.NFT_TABLE, self.__setName(slot), self.DEFAULT_TIMEOUT)
+
+        # remove addresses of domains which are bound to another target now
+        for target, slot in self.slotDict.items():
+            for address, (domain, expireTime) in list(self.elemDict[slot].items()):
+                if self.domainDict.get(domain) == target:
+                    continue
+                del self.elemDict[slot][address]
+                if expireTime > now + 2:                    # not removed by kernel yet
+                    buf += "delete element %s %s %s { %s }\n" % (self.NFT_FAMILY, self.NFT_TABLE, self.__setName(slot), address)
+
+        # regenerate rules, delete sets of the released slots
+        buf += "flush chain %s %s prerouting\n" % (self.NFT_FAMILY, self.NFT_TABLE)
+        buf += "flush chain %s %s output\n" % (self.NFT_FAMILY, self.NFT_TABLE)
+        for slot in sorted(self.slotDict.values()):
+            for chain in ["prerouting", "output"]:
+                buf += "add rule %s %s %s meta mark 0 ip daddr @%s meta mark set 0x%x\n" % (self.NFT_FAMILY, self.NFT_TABLE, chain, self.__setName(slot), self.__slotToMark(slot))
+        for slot in freeSlotList:
+            buf += "delete set %s %s %s\n" % (self.NFT_FAMILY, self.NFT_TABLE, self.__setName(slot))
+            del self.elemDict[slot]
+        ByxUtil.nftablesApply(buf)
+
+        for slot in freeSlotList:
+            self.__removeSlotRoute(slot)
+
+    def get_dnsmasq_cfg(self):
+        # let dnsmasq add the resolved addresses into the sets by itself
+        buf = ""
+        for domain, target in sorted(self.domainDict.items()):
+            buf += "nftset=/%s/4#%s#%s#%s\n" % (domain, self.NFT_FAMILY, self.NFT_TABLE, self.__setName(self.slotDict[target]))
+        return buf
+
+    def on_dns_answer(self, qname, addrList):
+        # called by ByxDnsForwarder, addrList is list<(rtype, address, ttl)>, returns True if addresses are queued
+        domain = self.__matchDomain(qname)
+        if domain is None:
+            return False
+        slot = self.slotDict[self.domainDict[domain]]
+
+        now = time.monotonic()
+        bQueued = False
+        for rtype, address, ttl in addrList:
+            if rtype != 1:
+                continue
+            timeout = max(ttl, self.MIN_TIMEOUT)
+            old = self.elemDict[slot].get(address)
+            if old is not None and old[1] >= now + timeout / 2:
+                continue                                    # still valid for long enough, no kernel operation
+            bReplace = (old is not None and old[1] > now + 2)   # the timeout of an existing element can only be changed by replacing it
+            self.pendingElemDict[(slot, address)] = (domain, timeout, bReplace, old is None)
+            bQueued = True
+        return bQueued
+
+    def flush(self):
+        # add the queued addresses in one nftables transaction
+        if len(self.pendingElemDict) == 0:
+            return
+        elemDict = self.pendingElemDict
+        self.pendingElemDict = dict()
+
+        now = time.monotonic()
+        buf = ""
+        for (slot, address), (domain, timeout, bReplace, bNew) in elemDict.items():
+            if bReplace:
+                buf += "delete element %s %s %s { %s }\n" % (self.NFT_FAMILY, self.NFT_TABLE, self.__setName(slot), address)
+            buf += "add element %s %s %s { %s timeout %ds }\n" % (self.NFT_FAMILY, self.NFT_TABLE, self.__setName(slot), address, timeout)
+        try:
+            ByxUtil.nftablesApply(buf)
+        except subprocess.CalledProcessError:
+            # element may be removed by kernel just now, adding an existing element is not an error
+            buf = ""
+            for (slot, address), (domain, timeout, bReplace, bNew) in elemDict.items():
+                buf += "add element %s %s %s { %s timeout %ds }\n" % (self.NFT_FAMILY, self.NFT_TABLE, self.__setName(slot), address, timeout)
+            ByxUtil.nftablesApply(buf)
+        self.flushCount += 1
+
+        # the mirror is updated only after the kernel has the addresses
+        for (slot, address), (domain, timeout, bReplace, bNew) in elemDict.items():
+            self.elemDict[slot][address] = (domain, now + timeout)
+            if bNew:
+                self.learnCount += 1
+            else:
+                self.refreshCount += 1
+
+    def get_statistics(self):
+        return {
+            "domain": len(self.domainDict),
+            "slot": len(self.slotDict),
+            "address": sum([len(x) for x in self.elemDict.values()]),
+            "pending": len(self.slotRetrySet),
+            "learn": self.learnCount,
+            "refresh": self.refreshCount,
+            "flush": self.flushCount,
+        }
+
+    def _onNetlinkEvent(self, msg):
+        if msg["event"] in ["RTM_NEWLINK", "RTM_NEWADDR"]:
+            # interface or address appears, default routes of slots may be installable now
+            for target, slot in self.slotDict.items():
+                if slot in self.slotRetrySet:
+                    self.__setSlotRoute(slot, target)
+        elif msg["event"] == "RTM_DELROUTE":
+            table = msg.get_attr("RTA_TABLE")
+            if table is None:
+                table = msg["table"]
+            for target, slot in self.slotDict.items():
+                if self.__slotToMark(slot) == table:
+                    self.__setSlotRoute(slot, target)          # deleted by others or with its interface, re-install it
+
+    def __matchDomain(self, qname):
+        # longest matching domain suffix
+        name = qname.lower()
+        while True:
+            if name in self.domainDict:
+                return name
+            if "." not in name:
+                return None
+            name = name.split(".", 1)[1]
+
+    def __newSlot(self, target):
+        usedSlotSet = set(self.slotDict.values()) | set(self.elemDict.keys())
+        slot = 0
+        while slot in usedSlotSet:
+            slot += 1
+        if slot >= self.MAX_SLOT:
+            raise Exception("too many route targets")
+
+        mark = self.__slotToMark(slot)
+        err = self.param.netlink.rule_add(mark, mark, self.RULE_PRIORITY)
+        if err not in [0, 17]:                  # message: File exists
+            raise Exception("failed to add rule for fwmark 0x%x, error %d" % (mark, err))
+        self.__setSlotRoute(slot, target)
+        return slot
+
+    def __removeSlotRoute(self, slot):
+        mark = self.__slotToMark(slot)
+        self.param.netlink.rule_del(mark, mark, self.RULE_PRIORITY)
+        self.param.netlink.route_batch([("del", "0.0.0.0/0", None, None)], table=mark)
+        self.slotRetrySet.discard(slot)
+
+    def __setSlotRoute(self, slot, target):
+        nexthop, interface = target
+        idx = None
+        if interface is not None:
+            idx = self.param.netlink.get_ifindex(interface)
+            if idx is None:
+                self.slotRetrySet.add(slot)
+                return
+        err = self.param.netlink.route_batch([("replace", "0.0.0.0/0", nexthop, idx)], table=self.__slotToMark(slot))[0]
+        if err == 0:
+            self.slotRetrySet.discard(slot)
+        else:
+            if err != 101:                      # message: Network is unreachable
+                self.logger.error("Failed to set route for %s, error %d." % (str(target), err))
+            self.slotRetrySet.add(slot)
+
+    def __setName(self, slot):
+        return "byx_dip_%d" % (slot)
+
+    def __slotToMark(self, slot):
+        return self.MARK_BASE + slot
@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import iptc
+import logging
+from byx_util import ByxUtil
+
+
+class _FirewallBase:
+
+    # gateway interfaces are reference counted, a gateway interface can be used by several
+    # tfac groups or ntfac entities, its rules exist as long as one of them uses it
+
+    def __init__(self, param):
+        self.param = param
+        self.logger = logging.getLogger(self.__module__ + "." + self.__class__.__name__)
+        self.gatewayDict = dict()           # dict<interface, reference-count>
+
+    def _refGateways(self, gatewaySet):
+        # returns the gateways which are newly added
+        ret = set()
+        for gateway in gatewaySet:
+            if gateway not in self.gatewayDict:
+                self.gatewayDict[gateway] = 0
+                ret.add(gateway)
+            self.gatewayDict[gateway] += 1
+        return ret
+
+    def _unrefGateways(self, gatewaySet):
+        # returns the gateways which are not used any more
+        ret = set()
+        for gateway in gatewaySet:
+            self.gatewayDict[gateway] -= 1
+            if self.gatewayDict[gateway] == 0:
+                del self.gatewayDict[gateway]
+                ret.add(gateway)
+        return ret
+
+
+class ByxIptablesFirewall(_FirewallBase):
+
+    # gateway firewall rules as python-iptables rules, 4 rules for every gateway interface
+
+    def dispose(self):
+        # rules of a gateway exist only once whatever its reference count is
+        self._deleteRules(set(self.gatewayDict.keys()))
+        self.gatewayDict = dict()
+
+    def add_gateways(self, gatewaySet):
+        gatewaySet = self._refGateways(gatewaySet)
+        if len(gatewaySet) == 0:
+            return
+
+        filterTable = iptc.Table(iptc.Table.FILTER)
+        natTable = iptc.Table(iptc.Table.NAT)
+        filterTable.autocommit = False
+        natTable.autocommit = False
+        try:
+            for gateway in gatewaySet:
+                for rule in self.__generateGatewayFwRulesFilterInputChain(gateway):
+                    iptc.Chain(filterTable, "INPUT").append_rule(rule)
+                for rule in self.__generateGatewayFwRulesNatPostChain(gateway):
+                    iptc.Chain(natTable, "POSTROUTING").append_rule(rule)
+            filterTable.commit()
+            natTable.commit()
+        finally:
+            filterTable.autocommit = True
+            natTable.autocommit = True
+
+    def remove_gateways(self, gatewaySet):
+        self._deleteRules(self._unrefGateways(gatewaySet))
+
+    def _deleteRules(self, gatewaySet):
+        if len(gatewaySet) == 0:
+            return
+
+        filterTable = iptc.Table(iptc.Table.FILTER)
+        natTable = iptc.Table(iptc.Table.NAT)
+        filterTable.autocommit = False
+        natTable.autocommit = False
+        try:
+            for gateway in gatewaySet:
+                for rule in self.__generateGatewayFwRulesFilterInputChain(gateway):
+                    iptc.Chain(filterTable, "INPUT").delete_rule(rule)
+                for rule in self.__generateGatewayFwRulesNatPostChain(gateway):
+                    iptc.Chain(natTable, "POSTROUTING").delete_rule(rule)
+            filterTable.commit()
+            natTable.commit()
+        finally:
+            filterTable.autocommit = True
+            natTable.autocommit = True
+
+    def __generateGatewayFwRulesFilterInputChain(self, gateway):
+        ret = []
+
+        rule = iptc.Rule()
+        rule.in_interface = gateway
+        rule.protocol = "icmp"
+        rule.create_target("ACCEPT")
+        ret.append(rule)
+
+        rule = iptc.Rule()
+        rule.in_interface = gateway
+        match = iptc.Match(rule, "state")
+        match.state = "ESTABLISHED,RELATED"
+        rule.add_match(match)
+        rule.create_target("ACCEPT")
+        ret.append(rule)
+
+        rule = iptc.Rule()
+        rule.in_interface = gateway
+        rule.create_target("DROP")
+        ret.append(rule)
+
+        return ret
+
+    def __generateGatewayFwRulesNatPostChain(self, gateway):
+        rule = iptc.Rule()
+        rule.out_interface = gateway
+        rule.create_target("MASQUERADE")
+        return [rule]
+
+
+class ByxNftablesFirewall(_FirewallBase):
+
+    # gateway firewall rules in a nftables table, gateway interfaces are kept in a named set,
+    # so the rules are constant and adding or removing a gateway is one set element update
+    # in one nftables transaction.
+
+    TABLE = "ip bombyx"
+
+    def __init__(self, param):
+        super().__init__(param)
+
+        buf = ""
+        buf += "table %s\n" % (self.TABLE)                     # make sure the table exists before deleting it
+        buf += "delete table %s\n" % (self.TABLE)
+        buf += "table %s {\n" % (self.TABLE)
+        buf += "    set byx_gw {\n"
+        buf += "        type ifname\n"
+        buf += "    }\n"
+        buf += "    chain input {\n"
+        buf += "        type filter hook input priority 0; policy accept;\n"
+        buf += "        iifname @byx_gw ip protocol icmp accept\n"
+        buf += "        iifname @byx_gw ct state established,related accept\n"
+        buf += "        iifname @byx_gw drop\n"
+        buf += "    }\n"
+        buf += "    chain postrouting {\n"
+        buf += "        type nat hook postrouting priority 100; policy accept;\n"
+        buf += "        oifname @byx_gw masquerade\n"
+        buf += "    }\n"
+        buf += "}\n"
+        ByxUtil.nftablesApply(buf)
+
+    def dispose(self):
+        ByxUtil.nftablesApply("delete table %s\n" % (self.TABLE))
+        self.gatewayDict = dict()
+
+    def add_gateways(self, gatewaySet):
+        gatewaySet = self._refGateways(gatewaySet)
+        if len(gatewaySet) > 0:
+            ByxUtil.nftablesApply("add element %s byx_gw { %s }\n" % (self.TABLE, ", ".join(["\"%s\"" % (x) for x in sorted(gatewaySet)])))
+
+    def remove_gateways(self, gatewaySet):
+        gatewaySet = self._unrefGateways(gatewaySet)
+        if len(gatewaySet) > 0:
+            ByxUtil.nftablesApply("delete element %s byx_gw { %s }\n" % (self.TABLE, ", ".join(["\"%s\"" % (x) for x in sorted(gatewaySet)])))
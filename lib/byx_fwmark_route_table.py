@@ -0,0 +1,419 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import socket
+import struct
+import bisect
+import logging
+from gi.repository import GLib
+from byx_util import ByxUtil
+
+
+class ByxFwmarkRouteTable:
+
+    # policy routing alternative of ByxRouteTable, for very large destination lists:
+    #   1. every route target (nexthop, interface) gets a slot, a slot is a fwmark, a routing table
+    #      with only one default route to the target, and an "ip rule fwmark -> table"
+    #   2. destination prefixes are put into one nftables interval map <address-range, fwmark>,
+    #      which marks the packets in prerouting and output
+    #
+    # nested prefixes are flattened into non-overlapping ranges, so the most specific prefix wins,
+    # the same as kernel route lookup. only the ranges covered by the changed prefixes (and the
+    # ranges overlapping or adjacent to them) are recomputed, unless a large part of the prefixes
+    # changed. the map is updated by the difference of ranges in one nft transaction, a target
+    # which takes over all the prefixes of a disappearing target takes over its slot, so moving a
+    # whole group to another gateway only replaces one default route.
+    #
+    # slots freed in a refresh are not reused in the same refresh, they are removed only after
+    # the map no longer marks packets with them. if the map fails to be updated, they are kept
+    # aside and removed by the next refresh which updates the map.
+    #
+    # it has the same interface as ByxRouteTable.
+
+    MARK_BASE = 0x1000                  # fwmark and routing table id of the first slot
+    MAX_SLOT = 256                      # slots of one instance
+    RULE_PRIORITY = 10000               # before the main table rule (32766)
+    FULL_FLATTEN_RATIO = 8              # flatten all the prefixes when more than 1/8 of them changed
+
+    usedInstanceIdSet = set()
+
+    def __init__(self, param, routeFullDict):
+        self.param = param
+        self.logger = logging.getLogger(self.__module__ + "." + self.__class__.__name__)
+
+        self.routeFullDict = routeFullDict      # covered and adjacent prefixes are merged by flattening, no need for ByxRouteAggregator
+        self.prefixDict = dict()                # dict<prefix, target>, mirror of the winning routes
+        self.targetPrefixDict = dict()          # dict<target, set<prefix>>
+        self.netDict = dict()                   # dict<(start, prefix-length), set<prefix>>, prefixes as integers
+        self.netStartList = []                  # list<(start, prefix-length)>, sorted keys of self.netDict
+        self.slotDict = dict()                  # dict<target, slot>
+        self.slotRetrySet = set()               # set<slot>, slots whose default route failed to be installed
+        self.staleSlotSet = set()               # set<slot>, slots of gone targets, the map may still mark packets with them
+        self.rangeDict = dict()                 # dict<start, (end, fwmark)>, elements of the nftables map
+        self.rangeStartList = []                # list<start>, sorted keys of self.rangeDict
+        self.bFullFlatten = False               # the map failed to be updated, do a full flatten in next refresh
+
+        self.setUpdateCount = 0
+        self.slotReuseCount = 0
+        self.fullFlattenCount = 0
+
+        self.instanceId = 0
+        while self.instanceId in self.usedInstanceIdSet:
+            self.instanceId += 1
+        self.usedInstanceIdSet.add(self.instanceId)
+        self.nftTable = "ip bombyx_route%d" % (self.instanceId)
+
+        buf = ""
+        buf += "table %s\n" % (self.nftTable)                     # make sure the table exists before deleting it
+        buf += "delete table %s\n" % (self.nftTable)
+        buf += "table %s {\n" % (self.nftTable)
+        buf += "    map byx_dst {\n"
+        buf += "        type ipv4_addr : mark\n"
+        buf += "        flags interval\n"
+        buf += "    }\n"
+        buf += "    chain prerouting {\n"
+        buf += "        type filter hook prerouting priority -150; policy accept;\n"
+        buf += "        meta mark 0 meta mark set ip daddr map @byx_dst\n"
+        buf += "    }\n"
+        buf += "    chain output {\n"
+        buf += "        type route hook output priority -150; policy accept;\n"
+        buf += "        meta mark 0 meta mark set ip daddr map @byx_dst\n"
+        buf += "    }\n"
+        buf += "}\n"
+        try:
+            ByxUtil.nftablesApply(buf)
+        except BaseException:
+            self.usedInstanceIdSet.remove(self.instanceId)
+            raise
+
+        self.refreshIdle = None
+        self.param.netlink.add_event_callback(self._onNetlinkEvent)
+
+    def dispose(self):
+        if self.refreshIdle is not None:
+            GLib.source_remove(self.refreshIdle)
+            self.refreshIdle = None
+        self.param.netlink.remove_event_callback(self._onNetlinkEvent)
+
+        for target, slot in self.slotDict.items():
+            self.__removeSlot(slot)
+        self.slotDict = dict()
+        for slot in self.staleSlotSet:
+            self.__removeSlot(slot)
+        self.staleSlotSet = set()
+        ByxUtil.nftablesApply("delete table %s\n" % (self.nftTable))
+        self.usedInstanceIdSet.remove(self.instanceId)
+
+    def schedule_refresh(self):
+        if self.refreshIdle is None:
+            self.refreshIdle = GLib.idle_add(self._refreshIdleCallback)
+
+    def refresh(self):
+        changeDict = self.routeFullDict.pop_changes()
+
+        # update mirror, record the prefix set of the targets which disappear
+        goneDict = dict()                               # dict<target, set<prefix>>
+        netChangeSet = set()                            # set<(start, prefix-length)>
+        for prefix, target in changeDict.items():
+            if target is not None:
+                target = tuple(target)                  # target may be a json list
+            net = _Helper.prefixToNet(prefix)
+            netChangeSet.add(net)
+            oldTarget = self.prefixDict.get(prefix)
+            if oldTarget is not None:
+                if oldTarget not in goneDict:
+                    goneDict[oldTarget] = set(self.targetPrefixDict[oldTarget])
+                self.targetPrefixDict[oldTarget].remove(prefix)
+                if len(self.targetPrefixDict[oldTarget]) == 0:
+                    del self.targetPrefixDict[oldTarget]
+                del self.prefixDict[prefix]
+                self.netDict[net].remove(prefix)
+                if len(self.netDict[net]) == 0:
+                    del self.netDict[net]
+            if target is not None:
+                self.prefixDict[prefix] = target
+                self.targetPrefixDict.setdefault(target, set()).add(prefix)
+                self.netDict.setdefault(net, set()).add(prefix)
+        goneDict = {k: v for k, v in goneDict.items() if k not in self.targetPrefixDict}
+
+        bFull = self.bFullFlatten or (len(netChangeSet) * self.FULL_FLATTEN_RATIO > len(self.netDict))
+        if bFull:
+            self.netStartList = sorted(self.netDict.keys())
+        else:
+            for net in netChangeSet:
+                i = bisect.bisect_left(self.netStartList, net)
+                bExist = (i < len(self.netStartList) and self.netStartList[i] == net)
+                if net in self.netDict and not bExist:
+                    self.netStartList.insert(i, net)
+                elif net not in self.netDict and bExist:
+                    del self.netStartList[i]
+
+        # assign slots, a new target takes over the slot of a gone target with the same prefix set
+        goneSlotDict = dict()                           # dict<target, slot>
+        for target in goneDict:
+            goneSlotDict[target] = self.slotDict.pop(target)
+        for target, prefixSet in self.targetPrefixDict.items():
+            if target in self.slotDict:
+                continue
+            for oldTarget, slot in goneSlotDict.items():
+                if goneDict[oldTarget] == prefixSet:
+                    del goneSlotDict[oldTarget]
+                    self.slotDict[target] = slot
+                    self.slotReuseCount += 1
+                    self.__setSlotRoute(slot, target)
+                    break
+        freeSlotList = list(goneSlotDict.values()) + sorted(self.staleSlotSet)
+        self.staleSlotSet = set(freeSlotList)           # until they are removed, this refresh may fail
+        for target in self.targetPrefixDict:
+            if target not in self.slotDict:
+                self.slotDict[target] = self.__newSlot(target, freeSlotList)
+
+        # update the nftables map by the difference of ranges, in one transaction
+        if bFull:
+            newRangeDict = {x[0]: (x[1], x[2]) for x in _Helper.flatten([self.__netItem(x) for x in self.netStartList])}
+            removedDict = {k: v for k, v in self.rangeDict.items() if newRangeDict.get(k) != v}
+            addedDict = {k: v for k, v in newRangeDict.items() if self.rangeDict.get(k) != v}
+            self.rangeDict = newRangeDict
+            self.rangeStartList = sorted(newRangeDict.keys())
+            self.bFullFlatten = False
+            self.fullFlattenCount += 1
+        else:
+            removedDict = dict()                        # dict<start, (end, fwmark)>, ranges deleted from the map
+            addedDict = dict()                          # dict<start, (end, fwmark)>, ranges added to the map
+            for start, end in _Helper.mergeSpans([_Helper.netSpan(x) for x in netChangeSet]):
+                self.__flattenSpan(start, end, removedDict, addedDict)
+        if len(removedDict) > 0 or len(addedDict) > 0:
+            delList = [(k, v[0]) for k, v in removedDict.items()]
+            addList = [(k, v[0], v[1]) for k, v in addedDict.items()]
+            buf = ""
+            for i in range(0, len(delList), 4096):
+                buf += "delete element %s byx_dst { %s }\n" % (self.nftTable, ", ".join([_Helper.rangeToStr(x) for x in delList[i:i + 4096]]))
+            for i in range(0, len(addList), 4096):
+                buf += "add element %s byx_dst { %s }\n" % (self.nftTable, ", ".join(["%s : 0x%x" % (_Helper.rangeToStr(x[:2]), x[2]) for x in addList[i:i + 4096]]))
+            try:
+                ByxUtil.nftablesApply(buf)
+            except BaseException:
+                # the map is unchanged, roll back the mirror, the changes are recomputed in next refresh
+                for k in addedDict:
+                    del self.rangeDict[k]
+                self.rangeDict.update(removedDict)
+                self.rangeStartList = sorted(self.rangeDict.keys())
+                self.bFullFlatten = True
+                raise
+            self.setUpdateCount += 1
+
+        # release slots not used any more, after no packet is marked with them
+        for slot in freeSlotList:
+            self.__removeSlot(slot)
+            self.staleSlotSet.remove(slot)
+
+        # retry slots whose route is not installed
+        for target, slot in self.slotDict.items():
+            if slot in self.slotRetrySet:
+                self.__setSlotRoute(slot, target)
+
+    def sweep(self):
+        self.refresh()
+
+    def get_statistics(self):
+        return {
+            "installed": len(self.prefixDict),
+            "pending": len(self.slotRetrySet),
+            "slot": len(self.slotDict),
+            "stale-slot": len(self.staleSlotSet),
+            "range": len(self.rangeDict),
+            "set-update": self.setUpdateCount,
+            "slot-reuse": self.slotReuseCount,
+            "full-flatten": self.fullFlattenCount,
+        }
+
+    def _refreshIdleCallback(self):
+        self.refreshIdle = None
+        try:
+            self.refresh()
+        except Exception:
+            self.logger.error("Error occured in route refresh idle callback", exc_info=True)
+        return False
+
+    def _onNetlinkEvent(self, msg):
+        if msg["event"] in ["RTM_NEWLINK", "RTM_NEWADDR"]:
+            # interface or address appears, default routes of slots may be installable now
+            if len(self.slotRetrySet) > 0:
+                self.schedule_refresh()
+        elif msg["event"] == "RTM_DELROUTE":
+            # default route of a slot is deleted by others or with its interface, re-install it
+            table = msg.get_attr("RTA_TABLE")
+            if table is None:
+                table = msg["table"]
+            if table in [self.__slotToMark(x) for x in self.slotDict.values()]:
+                self.slotRetrySet.add(table - self.__slotToMark(0))
+                self.schedule_refresh()
+
+    def __newSlot(self, target, freeSlotList):
+        # slots in freeSlotList still mark packets until the map is updated, so they can't be used
+        usedSlotSet = set(self.slotDict.values()) | set(freeSlotList)
+        slot = 0
+        while slot in usedSlotSet:
+            slot += 1
+        if slot >= self.MAX_SLOT:
+            raise Exception("too many route targets")
+
+        mark = self.__slotToMark(slot)
+        err = self.param.netlink.rule_add(mark, mark, self.RULE_PRIORITY)
+        if err not in [0, 17]:                  # message: File exists
+            raise Exception("failed to add rule for fwmark 0x%x, error %d" % (mark, err))
+        self.__setSlotRoute(slot, target)
+        return slot
+
+    def __removeSlot(self, slot):
+        mark = self.__slotToMark(slot)
+        self.param.netlink.rule_del(mark, mark, self.RULE_PRIORITY)
+        self.param.netlink.route_batch([("del", "0.0.0.0/0", None, None)], table=mark)
+        self.slotRetrySet.discard(slot)
+
+    def __setSlotRoute(self, slot, target):
+        nexthop, interface = target
+        idx = None
+        if interface is not None:
+            idx = self.param.netlink.get_ifindex(interface)
+            if idx is None:
+                self.slotRetrySet.add(slot)
+                return
+        err = self.param.netlink.route_batch([("replace", "0.0.0.0/0", nexthop, idx)], table=self.__slotToMark(slot))[0]
+        if err == 0:
+            self.slotRetrySet.discard(slot)
+        else:
+            if err != 101:                      # message: Network is unreachable
+                self.logger.error("Failed to set route for %s, error %d." % (str(target), err))
+            self.slotRetrySet.add(slot)
+
+    def __netItem(self, net):
+        # returns (start, prefix-length, end, fwmark), duplicate prefixes of a network are ordered by name
+        prefix = min(self.netDict[net])
+        return (net[0], net[1], _Helper.netSpan(net)[1], self.__slotToMark(self.slotDict[self.prefixDict[prefix]]))
+
+    def __flattenSpan(self, start, end, removedDict, addedDict):
+        # recompute the ranges in [start, end], the ranges overlapping or adjacent to it are recomputed
+        # as a whole, so that the result is the same as flattening all the prefixes
+        i = bisect.bisect_left(self.rangeStartList, start)
+        if i > 0 and self.rangeDict[self.rangeStartList[i - 1]][0] >= start - 1:
+            i -= 1
+        j = bisect.bisect_right(self.rangeStartList, end + 1)
+        oldList = self.rangeStartList[i:j]
+        if len(oldList) > 0:
+            start = min(start, oldList[0])
+            end = max(end, self.rangeDict[oldList[-1]][0])
+
+        # prefixes overlapping the span are the ones containing its start and the ones starting in it
+        itemList = []
+        for plen in range(0, 33):
+            net = (start & _Helper.lenToMask(plen), plen)
+            if net[0] < start and net in self.netDict:
+                itemList.append(self.__netItem(net))
+        k = bisect.bisect_left(self.netStartList, (start, -1))
+        while k < len(self.netStartList) and self.netStartList[k][0] <= end:
+            itemList.append(self.__netItem(self.netStartList[k]))
+            k += 1
+
+        newDict = dict()
+        for s, e, mark in _Helper.flatten(itemList):
+            s = max(s, start)
+            e = min(e, end)
+            if s <= e:
+                newDict[s] = (e, mark)
+
+        for s in oldList:
+            v = self.rangeDict[s]
+            if newDict.get(s) == v:
+                continue
+            del self.rangeDict[s]
+            if addedDict.get(s) == v:
+                del addedDict[s]                # added by a previous span of this refresh
+            else:
+                removedDict[s] = v
+        for s, v in newDict.items():
+            if self.rangeDict.get(s) == v:
+                continue
+            self.rangeDict[s] = v
+            if removedDict.get(s) == v:
+                del removedDict[s]
+            else:
+                addedDict[s] = v
+        self.rangeStartList[i:j] = sorted(newDict.keys())
+
+    def __slotToMark(self, slot):
+        # fwmark and routing table id
+        return self.MARK_BASE + self.instanceId * self.MAX_SLOT + slot
+
+
+class _Helper:
+
+    @staticmethod
+    def prefixToNet(prefix):
+        """1.2.3.0/255.255.255.0 -> (start, prefix-length)"""
+
+        tl = prefix.split("/")
+        plen = ByxUtil.ipMaskToLen(tl[1])
+        return (struct.unpack("!I", socket.inet_aton(tl[0]))[0] & _Helper.lenToMask(plen), plen)
+
+    @staticmethod
+    def lenToMask(plen):
+        return (0xFFFFFFFF << (32 - plen)) & 0xFFFFFFFF
+
+    @staticmethod
+    def netSpan(net):
+        return (net[0], net[0] + (1 << (32 - net[1])) - 1)
+
+    @staticmethod
+    def mergeSpans(spanList):
+        """merges overlapping (start, end) spans, returns them sorted"""
+
+        ret = []
+        for start, end in sorted(spanList):
+            if len(ret) > 0 and start <= ret[-1][1]:
+                ret[-1][1] = max(ret[-1][1], end)
+            else:
+                ret.append([start, end])
+        return ret
+
+    @staticmethod
+    def flatten(itemList):
+        """itemList is list<(start, prefix-length, end, value)>, returns list<[start, end, value]> sorted by start,
+           ranges are not overlapping, value of an address is the value of its most specific prefix"""
+
+        itemList = sorted(itemList)
+
+        retList = []
+        stack = []                                  # list<(end, value)>, the prefixes containing current position
+        cur = 0
+
+        def _emit(start, end, value):
+            if start > end:
+                return
+            if len(retList) > 0 and retList[-1][1] + 1 == start and retList[-1][2] == value:
+                retList[-1][1] = end                # merge adjacent ranges with the same value
+            else:
+                retList.append([start, end, value])
+
+        for start, plen, end, value in itemList:
+            while len(stack) > 0 and stack[-1][0] < start:
+                _emit(cur, stack[-1][0], stack[-1][1])
+                cur = stack[-1][0] + 1
+                stack.pop()
+            if len(stack) > 0:
+                _emit(cur, start - 1, stack[-1][1])
+            cur = start
+            stack.append((end, value))
+        while len(stack) > 0:
+            _emit(cur, stack[-1][0], stack[-1][1])
+            cur = stack[-1][0] + 1
+            stack.pop()
+
+        return retList
+
+    @staticmethod
+    def rangeToStr(r):
+        start = socket.inet_ntoa(struct.pack("!I", r[0]))
+        if r[0] == r[1]:
+            return start
+        return start + "-" + socket.inet_ntoa(struct.pack("!I", r[1]))
@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import socket
+import logging
+import threading
+import pyroute2
+from pyroute2.netlink import NLM_F_REQUEST
+from pyroute2.netlink import NLM_F_ACK
+from pyroute2.netlink import NLM_F_CREATE
+from pyroute2.netlink import NLM_F_EXCL
+from pyroute2.netlink import NLM_F_REPLACE
+from pyroute2.netlink import rtnl
+from pyroute2.netlink.rtnl.rtmsg import rtmsg
+from gi.repository import GLib
+
+
+class ByxNetlink:
+
+    # the netlink session shared by the whole daemon:
+    #   1. one long-lived rtnetlink socket for requests
+    #   2. one rtnetlink socket bound to link/address/route groups, watched by the GLib main loop
+    #   3. interface name -> index cache, invalidated by link events
+    #
+    # request methods can be called in other threads, events are dispatched in the main loop.
+
+    BATCH_SIZE = 512                    # number of requests sent before their acks are collected
+
+    def __init__(self, param):
+        self.param = param
+        self.logger = logging.getLogger(self.__module__ + "." + self.__class__.__name__)
+
+        self.ipr = None
+        self.iprLock = threading.Lock()
+        self.seq = 0
+
+        self.ifindexDict = dict()       # dict<ifname, ifindex>, ifindex is None if the interface does not exist
+        self.callbackList = []
+
+        self.monitor = None
+        self.monitorWatch = None
+
+        self.batchCount = 0
+        self.requestCount = 0
+        self.ifindexLookupCount = 0
+        self.ifindexHitCount = 0
+
+        try:
+            self.ipr = pyroute2.IPRoute()
+            self.monitor = pyroute2.IPRoute()
+            self.monitor.bind(groups=rtnl.RTMGRP_LINK | rtnl.RTMGRP_IPV4_IFADDR | rtnl.RTMGRP_IPV4_ROUTE)
+            self.monitorWatch = GLib.io_add_watch(self.monitor.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, self._monitorCallback)
+        except BaseException:
+            self.dispose()
+            raise
+
+    def dispose(self):
+        if self.monitorWatch is not None:
+            GLib.source_remove(self.monitorWatch)
+            self.monitorWatch = None
+        if self.monitor is not None:
+            self.monitor.close()
+            self.monitor = None
+        if self.ipr is not None:
+            self.ipr.close()
+            self.ipr = None
+
+    def add_event_callback(self, callback):
+        # callback(msg) is called for every RTM_NEWLINK, RTM_DELLINK, RTM_NEWADDR, RTM_DELADDR, RTM_NEWROUTE, RTM_DELROUTE message
+        self.callbackList.append(callback)
+
+    def remove_event_callback(self, callback):
+        self.callbackList.remove(callback)
+
+    def get_ifindex(self, ifname):
+        with self.iprLock:
+            self.ifindexLookupCount += 1
+            if ifname in self.ifindexDict:
+                self.ifindexHitCount += 1
+                return self.ifindexDict[ifname]
+            idx_list = self.ipr.link_lookup(ifname=ifname)
+            assert len(idx_list) <= 1
+            self.ifindexDict[ifname] = idx_list[0] if len(idx_list) > 0 else None
+            return self.ifindexDict[ifname]
+
+    def get_links(self):
+        with self.iprLock:
+            return self.ipr.get_links()
+
+    def get_routes(self, table=254):
+        with self.iprLock:
+            return self.ipr.get_routes(family=socket.AF_INET, table=table)
+
+    def route_batch(self, opList, table=254):
+        """opList is list<(operation, "dst/len", nexthop, oif)>, operation can be "add", "replace" or "del",
+           returns list<error-code>, error code is 0 if the operation succeeds"""
+
+        ret = []
+        with self.iprLock:
+            for i in range(0, len(opList), self.BATCH_SIZE):
+                seqList = []
+                for op, dst, nexthop, oif in opList[i:i + self.BATCH_SIZE]:
+                    seqList.append(self._putRouteRequest(table, op, dst, nexthop, oif))
+                for seq in seqList:
+                    ret.append(self._getAck(seq))
+                self.batchCount += 1
+            self.requestCount += len(opList)
+        return ret
+
+    def rule_add(self, fwmark, table, priority):
+        # returns error code, 0 if the operation succeeds
+        with self.iprLock:
+            return self._ruleRequest("add", fwmark, table, priority)
+
+    def rule_del(self, fwmark, table, priority):
+        # returns error code, 0 if the operation succeeds
+        with self.iprLock:
+            return self._ruleRequest("del", fwmark, table, priority)
+
+    def get_statistics(self):
+        return {
+            "batch": self.batchCount,
+            "request": self.requestCount,
+            "ifindex-lookup": self.ifindexLookupCount,
+            "ifindex-cache-hit": self.ifindexHitCount,
+        }
+
+    def _putRouteRequest(self, table, op, dst, nexthop, oif):
+        addr, plen = dst.split("/")
+
+        msg = rtmsg()
+        msg["family"] = socket.AF_INET
+        msg["dst_len"] = int(plen)
+        if table < 256:
+            msg["table"] = table
+            msg["attrs"] = []
+        else:
+            msg["table"] = 252                              # RT_TABLE_COMPAT, real table id is in RTA_TABLE
+            msg["attrs"] = [["RTA_TABLE", table]]
+        if addr != "0.0.0.0" or int(plen) != 0:
+            msg["attrs"].append(["RTA_DST", addr])
+
+        if op in ["add", "replace"]:
+            msg["proto"] = 3                                # RTPROT_BOOT, same as "ip route add"
+            msg["type"] = 1                                 # RTN_UNICAST
+            if nexthop is not None:
+                msg["scope"] = 0                            # RT_SCOPE_UNIVERSE
+                msg["attrs"].append(["RTA_GATEWAY", nexthop])
+            else:
+                msg["scope"] = 253                          # RT_SCOPE_LINK
+            if oif is not None:
+                msg["attrs"].append(["RTA_OIF", oif])
+            msgType = rtnl.RTM_NEWROUTE
+            if op == "add":
+                flags = NLM_F_REQUEST | NLM_F_ACK | NLM_F_CREATE | NLM_F_EXCL
+            else:
+                flags = NLM_F_REQUEST | NLM_F_ACK | NLM_F_CREATE | NLM_F_REPLACE
+        elif op == "del":
+            msg["scope"] = 255                              # RT_SCOPE_NOWHERE, matches any scope
+            if nexthop is not None:
+                msg["attrs"].append(["RTA_GATEWAY", nexthop])         # only the route through it is deleted
+            if oif is not None:
+                msg["attrs"].append(["RTA_OIF", oif])
+            msgType = rtnl.RTM_DELROUTE
+            flags = NLM_F_REQUEST | NLM_F_ACK
+        else:
+            assert False
+
+        self.seq = (self.seq + 1) % 0x7FFFFFFF
+        seq = 0x10000 + self.seq
+        self.ipr.put(msg, msgType, msg_flags=flags, msg_seq=seq)
+        return seq
+
+    def _ruleRequest(self, op, fwmark, table, priority):
+        self.requestCount += 1
+        try:
+            self.ipr.rule(op, family=socket.AF_INET, fwmark=fwmark, table=table, priority=priority)
+            return 0
+        except pyroute2.netlink.exceptions.NetlinkError as e:
+            return e.code
+
+    def _getAck(self, seq):
+        try:
+            self.ipr.get(msg_seq=seq)
+            return 0
+        except pyroute2.netlink.exceptions.NetlinkError as e:
+            return e.code
+
+    def _monitorCallback(self, source, cb_condition):
+        try:
+            for msg in self.monitor.get():
+                if msg["event"] in ["RTM_NEWLINK", "RTM_DELLINK"]:
+                    with self.iprLock:
+                        ifname = msg.get_attr("IFLA_IFNAME")
+                        for k, v in list(self.ifindexDict.items()):
+                            if k == ifname or v == msg["index"]:
+                                del self.ifindexDict[k]
+                for callback in self.callbackList:
+                    callback(msg)
+        except Exception:
+            self.logger.error("Error occured in netlink monitor callback", exc_info=True)
+        return True
@@ -2,34 +2,229 @@
 # -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
 
 import os
+import stat
+import time
 import json
-import iptc
+import struct
 import logging
 import pyroute2
-import subprocess
+import urllib.parse
 import configparser
 from gi.repository import Gio
+from gi.repository import GLib
+from byx_dnsmasq import ByxDnsmasq
+from byx_dns_forwarder import ByxDnsForwarder
+from byx_domain_index import ByxDomainIndex
+from byx_priority_dict import ByxPriorityDict
+from byx_route_table import ByxRouteTable
+from byx_fwmark_route_table import ByxFwmarkRouteTable
 from byx_util import ByxUtil
+from byx_ntfac_supervisor import ByxNtfacSupervisor
 
 
 class ByxNtfacGroup:
 
-    def __init__(self, param, activeInfo, ntfacNameList):
+    # ntfacs send line-JSON messages by default. an ntfac can send a "hello" message first to
+    # negotiate a newer protocol version and capabilities, which are:
+    #   "frame":      length-prefixed frames, each contains an array of messages
+    #   "list-delta": "update" messages can carry append/remove deltas of "network-list" and "domain-list"
+    #   "sync":       "sync" messages are acknowledged
+    #   "network-changed": facilities of ByxPersistentNtfacSet are notified when they are attached to a new group
+    #
+    # "sync" messages carry the complete entity set of an ntfac, the manager applies only the difference
+    # against the entities it holds for this ntfac, so a restarted or confused ntfac leaves nothing stale.
+    # see doc/network-facility-protocol.txt.
+    #
+    # churn protection: a pending "update" absorbs the following updates of the same id, so only the
+    # result is applied. an ntfac with "rate-limit" in ntfac.ini has a token bucket, one token for every
+    # message applied, messages over the limit are deferred (and still coalesced) until tokens refill.
+
+    PROTOCOL_VERSION = 2
+    CAPABILITY_LIST = ["frame", "list-delta", "sync", "network-changed"]
+    MAX_FRAME_SIZE = 1024 * 1024        # bytes, big lists should be split into delta messages in several frames
+
+    # the group is started in stages, so that the caller can run them concurrently with other work:
+    #   start_nameserver() and start_gateway() are independent, and don't need the connection
+    #   set_active_info() needs both of them, start_ntfacs() needs set_active_info()
+    #   wait_ntfacs_ready() needs start_ntfacs(), attach_persistent_ntfacs() needs wait_ntfacs_ready()
+    # dispose() can be called after any of them, cancel_start() interrupts wait_ntfacs_ready().
+    # all the methods must be called in main loop, except wait_ntfacs_ready() and cancel_start(), which
+    # are for the activation thread.
+
+    def __init__(self, param, ntfacNameList, persistentNtfacSet=None):
         self.param = param
-        self.activeInfo = activeInfo
+        self.activeInfo = None
+        self.persistentNtfacSet = persistentNtfacSet        # facilities not owned by this group, attached after start
         self.logger = logging.getLogger(self.__module__ + "." + self.__class__.__name__)
 
-        self.ntfacDict = dict()                 # dict<ntfac-name, ntfac-info>
+        self.ntfacDict = dict()                 # dict<ntfac-name, ntfac-info>, including attached facilities
+        ownNtfacDict = dict()
         for ntfacName in ntfacNameList:
-            self.ntfacDict[ntfacName] = _NtfacInfo(ntfacName, os.path.join(self.param.etcNtfacDir, ntfacName))
+            if self.persistentNtfacSet is not None and self.persistentNtfacSet.has_ntfac(ntfacName):
+                continue
+            ownNtfacDict[ntfacName] = _NtfacInfo(ntfacName, os.path.join(self.param.etcNtfacDir, ntfacName), os.path.join(self.param.runNtfacDir, ntfacName))
+        self.ntfacDict.update(ownNtfacDict)
 
-        self.stdoutDict = dict()                # dict<stdout, ntfac-name>
-        self.stderrDict = dict()                # dict<stderr, ntfac-name>
-        self.idTypeDict = dict()                # dict<id, type>
+        self.channelDict = dict()               # dict<ntfac-name, _NtfacChannel>
+        self.entityOwnerDict = dict()           # dict<id, ntfac-name>, entity data is in ntfac-info
+        self.syncCount = 0
 
-        self.hostManager = _HostManager(self.param)
+        self.pendingMsgList = []                # list<(ntfac-name, json-object)>
+        self.pendingUpdateDict = dict()         # dict<(ntfac-name, id), json-object>, pending update which absorbs later updates
+        self.flushSource = None
+        self.throttleSource = None
+
+        self.supervisor = ByxNtfacSupervisor(ownNtfacDict, self._onNtfacStart, self._onNtfacExit)
 
         self.dnsServ = _Level2DnsServer(self.param)
+        self.hostManager = _HostManager(self.param, self.dnsServ)
+        self.gatewayManager = _GatewayManager(self.param)
+
+    def dispose(self):
+        self._dispose()
+
+    def start_nameserver(self):
+        self.dnsServ.start()
+        self.logger.info("Level 2 nameserver started.")
+        self.hostManager.start()
+
+    def start_gateway(self):
+        self.gatewayManager.start()
+        self.logger.info("Gateway manager started.")
+
+    def set_active_info(self, activeInfo):
+        # nameservers and gateways of the connection itself, in one batch
+        self.activeInfo = activeInfo
+        self._beginBatch()
+        try:
+            self._addMainEntities()
+        finally:
+            self._endBatch()
+
+    def change_active_info(self, activeInfo):
+        # the group is taken over by another connection, default route, nameservers and gateway
+        # firewall rules are switched in one batch, facilities keep running and are notified
+        self._beginBatch()
+        try:
+            self._deleteMainEntities()
+            self.activeInfo = activeInfo
+            self._addMainEntities()
+        finally:
+            self._endBatch()
+
+        for ntfacName, channel in self.channelDict.items():
+            ntfacInfo = self.ntfacDict[ntfacName]
+            if "network-changed" in ntfacInfo.capabilitySet:
+                channel.send({"operation": "network-changed", "generation": ntfacInfo.generation})
+
+    def start_ntfacs(self):
+        self.supervisor.start()
+
+    def wait_ntfacs_ready(self):
+        notReadyList = self.supervisor.wait_ready()
+        if self.supervisor.is_wait_cancelled():
+            return
+        if len(notReadyList) > 0:
+            self.logger.warning("Network traffic facility %s not ready, continue activation." % (", ".join(notReadyList)))
+
+    def attach_persistent_ntfacs(self):
+        if self.persistentNtfacSet is not None:
+            self.persistentNtfacSet.attach(self)
+
+    def cancel_start(self):
+        self.supervisor.cancel_wait_ready()
+
+    def get_l2_nameserver_port(self):
+        # the port may change when the nameserver is restarted
+        return self.dnsServ.dnsmasq.get_port()
+
+    def get_statistics(self):
+        return {
+            "dnsmasq": self.dnsServ.get_statistics(),
+            "host": self.hostManager.get_statistics(),
+            "route": self.gatewayManager.get_statistics(),
+            "ntfac": self.supervisor.get_statistics(),
+            "entity": len(self.entityOwnerDict),
+            "sync": self.syncCount,
+            "churn": {k: v.get_churn_statistics() for k, v in self.ntfacDict.items()},
+        }
+
+    def _dispose(self):
+        if self.flushSource is not None:
+            GLib.source_remove(self.flushSource)
+            self.flushSource = None
+        if self.throttleSource is not None:
+            GLib.source_remove(self.throttleSource)
+            self.throttleSource = None
+
+        if self.persistentNtfacSet is not None:
+            self.persistentNtfacSet.detach(self)
+
+        self.supervisor.stop()
+        for ntfacName, channel in self.channelDict.items():
+            channel.close()
+            self.ntfacDict[ntfacName].reset()
+        self.channelDict = dict()
+
+        self.gatewayManager.stop()
+        self.logger.info("Gateway manager stopped.")
+
+        self.hostManager.stop()
+        self.dnsServ.stop()
+        self.logger.info("Level 2 nameserver stopped.")
+
+    def adopt_channel(self, channel):
+        # facility of ByxPersistentNtfacSet, its entities are installed, then it is notified
+        ntfacName = channel.ntfacName
+        ntfacInfo = channel.ntfacInfo
+        self.ntfacDict[ntfacName] = ntfacInfo
+        self.channelDict[ntfacName] = channel
+
+        self._beginBatch()
+        try:
+            for id, (type, data) in list(ntfacInfo.entityDict.items()):
+                try:
+                    if id in self.entityOwnerDict:
+                        raise Exception("entity \"%s\" duplicates" % (id))
+                    self._entityApply(ntfacName, id, type, data)
+                    self.entityOwnerDict[id] = ntfacName
+                except Exception:
+                    self.logger.error("Failed to install entity \"%s\" of network traffic facility %s." % (id, ntfacName), exc_info=True)
+                    del ntfacInfo.entityDict[id]
+        finally:
+            self._endBatch()
+
+        channel.attach(self)
+        if "network-changed" in ntfacInfo.capabilitySet:
+            channel.send({"operation": "network-changed", "generation": ntfacInfo.generation})
+        self.logger.info("Network traffic facility %s attached with %d entities." % (ntfacName, len(ntfacInfo.entityDict)))
+
+    def release_channel(self, ntfacName):
+        # entities are kept in ntfac-info, messages not applied yet go back to the channel, this group is being disposed
+        ntfacInfo = self.ntfacDict[ntfacName]
+        self.channelDict.pop(ntfacName).detach([x[1] for x in self.pendingMsgList if x[0] == ntfacName] + ntfacInfo.throttleList)
+        self._dropMessages(ntfacName)
+        for id in self.ntfacDict[ntfacName].entityDict:
+            if self.entityOwnerDict.get(id) == ntfacName:
+                del self.entityOwnerDict[id]
+        del self.ntfacDict[ntfacName]
+
+    def withdraw_ntfac(self, ntfacName):
+        # withdraw everything of an exited facility, it announces its entities again after restart
+        self._dropMessages(ntfacName)
+        idList = [k for k, v in self.entityOwnerDict.items() if v == ntfacName]
+        self._beginBatch()
+        try:
+            for id in idList:
+                self._entityDelete(id)
+        finally:
+            self._endBatch()
+        self.logger.info("%d entities of network traffic facility %s withdrawn." % (len(idList), ntfacName))
+
+    def receive_messages(self, ntfacName, jsonObjList):
+        self._queueMessages(ntfacName, jsonObjList)
+
+    def _addMainEntities(self):
         if "default-nameserver" in self.activeInfo:
             self.dnsServ.nameServerNewAsDefault("main", self.param.priority, self.activeInfo["default-nameserver"])
         i = 0
@@ -38,123 +233,700 @@ class ByxNtfacGroup:
             self.dnsServ.nameServerNew(id, self.param.priority, ns["target"], ns["domain-list"])
             i += 1
 
-        self.gatewayManager = _GatewayManager(self.param)
         if "default-gateway" in self.activeInfo:
             self.gatewayManager.gatewayNewAsDefault("main", self.param.priority, self.activeInfo["default-gateway"])
         i = 0
         for gw in self.activeInfo.get("gateway-list", []):
             id = "main" if i == 0 else "main-%d" % (i)
-            self.dnsServ.gatewayNew(id, self.param.priority, gw["target"], gw["network-list"])
+            self.gatewayManager.gatewayNew(id, self.param.priority, gw["target"], gw["network-list"])
             i += 1
 
-        try:
-            self.dnsServ.start()
-            self.logger.info("Level 2 nameserver started.")
+    def _deleteMainEntities(self):
+        # "main" is used by both the default one and the first one in list, the default one is deleted first
+        if "default-nameserver" in self.activeInfo:
+            self.dnsServ.nameServerDelete("main")
+        for i in range(0, len(self.activeInfo.get("nameserver-list", []))):
+            self.dnsServ.nameServerDelete("main" if i == 0 else "main-%d" % (i))
 
-            self.gatewayManager.start()
-            self.logger.info("Gateway manager started.")
+        if "default-gateway" in self.activeInfo:
+            self.gatewayManager.gatewayDelete("main")
+        for i in range(0, len(self.activeInfo.get("gateway-list", []))):
+            self.gatewayManager.gatewayDelete("main" if i == 0 else "main-%d" % (i))
+
+    def _onNtfacStart(self, ntfacName, proc):
+        self.ntfacDict[ntfacName].reset()
+        self.ntfacDict[ntfacName].proc = proc
+        self.channelDict[ntfacName] = _NtfacChannel(ntfacName, self.ntfacDict[ntfacName], self.supervisor)
+        self.channelDict[ntfacName].attach(self)
+
+    def _onNtfacExit(self, ntfacName):
+        self.channelDict.pop(ntfacName).close()
+        self.withdraw_ntfac(ntfacName)
+        self.ntfacDict[ntfacName].reset()
+
+    def _queueMessages(self, ntfacName, jsonObjList):
+        # messages are not applied here, they are coalesced and applied as a batch in self._flushPendingMessages()
+        ntfacInfo = self.ntfacDict[ntfacName]
+        for jsonObj in jsonObjList:
+            if self._coalesceMessage(ntfacName, jsonObj):
+                ntfacInfo.coalesceCount += 1
+            elif len(ntfacInfo.throttleList) > 0:
+                ntfacInfo.throttleList.append(jsonObj)          # keep the order behind the deferred messages
+            else:
+                self.pendingMsgList.append((ntfacName, jsonObj))
+        self._scheduleFlush()
 
+    def _scheduleFlush(self):
+        if self.flushSource is None and len(self.pendingMsgList) > 0:
+            if self.param.ntfacBatchWindow > 0:
+                self.flushSource = GLib.timeout_add(self.param.ntfacBatchWindow, self._flushPendingMessages)
+            else:
+                # idle priority is lower than read callbacks, so all the data already buffered is drained first
+                self.flushSource = GLib.idle_add(self._flushPendingMessages)
+
+    def _coalesceMessage(self, ntfacName, jsonObj):
+        # returns True if jsonObj is merged into a pending update of the same id
+        if jsonObj["operation"] == "sync":
+            for key in [x for x in self.pendingUpdateDict if x[0] == ntfacName]:
+                del self.pendingUpdateDict[key]
+            return False
+
+        key = (ntfacName, jsonObj.get("id"))
+        if jsonObj["operation"] != "update" or not isinstance(jsonObj.get("data"), dict):
+            self.pendingUpdateDict.pop(key, None)               # later updates can't jump over it
+            return False
+        if key in self.pendingUpdateDict:
+            pendingObj = self.pendingUpdateDict[key]
+            pendingObj["data"] = _Helper.mergeUpdate(pendingObj["data"], jsonObj["data"])
+            return True
+        self.pendingUpdateDict[key] = jsonObj
+        return False
+
+    def _dropMessages(self, ntfacName):
+        self.pendingMsgList = [x for x in self.pendingMsgList if x[0] != ntfacName]
+        for key in [x for x in self.pendingUpdateDict if x[0] == ntfacName]:
+            del self.pendingUpdateDict[key]
+        self.ntfacDict[ntfacName].throttleList = []
+        self.ntfacDict[ntfacName].bThrottled = False
+
+    def _flushPendingMessages(self):
+        self.flushSource = None
+        msgList = self.pendingMsgList
+        self.pendingMsgList = []
+
+        # one route refresh and one nameserver reload for the whole batch
+        self._beginBatch()
+        try:
+            for ntfacName, jsonObj in msgList:
+                ntfacInfo = self.ntfacDict[ntfacName]
+                if len(ntfacInfo.throttleList) > 0 or not ntfacInfo.tokenBucket.take():
+                    if not ntfacInfo.bThrottled:
+                        ntfacInfo.bThrottled = True
+                        ntfacInfo.throttleCount += 1
+                        self.logger.warning("Network traffic facility %s exceeds its rate limit, messages are deferred." % (ntfacName))
+                    ntfacInfo.throttleList.append(jsonObj)
+                    continue
+                key = (ntfacName, jsonObj.get("id"))
+                if self.pendingUpdateDict.get(key) is jsonObj:
+                    del self.pendingUpdateDict[key]
+                try:
+                    self._applyMessage(ntfacName, jsonObj)
+                except Exception:
+                    self.logger.error("Invalid message from network traffic facility %s." % (ntfacName), exc_info=True)
+        finally:
+            try:
+                self._endBatch()
+            except Exception:
+                self.logger.error("Error occured in flush pending messages callback", exc_info=True)
+
+        delay = None
+        for ntfacName, ntfacInfo in self.ntfacDict.items():
+            if len(ntfacInfo.throttleList) > 0:
+                d = ntfacInfo.tokenBucket.get_delay()
+                delay = d if delay is None else min(delay, d)
+            elif ntfacInfo.bThrottled:
+                ntfacInfo.bThrottled = False
+                self.logger.info("Network traffic facility %s is within its rate limit again." % (ntfacName))
+        if delay is not None and self.throttleSource is None:
+            self.throttleSource = GLib.timeout_add(max(delay, 1), self._throttleTimeoutCallback)
+
+        return False
+
+    def _throttleTimeoutCallback(self):
+        # deferred messages are applied before the ones received after them
+        self.throttleSource = None
+        try:
             for ntfacName, ntfacInfo in self.ntfacDict.items():
-                ntfacInfo.proc = Gio.subprocess(Gio.Subprocess.Flags.STDOUT_PIPE | Gio.Subprocess.Flags.STDERR_PIPE,
-                                                ntfacInfo.execPath, *ntfacInfo.paramList)
-                self.stdoutDict[ntfacInfo.proc.get_stdout_pipe()] = ntfacName
-                self.stderrDict[ntfacInfo.proc.get_stderr_pipe()] = ntfacName
-                ntfacInfo.proc.get_stdout_pipe().read_line_async(0, None, self._onReceive)        # fixme: 0 should be PRIORITY_DEFAULT, but I can't find it
-                ntfacInfo.proc.get_stderr_pipe().read_async(0, None, self._on_error)              # fixme: 0 should be PRIORITY_DEFAULT, but I can't find it
-                self.logger.info("Network traffic facility %s started." % (ntfacName))
-        except BaseException:
-            self._dispose()
-            raise
+                for jsonObj in ntfacInfo.throttleList:
+                    self.pendingMsgList.append((ntfacName, jsonObj))
+                ntfacInfo.throttleList = []
+            self._scheduleFlush()
+        except Exception:
+            self.logger.error("Error occured in throttle timeout callback", exc_info=True)
+        return False
+
+    def _beginBatch(self):
+        self.dnsServ.begin_batch()
+        self.hostManager.begin_batch()
+        self.gatewayManager.begin_batch()
+
+    def _endBatch(self):
+        # all of them leave batch mode even if applying the batch fails, or every later batch would fail
+        try:
+            self.gatewayManager.end_batch()
+        finally:
+            try:
+                self.hostManager.end_batch()
+            finally:
+                self.dnsServ.end_batch()
+
+    def _applyMessage(self, ntfacName, jsonObj):
+        if jsonObj["operation"] == "new":
+            if jsonObj["id"] in self.entityOwnerDict:
+                raise Exception("entity \"%s\" duplicates" % (jsonObj["id"]))
+            self._entityNew(ntfacName, jsonObj["id"], jsonObj["type"], jsonObj["data"])
+        elif jsonObj["operation"] == "update":
+            self._checkOwner(ntfacName, jsonObj["id"])
+            if any([x.endswith("-append") or x.endswith("-remove") for x in jsonObj["data"]]):
+                self._checkCapability(ntfacName, "list-delta")
+            self._entityUpdate(jsonObj["id"], jsonObj["data"])
+        elif jsonObj["operation"] == "delete":
+            self._checkOwner(ntfacName, jsonObj["id"])
+            self._entityDelete(jsonObj["id"])
+        elif jsonObj["operation"] == "sync":
+            self._applySync(ntfacName, jsonObj)
+        else:
+            raise Exception("invalid message")
+
+    def _applySync(self, ntfacName, jsonObj):
+        # the complete entity set of the ntfac, it can be split into several messages with "more"
+        ntfacInfo = self.ntfacDict[ntfacName]
+        generation = int(jsonObj["generation"])
+        if ntfacInfo.generation is not None and generation <= ntfacInfo.generation:
+            self.logger.warning("Stale sync generation %d from network traffic facility %s ignored." % (generation, ntfacName))
+            return
+        if ntfacInfo.syncBuffer is None or ntfacInfo.syncBuffer[0] != generation:
+            ntfacInfo.syncBuffer = (generation, [])             # an unfinished older generation is dropped
+        ntfacInfo.syncBuffer[1].extend(jsonObj["entity-list"])
+        if jsonObj.get("more", False):
+            return
+        entityList = ntfacInfo.syncBuffer[1]
+        ntfacInfo.syncBuffer = None
+        ntfacInfo.generation = generation
+
+        # apply the difference only
+        newDict = dict()
+        for item in entityList:
+            newDict[item["id"]] = (item["type"], item["data"])
+        deleteCount, newCount, updateCount = 0, 0, 0
+        for id in list(ntfacInfo.entityDict.keys()):
+            if id not in newDict:
+                self._entityDelete(id)
+                deleteCount += 1
+        for id, (type, data) in newDict.items():
+            try:
+                if id not in self.entityOwnerDict:
+                    self._entityNew(ntfacName, id, type, data)
+                    newCount += 1
+                    continue
+                self._checkOwner(ntfacName, id)
+                oldType, oldData = ntfacInfo.entityDict[id]
+                if oldType == type and oldData == data:
+                    continue
+                delta = _Helper.entityDelta(type, oldData, data) if oldType == type else None
+                if delta is not None:
+                    self._entityUpdate(id, delta)
+                    ntfacInfo.entityDict[id] = (type, data)
+                else:
+                    self._entityDelete(id)
+                    self._entityNew(ntfacName, id, type, data)
+                updateCount += 1
+            except Exception:
+                self.logger.error("Invalid entity \"%s\" in sync from network traffic facility %s." % (id, ntfacName), exc_info=True)
+        self.syncCount += 1
+        self.logger.info("Network traffic facility %s synchronized to generation %d, %d new, %d changed, %d deleted." % (ntfacName, generation, newCount, updateCount, deleteCount))
+
+        if "sync" in ntfacInfo.capabilitySet:
+            reply = {"operation": "sync", "generation": generation}
+            self.channelDict[ntfacName].send(reply)
+
+    def _entityNew(self, ntfacName, id, type, data):
+        self._entityApply(ntfacName, id, type, data)
+        self.entityOwnerDict[id] = ntfacName
+        self.ntfacDict[ntfacName].entityDict[id] = (type, data)
+
+    def _entityApply(self, ntfacName, id, type, data):
+        priority = self.ntfacDict[ntfacName].priority
+        if type == "host":
+            self.hostManager.hostNew(id, priority, data["hostname"], data["address"])
+        elif type == "nameserver":
+            self.dnsServ.nameServerNew(id, priority, data["target"], data["domain-list"])
+        elif type == "gateway":
+            self.gatewayManager.gatewayNew(id, priority, data["target"], data["network-list"])
+        elif type == "default-nameserver":
+            self.dnsServ.nameServerNewAsDefault(id, priority, data["target"])
+        elif type == "default-gateway":
+            self.gatewayManager.gatewayNewAsDefault(id, priority, data["target"])
+        else:
+            raise Exception("invalid message")
+
+    def _entityUpdate(self, id, data):
+        ntfacName = self.entityOwnerDict[id]
+        type, oldData = self.ntfacDict[ntfacName].entityDict[id]
+        newData = dict(oldData)
+        if type == "host":
+            self.hostManager.hostUpdate(id, data["address"])
+            newData["address"] = data["address"]
+        elif type == "nameserver":
+            if "domain-list" in data:
+                self.dnsServ.nameServerUpdate(id, data["domain-list"])
+                newData["domain-list"] = data["domain-list"]
+            else:
+                self.dnsServ.nameServerUpdateDelta(id, data.get("domain-list-append", []), data.get("domain-list-remove", []))
+                newData["domain-list"] = _Helper.applyListDelta(oldData["domain-list"], data.get("domain-list-append", []), data.get("domain-list-remove", []))
+        elif type == "gateway":
+            if "network-list" in data:
+                self.gatewayManager.gatewayUpdate(id, data["network-list"])
+                newData["network-list"] = data["network-list"]
+            else:
+                self.gatewayManager.gatewayUpdateDelta(id, data.get("network-list-append", []), data.get("network-list-remove", []))
+                newData["network-list"] = _Helper.applyListDelta(oldData["network-list"], data.get("network-list-append", []), data.get("network-list-remove", []))
+        else:
+            raise Exception("invalid message")
+        self.ntfacDict[ntfacName].entityDict[id] = (type, newData)
+
+    def _entityDelete(self, id):
+        ntfacName = self.entityOwnerDict[id]
+        type = self.ntfacDict[ntfacName].entityDict[id][0]
+        if type == "host":
+            self.hostManager.hostDelete(id)
+        elif type in ["nameserver", "default-nameserver"]:
+            self.dnsServ.nameServerDelete(id)
+        elif type in ["gateway", "default-gateway"]:
+            self.gatewayManager.gatewayDelete(id)
+        else:
+            assert False
+        del self.entityOwnerDict[id]
+        del self.ntfacDict[ntfacName].entityDict[id]
 
-    def dispose(self):
-        self._dispose()
+    def _checkOwner(self, ntfacName, id):
+        if self.entityOwnerDict.get(id) != ntfacName:
+            raise Exception("entity \"%s\" belongs to another network traffic facility" % (id))
 
-    def get_l2_nameserver_port(self):
-        return self.dnsServ.dnsPort
+    def _checkCapability(self, ntfacName, capability):
+        if capability not in self.ntfacDict[ntfacName].capabilitySet:
+            raise Exception("capability \"%s\" is not negotiated" % (capability))
 
-    def _dispose(self):
-        for ntfacName, ntfacInfo in self.ntfacDict.items():
-            ntfacInfo.proc.send_signal(15)    # SIGTERM
-            ntfacInfo.proc.wait()
-            ntfacInfo.proc = None
-            self.logger.info("Network traffic facility %s terminated." % (ntfacName))
 
-        self.gatewayManager.stop()
-        self.logger.info("Gateway manager stopped.")
+class ByxPersistentNtfacSet:
 
-        self.dnsServ.stop()
-        self.logger.info("Level 2 nameserver stopped.")
+    # connection-independent facilities ("connection-independent=true" in ntfac.ini). they are started
+    # once and keep running across connection switches, their entities are kept while no connection
+    # is active, and installed into the ntfac group of every new connection. facilities with capability
+    # "network-changed" are notified then, so that they only need to send the entities changed.
+
+    def __init__(self, param, ntfacNameList):
+        self.param = param
+        self.logger = logging.getLogger(self.__module__ + "." + self.__class__.__name__)
+
+        self.ntfacDict = dict()                 # dict<ntfac-name, ntfac-info>
+        for ntfacName in ntfacNameList:
+            try:
+                ntfacInfo = _NtfacInfo(ntfacName, os.path.join(self.param.etcNtfacDir, ntfacName), os.path.join(self.param.runNtfacDir, ntfacName))
+            except Exception:
+                self.logger.error("Invalid network traffic facility %s." % (ntfacName), exc_info=True)
+                continue
+            if ntfacInfo.bConnectionIndependent:
+                self.ntfacDict[ntfacName] = ntfacInfo
+
+        self.channelDict = dict()               # dict<ntfac-name, _NtfacChannel>
+        self.group = None                       # ntfac group of the active connection
+
+        # readiness is not waited for, nothing depends on them when daemon starts
+        self.supervisor = ByxNtfacSupervisor(self.ntfacDict, self._onNtfacStart, self._onNtfacExit)
+        try:
+            self.supervisor.start()
+        except BaseException:
+            self.dispose()
+            raise
+
+    def dispose(self):
+        assert self.group is None
+        self.supervisor.stop()
+        for ntfacName, channel in self.channelDict.items():
+            channel.close()
+            self.ntfacDict[ntfacName].reset()
+        self.channelDict = dict()
+
+    def has_ntfac(self, ntfacName):
+        return ntfacName in self.ntfacDict
+
+    def attach(self, group):
+        assert self.group is None
+        self.group = group
+        for channel in self.channelDict.values():
+            self.group.adopt_channel(channel)
+
+    def detach(self, group):
+        if self.group is not group:
+            return                              # group failed before attaching
+        for ntfacName in self.channelDict:
+            self.group.release_channel(ntfacName)
+        self.group = None
+
+    def get_statistics(self):
+        return self.supervisor.get_statistics()
+
+    def _onNtfacStart(self, ntfacName, proc):
+        self.ntfacDict[ntfacName].reset()
+        self.ntfacDict[ntfacName].proc = proc
+        self.channelDict[ntfacName] = _NtfacChannel(ntfacName, self.ntfacDict[ntfacName], self.supervisor)
+        if self.group is not None:
+            self.group.adopt_channel(self.channelDict[ntfacName])
+
+    def _onNtfacExit(self, ntfacName):
+        if self.group is not None:
+            self.group.withdraw_ntfac(ntfacName)
+            self.group.release_channel(ntfacName)
+        self.channelDict.pop(ntfacName).close()
+        self.ntfacDict[ntfacName].reset()
+
+
+class _NtfacChannel:
+
+    # stdout reader of a running facility. "ready" and "hello" are handled when received, the other
+    # messages are passed to the ntfac group it is attached to, or kept until a group is attached.
+    #
+    # big lists can be sent as files in the runtime directory of the facility, "network-list-file"
+    # or "domain-list-file" in entity data. the file is read by _ListFileReader, some lines in every
+    # main loop iteration, and replaced by the list, then it is deleted, so it never becomes a json
+    # string and never blocks the main loop. the messages after it wait, so the order is kept.
+
+    def __init__(self, ntfacName, ntfacInfo, supervisor):
+        self.ntfacName = ntfacName
+        self.ntfacInfo = ntfacInfo
+        self.supervisor = supervisor
+        self.logger = logging.getLogger(self.__module__ + "." + self.__class__.__name__)
+
+        self.group = None
+        self.pendingList = []                   # list<json-object>, received while no group is attached
+        self.deliverList = []                   # list<json-object>, waiting for the list files of the first one
+        self.listFileReader = None
+        self.bClosed = False
+
+        self.stdout = Gio.DataInputStream.new(self.ntfacInfo.proc.get_stdout_pipe())
+        self.stdout.read_line_async(GLib.PRIORITY_DEFAULT, None, self._onReceive)
+
+    def attach(self, group):
+        self.group = group
+        msgList = self.pendingList
+        self.pendingList = []
+        if len(msgList) > 0:
+            group.receive_messages(self.ntfacName, msgList)
+
+    def detach(self, msgList=[]):
+        self.group = None
+        self.pendingList = msgList + self.pendingList
+
+    def close(self):
+        self.bClosed = True
+        if self.listFileReader is not None:
+            self.listFileReader.cancel()
+            self.listFileReader = None
+        self.deliverList = []
+        self.detach()
+
+    def send(self, jsonObj):
+        self.ntfacInfo.proc.get_stdin_pipe().write_all((json.dumps(jsonObj) + "\n").encode("utf-8"), None)
 
     def _onReceive(self, source_object, res):
+        if self.bClosed:
+            return                                          # facility exited
         try:
             line, len = source_object.read_line_finish_utf8(res)
-            if line is None:
-                raise Exception("socket closed by peer")
+        except Exception:
+            self.logger.error("Error occured in receive callback", exc_info=True)
+            return                                          # pipe is broken, facility is exiting, handled by supervisor
+        if line is None:
+            return                                          # facility is exiting, handled by supervisor
 
+        # a bad message is dropped, reading must go on, or the facility blocks on a full pipe
+        try:
             jsonObj = json.loads(line)
-            if jsonObj["operation"] == "new":
-                if jsonObj["type"] == "host":
-                    self.hostManager.hostNew(jsonObj["id"], self.ntfacDict[self.stdoutDict[source_object]].priority,
-                                             jsonObj["data"]["hostname"], jsonObj["data"]["address"])
-                elif jsonObj["type"] == "nameserver":
-                    self.dnsServ.nameServerNew(jsonObj["id"], self.ntfacDict[self.stdoutDict[source_object]].priority,
-                                               jsonObj["data"]["target"], jsonObj["data"]["domain-list"])
-                elif jsonObj["type"] == "gateway":
-                    self.gatewayManager.gatewayNew(jsonObj["id"], self.ntfacDict[self.stdoutDict[source_object]].priority,
-                                                   jsonObj["data"]["target"], jsonObj["data"]["network-list"])
-                elif jsonObj["type"] == "default-nameserver":
-                    self.dnsServ.nameServerNewAsDefault(jsonObj["id"], self.ntfacDict[self.stdoutDict[source_object]].priority,
-                                                        jsonObj["data"]["target"])
-                elif jsonObj["type"] == "default-gateway":
-                    self.dnsServ.gatewayNewAsDefault(jsonObj["id"], self.ntfacDict[self.stdoutDict[source_object]].priority,
-                                                     jsonObj["data"]["target"])
-                else:
-                    raise Exception("invalid message")
-                self.idTypeDict[jsonObj["id"]] = jsonObj["type"]
-            elif jsonObj["operation"] == "update":
-                if self.idTypeDict[jsonObj["id"]] == "host":
-                    self.hostManager.hostUpdate(jsonObj["id"], jsonObj["data"]["address"])
-                elif self.idTypeDict[jsonObj["id"]] == "nameserver":
-                    self.dnsServ.nameServerUpdate(jsonObj["id"], jsonObj["data"]["domain-list"])
-                elif self.idTypeDict[jsonObj["id"]] == "gateway":
-                    self.gatewayManager.gatewayUpdate(jsonObj["id"], jsonObj["data"]["network-list"])
-                else:
-                    raise Exception("invalid message")
-            elif jsonObj["operation"] == "delete":
-                if self.idTypeDict[jsonObj["id"]] == "host":
-                    self.hostManager.hostDelete(jsonObj["id"])
-                elif self.idTypeDict[jsonObj["id"]] in ["nameserver", "default-nameserver"]:
-                    self.dnsServ.nameServerDelete(jsonObj["id"])
-                elif self.idTypeDict[jsonObj["id"]] in ["gateway", "default-gateway"]:
-                    self.gatewayManager.gatewayDelete(jsonObj["id"])
-                else:
-                    raise Exception("invalid message")
-                del self.idTypeDict[jsonObj["id"]]
+            if jsonObj["operation"] == "ready":
+                self.supervisor.set_ready(self.ntfacName)
+            elif jsonObj["operation"] == "hello":
+                # it changes how the following data is read, so it is handled here instead of being queued
+                self._negotiate(jsonObj)
+                if "frame" in self.ntfacInfo.capabilitySet:
+                    self.ntfacInfo.frameReader = _FrameReader(source_object, ByxNtfacGroup.MAX_FRAME_SIZE, self._onReceiveFrame)
+                    self.ntfacInfo.frameReader.start()
+                    return
             else:
-                raise Exception("invalid message")
+                self._deliver([jsonObj])
+        except Exception:
+            self.logger.error("Invalid message from network traffic facility %s." % (self.ntfacName), exc_info=True)
 
-            self.dis.read_line_async(0, None, self._onReceive)
-        except Exception as e:
-            assert False
+        try:
+            source_object.read_line_async(GLib.PRIORITY_DEFAULT, None, self._onReceive)
+        except Exception:
+            self.logger.error("Error occured in receive callback", exc_info=True)
+
+    def _onReceiveFrame(self, source_object, payload):
+        if self.bClosed or payload is None:
+            return                                          # facility is exiting, handled by supervisor
+        try:
+            jsonObjList = json.loads(payload.decode("utf-8"))
+            if not isinstance(jsonObjList, list):
+                raise Exception("frame is not an array")
+            if any([x["operation"] == "ready" for x in jsonObjList]):
+                self.supervisor.set_ready(self.ntfacName)
+                jsonObjList = [x for x in jsonObjList if x["operation"] != "ready"]
+            self._deliver(jsonObjList)
+        except Exception:
+            self.logger.error("Invalid frame from network traffic facility %s." % (self.ntfacName), exc_info=True)
+
+    def _negotiate(self, jsonObj):
+        ntfacInfo = self.ntfacInfo
+        if ntfacInfo.version is not None:
+            raise Exception("duplicate hello message")
+
+        ntfacInfo.version = min(int(jsonObj["version"]), ByxNtfacGroup.PROTOCOL_VERSION)
+        if ntfacInfo.version >= 2:
+            ntfacInfo.capabilitySet = set(jsonObj.get("capability", [])) & set(ByxNtfacGroup.CAPABILITY_LIST)
+
+        # ntfac waits for this reply before using any capability
+        reply = {
+            "operation": "hello",
+            "version": ntfacInfo.version,
+            "capability": sorted(ntfacInfo.capabilitySet),
+        }
+        self.send(reply)
+        self.logger.info("Network traffic facility %s uses protocol version %d, capabilities: %s." % (self.ntfacName, ntfacInfo.version, ", ".join(reply["capability"])))
+
+    def _deliver(self, jsonObjList):
+        self.deliverList.extend(jsonObjList)
+        if self.listFileReader is None:
+            self._deliverNext()
+
+    def _deliverNext(self):
+        msgList = []
+        while len(self.deliverList) > 0:
+            try:
+                fileList = self._getListFiles(self.deliverList[0])
+            except Exception:
+                self.logger.error("Invalid list file from network traffic facility %s." % (self.ntfacName), exc_info=True)
+                self.deliverList.pop(0)
+                continue
+            if len(fileList) > 0:
+                self.listFileReader = _ListFileReader(fileList, self._onListFilesRead)
+                self.listFileReader.start()
+                break
+            msgList.append(self.deliverList.pop(0))
+
+        if len(msgList) == 0:
+            return
+        if self.group is None:
+            self.pendingList.extend(msgList)
+            return
+        self.group.receive_messages(self.ntfacName, msgList)
+
+    def _onListFilesRead(self, bSuccess):
+        self.listFileReader = None
+        if not bSuccess:
+            self.logger.error("Invalid list file from network traffic facility %s." % (self.ntfacName))
+            self.deliverList.pop(0)
+        self._deliverNext()
+
+    def _getListFiles(self, jsonObj):
+        # returns list<(data, key, filename)>, the file references are removed from the message
+        if jsonObj["operation"] in ["new", "update"]:
+            dataList = [jsonObj.get("data")]
+        elif jsonObj["operation"] == "sync":
+            dataList = [x.get("data") for x in jsonObj.get("entity-list", [])]
+        else:
+            return []
+
+        ret = []
+        for data in dataList:
+            if not isinstance(data, dict):
+                continue
+            for key in ["network-list", "domain-list"]:
+                if key + "-file" not in data:
+                    continue
+                fn = data.pop(key + "-file")
+                if not isinstance(fn, str) or fn in ["", ".", ".."] or os.path.basename(fn) != fn:
+                    raise Exception("invalid file name \"%s\"" % (fn))
+                ret.append((data, key, os.path.join(self.ntfacInfo.runDir, fn)))
+        return ret
+
+
+class _ListFileReader:
+
+    # reads list files of a message in main loop, at most LINES_PER_CALL lines in every idle callback.
+    # a file is opened without following symlink, and must be a regular file, it is deleted after
+    # it is read, or when reading fails or is cancelled.
+
+    LINES_PER_CALL = 4096
+
+    def __init__(self, fileList, callback):
+        self.fileList = fileList                # list<(data, key, filename)>, data[key] is set to the list read
+        self.callback = callback                # callback(bSuccess)
+        self.logger = logging.getLogger(self.__module__ + "." + self.__class__.__name__)
+
+        self.f = None
+        self.itemList = None
+        self.idle = None
+
+    def start(self):
+        self.idle = GLib.idle_add(self._onIdle)
+
+    def cancel(self):
+        if self.idle is not None:
+            GLib.source_remove(self.idle)
+            self.idle = None
+        self._closeFile()
+        for data, key, fn in self.fileList:
+            ByxUtil.forceDelete(fn)
+        self.fileList = []
+
+    def _onIdle(self):
+        try:
+            if self.f is None:
+                self.f = _Helper.openListFile(self.fileList[0][2])
+                self.itemList = []
+            for i in range(0, self.LINES_PER_CALL):
+                line = self.f.readline()
+                if line == "":
+                    break
+                line = line.strip()
+                if line != "" and not line.startswith("#"):
+                    self.itemList.append(line)
+            else:
+                return True
+
+            data, key, fn = self.fileList.pop(0)
+            data[key] = self.itemList
+            self._closeFile()
+            ByxUtil.forceDelete(fn)
+            if len(self.fileList) > 0:
+                return True
+            self.idle = None
+            self.callback(True)
+            return False
+        except Exception:
+            self.logger.error("Error occured in list file read idle callback", exc_info=True)
+            self.idle = None
+            self.cancel()
+            self.callback(False)
+            return False
+
+    def _closeFile(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        self.itemList = None
+
+
+class _FrameReader:
+
+    # reads frames from a Gio input stream, a frame is a 4 bytes big-endian payload length followed
+    # by the payload. short reads are continued asynchronously, so a big frame never blocks the main loop.
+
+    def __init__(self, stream, maxSize, callback):
+        self.stream = stream
+        self.maxSize = maxSize
+        self.callback = callback                # callback(stream, payload), payload is None if stream is closed or broken
+        self.logger = logging.getLogger(self.__module__ + "." + self.__class__.__name__)
+
+        self.buf = bytearray()
+        self.size = None                        # payload size, None when reading the length
 
-    def _onEror(self, source_object, res):
-        assert False
+    def start(self):
+        self._read(4)
+
+    def _read(self, count):
+        self.stream.read_bytes_async(count - len(self.buf), GLib.PRIORITY_DEFAULT, None, self._onRead)
+
+    def _onRead(self, source_object, res):
+        try:
+            data = source_object.read_bytes_finish(res).get_data()
+            if len(data) == 0:
+                raise EOFError()
+            self.buf += data
+
+            if self.size is None:
+                if len(self.buf) < 4:
+                    self._read(4)
+                    return
+                self.size = struct.unpack("!I", self.buf)[0]
+                if self.size > self.maxSize:
+                    raise Exception("frame size %d exceeds %d" % (self.size, self.maxSize))
+                self.buf = bytearray()
+            if len(self.buf) < self.size:
+                self._read(self.size)
+                return
+
+            payload = bytes(self.buf)
+            self.buf = bytearray()
+            self.size = None
+            self.callback(self.stream, payload)
+            self._read(4)
+        except EOFError:
+            self.callback(self.stream, None)
+        except Exception:
+            self.logger.error("Error occured in frame read callback", exc_info=True)
+            self.callback(self.stream, None)
 
 
 class _NtfacInfo:
 
-    def __init__(self, ntfacName, ntfacPath):
+    def __init__(self, ntfacName, ntfacPath, runDir):
         # static data
+        self.runDir = runDir                    # facility puts list files here, cleared when it starts
         self.execPath = None
         self.paramList = []
         self.priority = None
+        self.bReadyNotify = False               # facility sends "ready" message when it is ready
+        self.bConnectionIndependent = False     # facility is run by ByxPersistentNtfacSet
+        self.rateLimit = None                   # messages per second, None means no limit
+        self.rateBurst = None                   # messages
 
-        # dynamic data
+        # dynamic data, reset when facility restarts
         self.proc = None
+        self.version = None                     # protocol version, None before negotiation, which means version 1
+        self.capabilitySet = set()
+        self.frameReader = None
+        self.generation = None                  # generation of the last sync applied
+        self.syncBuffer = None                  # (generation, list<entity>), sync being received
+        self.entityDict = dict()                # dict<id, (type, data)>, data is kept up to date with updates
 
         # initialize static data
         self._initStaticData(ntfacName, ntfacPath)
 
+        # churn protection, not reset, so that restarting doesn't refill the bucket
+        self.tokenBucket = _TokenBucket(self.rateLimit, self.rateBurst)
+        self.throttleList = []                  # list<json-object>, messages deferred by the rate limit
+        self.bThrottled = False
+        self.throttleCount = 0
+        self.coalesceCount = 0
+
+    def get_churn_statistics(self):
+        return {
+            "throttle": self.throttleCount,
+            "deferred": len(self.throttleList),
+            "coalesce": self.coalesceCount,
+        }
+
+    def reset(self):
+        self.proc = None
+        self.version = None
+        self.capabilitySet = set()
+        self.frameReader = None
+        self.generation = None
+        self.syncBuffer = None
+        self.entityDict = dict()
+
     def _initStaticData(self, ntfacName, ntfacPath):
         if not os.path.exists(ntfacPath):
             raise Exception("invalid network traffic facility %s" % (ntfacName))
@@ -168,59 +940,232 @@ class _NtfacInfo:
 
         if not cfg.has_option("main", "exec"):
             raise Exception("invalid network traffic facility %s" % (ntfacName))
-        self.execPath = int(cfg.get("main", "exec"))
+        self.execPath = cfg.get("main", "exec")
 
         for i in range(1, 10):
             if not cfg.has_option("main", "param%d" % (i)):
                 break
             p = cfg.get("main", "param%d" % (i))
             p = p.replace("${CFG_DIR}", ntfacPath)
+            p = p.replace("${RUN_DIR}", self.runDir)
             self.paramList.append(p)
 
         if not cfg.has_option("main", "priority"):
             raise Exception("invalid network traffic facility %s" % (ntfacName))
         self.priority = int(cfg.get("main", "priority"))
 
+        if cfg.has_option("main", "ready-notify"):
+            self.bReadyNotify = cfg.getboolean("main", "ready-notify")
+
+        if cfg.has_option("main", "connection-independent"):
+            self.bConnectionIndependent = cfg.getboolean("main", "connection-independent")
+
+        if cfg.has_option("main", "rate-limit"):
+            self.rateLimit = float(cfg.get("main", "rate-limit"))
+            if self.rateLimit <= 0:
+                raise Exception("invalid network traffic facility %s" % (ntfacName))
+            self.rateBurst = max(int(self.rateLimit), 1)
+            if cfg.has_option("main", "rate-burst"):
+                self.rateBurst = int(cfg.get("main", "rate-burst"))
+                if self.rateBurst < 1:
+                    raise Exception("invalid network traffic facility %s" % (ntfacName))
+
+
+class _TokenBucket:
+
+    def __init__(self, rate, burst):
+        self.rate = rate                        # tokens per second, None means unlimited
+        self.burst = burst
+        self.tokens = burst
+        self.lastTime = time.monotonic()
+
+    def take(self):
+        if self.rate is None:
+            return True
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def get_delay(self):
+        """Returns milliseconds until the next token is available"""
+
+        if self.rate is None:
+            return 0
+        self._refill()
+        return int(max(1 - self.tokens, 0) / self.rate * 1000) + 1
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.lastTime) * self.rate, self.burst)
+        self.lastTime = now
+
 
 class _HostManager:
 
-    def __init__(self, param):
+    # hosts of ntfac entities, indexed by id. ids with the same hostname are resolved by
+    # ByxPriorityDict, the winning id of every hostname is kept in a reverse index.
+    #
+    # every id has its own fragment file in the "hostsdir" of the level 2 nameserver, which exists
+    # only when the id wins its hostname. a change rewrites only the fragments of the ids that win
+    # or lose the hostname. dnsmasq reads the changed fragments by itself through inotify, the
+    # built-in forwarder is told which fragments are changed once per batch.
+
+    def __init__(self, param, dnsServ):
         self.param = param
+        self.dnsServ = dnsServ
+        self.tmpFile = os.path.join(self.param.tmpDir, "l2-ntfac-dnsmasq.hosts.tmp")     # not in hosts directory, so that nameserver never reads a partial fragment
+
+        self.hostDict = dict()                  # dict<id, (priority, hostname)>
+        self.dataFullDict = ByxPriorityDict()   # <hostname, address>, owner is id
+        self.nameOwnerDict = dict()             # dict<hostname, id>
+        self.dirtyIdSet = set()                 # set<id>, fragments to be rewritten
+
+        self.isStarted = False
+
+        self.bInBatch = False
+
+        self.fragmentWriteCount = 0
+        self.reloadCount = 0
+
+    def start(self):
+        self.isStarted = True
+        self._flush()
+
+    def stop(self):
+        self.isStarted = False                  # fragments are deleted with the hosts directory by the nameserver
+
+    def get_statistics(self):
+        return {
+            "host": len(self.hostDict),
+            "hostname": len(self.nameOwnerDict),
+            "fragment-write": self.fragmentWriteCount,
+            "reload": self.reloadCount,
+        }
+
+    def begin_batch(self):
+        assert not self.bInBatch
+        self.bInBatch = True
+
+    def end_batch(self):
+        assert self.bInBatch
+        self.bInBatch = False
+        self._flush()
 
     def hostNew(self, id, priority, hostname, address):
-        assert False
+        if id in self.hostDict:
+            raise Exception("host \"%s\" duplicates" % (id))
+
+        hostname = hostname.lower()
+        self.hostDict[id] = (priority, hostname)
+        self.dataFullDict.set_key_value(id, priority, hostname, address)
+        self._hostnameChanged(hostname)
 
     def hostUpdate(self, id, address):
-        assert False
+        assert id in self.hostDict
+        priority, hostname = self.hostDict[id]
+        self.dataFullDict.set_key_value(id, priority, hostname, address)
+        self._hostnameChanged(hostname)
 
     def hostDelete(self, id):
-        assert False
+        assert id in self.hostDict
+        priority, hostname = self.hostDict.pop(id)
+        self.dataFullDict.remove_by_owner(id)
+        self._hostnameChanged(hostname)
+
+    def _hostnameChanged(self, hostname):
+        # the winner may change without the address being changed, so owners are compared too
+        bValueChanged = (hostname in self.dataFullDict.pop_changes())
+        oldOwner = self.nameOwnerDict.get(hostname)
+        newOwner = self.dataFullDict.get_owner(hostname)
+        if newOwner is None:
+            del self.nameOwnerDict[hostname]
+        else:
+            self.nameOwnerDict[hostname] = newOwner
+
+        if oldOwner != newOwner:
+            self.dirtyIdSet |= set([x for x in [oldOwner, newOwner] if x is not None])
+        elif bValueChanged:
+            self.dirtyIdSet.add(newOwner)
+        if not self.bInBatch:
+            self._flush()
+
+    def _flush(self):
+        if not self.isStarted or len(self.dirtyIdSet) == 0:
+            return
+
+        fnList = []
+        for id in self.dirtyIdSet:
+            fn = os.path.join(self.dnsServ.hostsDir, "host-" + urllib.parse.quote(id, safe=""))
+            if id in self.hostDict and self.nameOwnerDict[self.hostDict[id][1]] == id:
+                hostname = self.hostDict[id][1]
+                with open(self.tmpFile, "w") as f:
+                    f.write("%s %s\n" % (self.dataFullDict.get_value(hostname), hostname))
+                os.rename(self.tmpFile, fn)     # atomic
+            else:
+                ByxUtil.forceDelete(fn)
+            fnList.append(fn)
+            self.fragmentWriteCount += 1
+        self.dirtyIdSet = set()
+
+        self.dnsServ.reload_hosts(fnList)
+        self.reloadCount += 1
 
 
 class _Level2DnsServer:
 
     def __init__(self, param):
         self.param = param
-        self.cfgFile = os.path.join(self.param.tmpDir, "l2-dnsmasq.conf")
-        self.pidFile = os.path.join(self.param.tmpDir, "l2-dnsmasq.pid")
 
         self.dnsServerDict = dict()                     # dict<id, (priority, target)>
         self.defaultDnsServerDict = dict()              # dict<id, (priority, target)>
 
-        self.dataFullDict = _IdPriorityKeyValueDict()
+        self.dataFullDict = ByxPriorityDict()
+        self.domainChangeSet = set()                    # domains changed in self.dataFullDict but not in self.domainIndex
+        self.domainIndex = None
+        self.domainIndexPriority = None                 # priority of default nameserver when self.domainIndex is built
+
+        self.hostsDir = os.path.join(self.param.tmpDir, "l2-ntfac-dnsmasq.hosts.d")      # filled by _HostManager
 
         self.dnsPort = None
-        self.dnsmasqProc = None
+        if self.param.dnsBackend == "builtin":
+            self.dnsmasq = ByxDnsForwarder(self.param, "l2-ntfac-dnsmasq")
+        else:
+            self.dnsmasq = ByxDnsmasq(self.param, "l2-ntfac-dnsmasq")
+
+        self.bInBatch = False
+        self.bBatchDirty = False
 
     def start(self):
-        self.dnsPort = ByxUtil.getFreeSocketPort("tcp")
-        self._runDnsmasq()
+        ByxUtil.mkDirAndClear(self.hostsDir)
+        self.dnsmasq.start(self._generateDnsmasqBaseCfg(), self._updateDomainIndex())
+        self.dnsPort = self.dnsmasq.get_port()
 
     def stop(self):
-        if not self._isStarted():
-            return
-        self._stopDnsmasq()
-        self.dnsPort = None
+        if self._isStarted():
+            self.dnsmasq.stop()
+            self.dnsPort = None
+        self.domainIndex = None
+        ByxUtil.forceDelete(self.hostsDir)
+
+    def reload_hosts(self, fileList):
+        if self._isStarted():
+            self.dnsmasq.reload_hosts(fileList)
+
+    def get_statistics(self):
+        return self.dnsmasq.get_statistics()
+
+    def begin_batch(self):
+        assert not self.bInBatch
+        self.bInBatch = True
+
+    def end_batch(self):
+        assert self.bInBatch
+        self.bInBatch = False
+        if self.bBatchDirty:
+            self.bBatchDirty = False
+            self._configChanged()
 
     def nameServerNew(self, id, priority, target, domainList):
         if id in self.dnsServerDict:
@@ -228,51 +1173,56 @@ class _Level2DnsServer:
 
         self.dnsServerDict[id] = (priority, target)
         for domain in domainList:
-            self.dataFullDict.set_priority_key_value(id, priority, domain, target)
-        if self._isStarted():
-            self._stopDnsmasq()
-            self._runDnsmasq()
+            self.dataFullDict.set_key_value(id, priority, domain, target)
+        if self._popDomainChanges():
+            self._configChanged()
 
     def nameServerNewAsDefault(self, id, priority, target):
         if id in self.defaultDnsServerDict:
             raise Exception("default namserver \"%s\" duplicates")
 
         self.defaultDnsServerDict[id] = (priority, target)
-        if self._isStarted():
-            self._stopDnsmasq()
-            self._runDnsmasq()
+        self._configChanged()
 
     def nameServerUpdate(self, id, domainList):
         assert id in self.dnsServerDict
-        self.dataFullDict.remove_by_id(id)
+        self.dataFullDict.remove_by_owner(id)
         for domain in domainList:
-            self.dataFullDict.set_priority_key_value(id, self.dnsServerDict[id][0], domain, self.dnsServerDict[id][1])
-        if self._isStarted():
-            self._stopDnsmasq()
-            self._runDnsmasq()
+            self.dataFullDict.set_key_value(id, self.dnsServerDict[id][0], domain, self.dnsServerDict[id][1])
+        if self._popDomainChanges():
+            self._configChanged()
+
+    def nameServerUpdateDelta(self, id, appendList, removeList):
+        assert id in self.dnsServerDict
+        for domain in removeList:
+            self.dataFullDict.remove_key(id, domain)
+        for domain in appendList:
+            self.dataFullDict.set_key_value(id, self.dnsServerDict[id][0], domain, self.dnsServerDict[id][1])
+        if self._popDomainChanges():
+            self._configChanged()
 
     def nameServerDelete(self, id):
         if id in self.defaultDnsServerDict:
             del self.defaultDnsServerDict[id]
+            self._configChanged()
         elif id in self.dnsServerDict:
-            self.dataFullDict.remove_by_id(id)
+            self.dataFullDict.remove_by_owner(id)
             del self.dnsServerDict[id]
+            if self._popDomainChanges():
+                self._configChanged()
         else:
             assert False
-        if self._isStarted():
-            self._stopDnsmasq()
-            self._runDnsmasq()
 
-    def _runDnsmasq(self):
-        # select default nameserver
+    def _selectDefaultNameServer(self):
         defaultDnsServerPriority = 0
         defaultDnsServerTarget = None
         for id, value in self.defaultDnsServerDict.items():
             if value[0] >= defaultDnsServerPriority:
                 defaultDnsServerPriority = value[0]
                 defaultDnsServerTarget = value[1]
+        return (defaultDnsServerPriority, defaultDnsServerTarget)
 
-        # generate dnsmasq config file
+    def _generateDnsmasqBaseCfg(self):
         buf = ""
         buf += "strict-order\n"
         buf += "bind-interfaces\n"                            # don't listen on 0.0.0.0
@@ -284,31 +1234,53 @@ class _Level2DnsServer:
         buf += "bogus-priv\n"
         buf += "\n"
         buf += "no-hosts\n"
+        buf += "hostsdir=%s\n" % (self.hostsDir)                         # read by inotify, records of changed and deleted files are dropped
         buf += "\n"
         buf += "no-resolv\n"
-        for target in defaultDnsServerTarget:
-            buf += "server=%s\n" % (target.replace(":", "#"))
-        for domain, nsList in self.dataFullDict.get_dict(defaultDnsServerPriority + 1).items():
-            for ns in nsList:
-                buf += "server=/%s/%s\n" % (domain, ns.replace(":", "#"))
         buf += "\n"
-        with open(self.cfgFile, "w") as f:
-            f.write(buf)
-
-        # run dnsmasq process
-        cmd = "/usr/sbin/dnsmasq"
-        cmd += " --keep-in-foreground"
-        cmd += " --port=%d" % (self.dnsPort)
-        cmd += " --conf-file=\"%s\"" % (self.cfgFile)
-        cmd += " --pid-file=%s" % (self.pidFile)
-        self.dnsmasqProc = subprocess.Popen(cmd, shell=True, universal_newlines=True)
-
-    def _stopDnsmasq(self):
-        self.dnsmasqProc.terminate()
-        self.dnsmasqProc.wait()
-        self.dnsmasqProc = None
-        ByxUtil.forceDelete(self.pidFile)
-        ByxUtil.forceDelete(self.cfgFile)
+        return buf
+
+    def _popDomainChanges(self):
+        changeDict = self.dataFullDict.pop_changes()
+        self.domainChangeSet |= changeDict.keys()
+        return len(changeDict) > 0
+
+    def _updateDomainIndex(self):
+        # default nameserver is also in the domain index, so that changing it needs no restart
+        defaultDnsServerPriority, defaultDnsServerTarget = self._selectDefaultNameServer()
+
+        defaultList = []
+        if defaultDnsServerTarget is not None:
+            defaultList = [target.replace(":", "#") for target in defaultDnsServerTarget]
+
+        # domains are filtered by the priority of default nameserver, the index is built again when it changes
+        if self.domainIndex is None or defaultDnsServerPriority != self.domainIndexPriority:
+            domainDict = dict()
+            for domain, nsList in self.dataFullDict.get_dict(defaultDnsServerPriority + 1).items():
+                domainDict[domain] = [ns.replace(":", "#") for ns in nsList]
+            self.domainIndex = ByxDomainIndex(defaultList, domainDict)
+            self.domainIndexPriority = defaultDnsServerPriority
+        else:
+            domainDict = dict()
+            for domain in self.domainChangeSet:
+                nsList = self.dataFullDict.get_value(domain)
+                if nsList is not None and self.dataFullDict.get_priority(domain) > defaultDnsServerPriority:
+                    domainDict[domain] = [ns.replace(":", "#") for ns in nsList]
+                else:
+                    domainDict[domain] = None
+            self.domainIndex.set_default_server_list(defaultList)
+            self.domainIndex.update(domainDict)
+        self.domainChangeSet = set()
+        return self.domainIndex
+
+    def _configChanged(self):
+        if self.bInBatch:
+            self.bBatchDirty = True
+        elif self._isStarted():
+            self._updateDnsmasq()
+
+    def _updateDnsmasq(self):
+        self.dnsmasq.set_config(self._generateDnsmasqBaseCfg(), self._updateDomainIndex())
 
     def _isStarted(self):
         return self.dnsPort is not None
@@ -318,32 +1290,53 @@ class _GatewayManager:
 
     def __init__(self, param):
         self.param = param
+        self.logger = logging.getLogger(self.__module__ + "." + self.__class__.__name__)
 
         self.gatewayDict = dict()               # dict<id, (priority, target)>
         self.defaultGatewayDict = dict()        # dict<id, (priority, target)>
 
-        self.routeFullDict = _IdPriorityKeyValueDict()
-        self.routeDict = dict()                 # dict<prefix, data>
+        self.routeFullDict = ByxPriorityDict()
+        if self.param.routeMode == "fwmark":
+            self.routeTable = ByxFwmarkRouteTable(self.param, self.routeFullDict)
+        else:
+            self.routeTable = ByxRouteTable(self.param, self.routeFullDict)
+        self.defaultRouteTarget = None          # (nexthop, interface), target of the default route, pending if it is not installed
+        self.defaultRoute = None                # (nexthop, oif), default route installed in main table
 
         self.isStarted = False
 
+        self.bInBatch = False
+        self.bBatchDirty = False
+
+        self.param.netlink.add_event_callback(self._onNetlinkEvent)
+
     def start(self):
         self._refreshRoutes()
-        for priority, target in self.defaultGatewayDict.values():
-            self._addGatewayFwRules(target[1])
-        for priority, target in self.gatewayDict.values():
-            self._addGatewayFwRules(target[1])
+        self.param.firewall.add_gateways(self._getGatewayList())
         self.isStarted = True
 
     def stop(self):
-        if not self.isStarted:
-            return
-        self._refreshRoutes()
-        for priority, target in self.defaultGatewayDict.values():
-            self._deleteGatewayFwRules(target[1])
-        for priority, target in self.gatewayDict.values():
-            self._deleteGatewayFwRules(target[1])
-        self.isStarted = False
+        if self.isStarted:
+            self._refreshRoutes()
+            self.param.firewall.remove_gateways(self._getGatewayList())
+            self.isStarted = False
+        self.param.netlink.remove_event_callback(self._onNetlinkEvent)
+        self._setDefaultRoute(None)
+        self.routeTable.dispose()
+
+    def get_statistics(self):
+        return self.routeTable.get_statistics()
+
+    def begin_batch(self):
+        assert not self.bInBatch
+        self.bInBatch = True
+
+    def end_batch(self):
+        assert self.bInBatch
+        self.bInBatch = False
+        if self.bBatchDirty:
+            self.bBatchDirty = False
+            self._refreshRoutes()
 
     def gatewayNew(self, id, priority, target, networkList):
         assert "0.0.0.0/0.0.0.0" not in networkList
@@ -353,42 +1346,62 @@ class _GatewayManager:
 
         # update routes
         for prefix in networkList:
-            self.routeFullDict.set_priority_key_value(id, priority, prefix, target)
-        self._refreshRoutes()
+            self.routeFullDict.set_key_value(id, priority, prefix, target)
+        self._routesChanged()
 
-        # update iptables
+        # update firewall, rules of all gateways are added in start()
         assert target[1] is not None
-        self._addGatewayFwRules(target[1])
+        if self.isStarted:
+            self.param.firewall.add_gateways(set([target[1]]))
 
     def gatewayNewAsDefault(self, id, priority, target):
         # record gateway information
         self.defaultGatewayDict[id] = (priority, target)
 
         # update routes
-        self._refreshRoutes()
+        self._routesChanged()
 
-        # update iptables
+        # update firewall, rules of all gateways are added in start()
         assert target[1] is not None
-        self._addGatewayFwRules(target[1])
+        if self.isStarted:
+            self.param.firewall.add_gateways(set([target[1]]))
 
     def gatewayUpdate(self, id, networkList):
-        # update routes, no need to update iptables
-        self.routeFullDict.remove_by_id(id)
+        # update routes, no need to update firewall
+        self.routeFullDict.remove_by_owner(id)
         for prefix in networkList:
-            self.routeFullDict.set_priority_key_value(id, self.gatewayDict[id][0], prefix, self.gatewayDict[id][1])
-        self._refreshRoutes()
+            self.routeFullDict.set_key_value(id, self.gatewayDict[id][0], prefix, self.gatewayDict[id][1])
+        self._routesChanged()
+
+    def gatewayUpdateDelta(self, id, appendList, removeList):
+        assert "0.0.0.0/0.0.0.0" not in appendList
+
+        # update routes, no need to update firewall
+        for prefix in removeList:
+            self.routeFullDict.remove_key(id, prefix)
+        for prefix in appendList:
+            self.routeFullDict.set_key_value(id, self.gatewayDict[id][0], prefix, self.gatewayDict[id][1])
+        self._routesChanged()
 
     def gatewayDelete(self, id):
         if id in self.defaultGatewayDict:
-            self._refreshRoutes()
-            self._deleteGatewayFwRules(self.defaultGatewayDict[id][1])
+            self._routesChanged()
+            if self.isStarted:
+                self.param.firewall.remove_gateways(set([self.defaultGatewayDict[id][1][1]]))
             del self.defaultGatewayDict[id]
         else:
-            self.routeFullDict.remove_by_id(id)
-            self._refreshRoutes()
-            self._deleteGatewayFwRules(self.gatewayDict[id][1])
+            self.routeFullDict.remove_by_owner(id)
+            self._routesChanged()
+            if self.isStarted:
+                self.param.firewall.remove_gateways(set([self.gatewayDict[id][1][1]]))
             del self.gatewayDict[id]
 
+    def _routesChanged(self):
+        if self.bInBatch:
+            self.bBatchDirty = True
+        else:
+            self._refreshRoutes()
+
     def _refreshRoutes(self):
         # select default gateway
         defaultGatewayPriority = 0
@@ -398,148 +1411,126 @@ class _GatewayManager:
                 defaultGatewayPriority = value[0]
                 defaultGatewayTarget = value[1]
 
-        if defaultGatewayTarget is not None:
-            with pyroute2.IPRoute() as ipp:
-                try:
-                    ipp.route("del", dst=_Helper.prefixConvert("0.0.0.0/0.0.0.0"))
-                except pyroute2.netlink.exceptions.NetlinkError as e:
-                    if e.code == 3:     # message: No such process
-                        pass            # route does not exist, ignore
-                    else:
-                        raise
-        else:
-            pass
-
-        newRouteDict = self.routeFullDict.get_dict()
-        with pyroute2.IPRoute() as ipp:
-            # remove routes
-            for prefix in self.routeDict:
-                if prefix not in newRouteDict:
-                    try:
-                        ipp.route("del", dst=_Helper.prefixConvert(prefix))
-                    except pyroute2.netlink.exceptions.NetlinkError as e:
-                        if e.code == 3:     # message: No such process
-                            pass            # route does not exist, ignore
-                        else:
-                            raise
-
-            # add or change routes
-            for prefix, data in list(newRouteDict.items()):
-                nexthop, interface = data
-                if interface is not None:
-                    idx_list = ipp.link_lookup(ifname=interface)
-                    if idx_list == []:
-                        del newRouteDict[prefix]
-                        continue
-                    assert len(idx_list) == 1
-                    idx = idx_list[0]
-                try:
-                    if prefix not in self.routeDict:                                    # add
-                        if nexthop is not None and interface is not None:
-                            ipp.route("add", dst=_Helper.prefixConvert(prefix), gateway=nexthop, oif=idx)
-                        elif nexthop is not None and interface is None:
-                            ipp.route("add", dst=_Helper.prefixConvert(prefix), gateway=nexthop)
-                        elif nexthop is None and interface is not None:
-                            ipp.route("add", dst=_Helper.prefixConvert(prefix), oif=idx)
-                        else:
-                            assert False
-                    else:                                                               # change
-                        pass        # fixme
-                except pyroute2.netlink.exceptions.NetlinkError as e:
-                    if e.code == 17:                    # message: File exists
-                        del newRouteDict[prefix]        # route already exists, retry in next cycle
-                    elif e.code == 101:                 # message: Network is unreachable
-                        del newRouteDict[prefix]        # nexthop is invalid, retry in next cycle
-                    else:
-                        raise
-        self.routeDict = newRouteDict
-
-    def _addGatewayFwRules(self, interface):
-        filterTable = iptc.Table(iptc.Table.FILTER)
-        natTable = iptc.Table(iptc.Table.NAT)
-        for rule in self.__generateGatewayFwRulesFilterInputChain(interface):
-            iptc.Chain(filterTable, "INPUT").append_rule(rule)
-        for rule in self.__generateGatewayFwRulesNatPostChain(interface):
-            iptc.Chain(natTable, "POSTROUTING").append_rule(rule)
-
-    def _deleteGatewayFwRules(self, interface):
-        filterTable = iptc.Table(iptc.Table.FILTER)
-        natTable = iptc.Table(iptc.Table.NAT)
-        for rule in self.__generateGatewayFwRulesFilterInputChain(interface):
-            iptc.Chain(filterTable, "INPUT").delete_rule(rule)
-        for rule in self.__generateGatewayFwRulesNatPostChain(interface):
-            iptc.Chain(natTable, "POSTROUTING").delete_rule(rule)
-
-    def __generateGatewayFwRulesFilterInputChain(self, gateway):
+        self._setDefaultRoute(defaultGatewayTarget)
+        self.routeTable.refresh()
+
+    def _setDefaultRoute(self, target):
+        # the default route is replaced in place, so when the group is taken over by another connection
+        # there's no moment without default route, and no moment with both.
+        # it is pending if it can't be installed, and retried on netlink events, the same as ByxRouteTable.
+        self.defaultRouteTarget = target
+        if target is not None:
+            nexthop, interface = target
+            idx = self.param.netlink.get_ifindex(interface)
+            if idx is None:
+                return
+            if (nexthop, idx) == self.defaultRoute:
+                return
+            err = self.param.netlink.route_batch([("replace", "0.0.0.0/0", nexthop, idx)])[0]
+            if err != 0:
+                if err != 101:                  # message: Network is unreachable
+                    self.logger.error("Failed to set default route to %s, error %d." % (str(target), err))
+                return
+            self.defaultRoute = (nexthop, idx)
+        elif self.defaultRoute is not None:
+            nexthop, idx = self.defaultRoute
+            err = self.param.netlink.route_batch([("del", "0.0.0.0/0", nexthop, idx)])[0]
+            if err == 0:
+                pass
+            elif err in [3, 19]:        # message: No such process, No such device
+                pass                    # route does not exist, ignore
+            else:
+                raise pyroute2.netlink.exceptions.NetlinkError(err)
+            self.defaultRoute = None
+
+    def _onNetlinkEvent(self, msg):
+        if msg["event"] in ["RTM_NEWLINK", "RTM_NEWADDR"]:
+            # interface or address appears, pending default route may be installable now
+            if self.defaultRouteTarget is not None:
+                self._setDefaultRoute(self.defaultRouteTarget)
+        elif msg["event"] == "RTM_DELROUTE":
+            if msg["table"] != 254 or msg["dst_len"] != 0 or self.defaultRoute is None:
+                return
+            if msg.get_attr("RTA_OIF") != self.defaultRoute[1]:
+                return
+            # deleted by others or with its interface, re-install it
+            self.defaultRoute = None
+            self._setDefaultRoute(self.defaultRouteTarget)
+
+    def _getGatewayList(self):
+        # gateways are reference counted by the firewall, so the same interface may appear more than once
         ret = []
-
-        rule = iptc.Rule()
-        rule.in_interface = gateway
-        rule.protocol = "icmp"
-        rule.create_target("ACCEPT")
-        ret.append(rule)
-
-        rule = iptc.Rule()
-        rule.in_interface = gateway
-        match = iptc.Match(rule, "state")
-        match.state = "ESTABLISHED,RELATED"
-        rule.add_match(match)
-        rule.create_target("ACCEPT")
-        ret.append(rule)
-
-        rule = iptc.Rule()
-        rule.in_interface = gateway
-        rule.create_target("DROP")
-        ret.append(rule)
-
+        for priority, target in self.defaultGatewayDict.values():
+            ret.append(target[1])
+        for priority, target in self.gatewayDict.values():
+            ret.append(target[1])
         return ret
 
-    def __generateGatewayFwRulesNatPostChain(self, gateway):
-        rule = iptc.Rule()
-        rule.out_interface = gateway
-        rule.create_target("MASQUERADE")
-        return [rule]
-
-
-class _IdPriorityKeyValueDict:
-
-    def __init__(self):
-        self.dictImpl = dict()
-
-    def set_priority_key_value(self, id, priority, key, value):
-        assert 0 <= priority <= 100
-        if key not in self.dictImpl:
-            self.dictImpl[key] = dict()
-        if priority not in self.dictImpl[key]:
-            self.dictImpl[key][priority] = dict()
-        self.dictImpl[key][priority][id] = value
-
-    def remove_by_id(self, id):
-        ret = set()
-        for key in list(self.dictImpl.keys()):
-            for priority in list(self.dictImpl[key].keys()):
-                if id in self.dictImpl[key][priority]:
-                    del self.dictImpl[key][priority][id]
-                    ret.add(key)
-                    if len(self.dictImpl[key][priority]) == 0:
-                        del self.dictImpl[key][priority]
-                        if len(self.dictImpl[key]) == 0:
-                            del self.dictImpl[key]
-        return ret
 
-    def get_dict(self, min_priority=0):
-        ret = dict()
-        for key, data in self.dictImpl.items():
-            priority = sorted(list(data.keys()))[0]
-            if priority >= min_priority:
-                id = sorted(list(data[priority].keys()))[0]
-                ret[key] = data[priority][id]
+class _Helper:
+
+    @staticmethod
+    def applyListDelta(itemList, appendList, removeList):
+        removeSet = set(removeList)
+        ret = [x for x in itemList if x not in removeSet]
+        itemSet = set(ret)
+        for x in appendList:
+            if x not in itemSet:
+                ret.append(x)
+                itemSet.add(x)
         return ret
 
+    @staticmethod
+    def openListFile(fn):
+        # the file is written by the facility, it may be a symlink to a file the facility can't read,
+        # or a fifo which blocks the reader
+        fd = os.open(fn, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK | os.O_CLOEXEC)
+        try:
+            if not stat.S_ISREG(os.fstat(fd).st_mode):
+                raise Exception("\"%s\" is not a regular file" % (fn))
+            return open(fd, "r", encoding="utf-8")
+        except BaseException:
+            os.close(fd)
+            raise
 
-class _Helper:
+    @staticmethod
+    def mergeUpdate(oldData, newData):
+        """Returns the update message data which has the effect of oldData followed by newData"""
+
+        ret = dict(oldData)
+        for key, value in newData.items():
+            if not key.startswith("domain-list") and not key.startswith("network-list"):
+                ret[key] = value
+        for key in ["domain-list", "network-list"]:
+            appendList = newData.get(key + "-append", [])
+            removeList = newData.get(key + "-remove", [])
+            if key in newData:
+                ret.pop(key + "-append", None)
+                ret.pop(key + "-remove", None)
+                ret[key] = newData[key]
+            elif key + "-append" not in newData and key + "-remove" not in newData:
+                pass
+            elif key in ret:
+                ret[key] = _Helper.applyListDelta(ret[key], appendList, removeList)
+            else:
+                # items appended before but removed now are dropped, removed items accumulate
+                ret[key + "-append"] = _Helper.applyListDelta(ret.get(key + "-append", []), appendList, removeList)
+                ret[key + "-remove"] = _Helper.applyListDelta(ret.get(key + "-remove", []), removeList, [])
+        return ret
 
     @staticmethod
-    def prefixConvert(prefix):
-        tl = prefix.split("/")
-        return tl[0] + "/" + str(ByxUtil.ipMaskToLen(tl[1]))
+    def entityDelta(type, oldData, newData):
+        """Returns the update message data which changes oldData to newData, None if it can't be updated in place"""
+
+        if type == "host":
+            if oldData["hostname"] == newData["hostname"]:
+                return {"address": newData["address"]}
+        elif type in ["nameserver", "gateway"]:
+            key = "domain-list" if type == "nameserver" else "network-list"
+            if oldData["target"] == newData["target"]:
+                oldSet, newSet = set(oldData[key]), set(newData[key])
+                return {
+                    key + "-append": [x for x in newData[key] if x not in oldSet],
+                    key + "-remove": [x for x in oldData[key] if x not in newSet],
+                }
+        return None
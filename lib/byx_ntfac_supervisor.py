@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import time
+import signal
+import logging
+import threading
+from gi.repository import Gio
+from gi.repository import GLib
+from byx_util import ByxUtil
+
+
+class ByxNtfacSupervisor:
+
+    # runs the processes of network traffic facilities:
+    #   1. all the facilities are spawned at once. facilities with "ready-notify" in ntfac.ini are
+    #      ready when they send the "ready" message, the others are ready when spawned
+    #   2. all the facilities get SIGTERM at once, the ones still running after TERM_TIMEOUT get SIGKILL
+    #   3. a facility which exits by itself is restarted after a delay, the delay doubles on every
+    #      exit, and is reset when the facility has run for STABLE_TIME
+    #
+    # wait_ready() blocks, it must be called in the activation thread, not in the main loop, which
+    # reports readiness. cancel_wait_ready() makes it return at once.
+
+    READY_TIMEOUT = 10                  # seconds
+    TERM_TIMEOUT = 3                    # seconds
+    RESTART_DELAY = 1000                # milliseconds, delay of the first restart
+    RESTART_DELAY_MAX = 60000           # milliseconds
+    STABLE_TIME = 60                    # seconds
+
+    def __init__(self, ntfacDict, startCallback, exitCallback):
+        self.ntfacDict = ntfacDict              # dict<ntfac-name, ntfac-info>, ntfac-info has execPath, paramList, runDir and bReadyNotify
+        self.startCallback = startCallback      # startCallback(ntfac-name, Gio.Subprocess), called after every spawn
+        self.exitCallback = exitCallback        # exitCallback(ntfac-name), called when a facility exits by itself
+        self.logger = logging.getLogger(self.__module__ + "." + self.__class__.__name__)
+
+        self.procDict = dict()                  # dict<ntfac-name, _ProcInfo>
+        for ntfacName in self.ntfacDict:
+            self.procDict[ntfacName] = _ProcInfo(self.RESTART_DELAY)
+        self.readyCond = threading.Condition()
+        self.bWaitCancelled = False
+        self.bStopping = False
+
+    def start(self):
+        for ntfacName in self.ntfacDict:
+            self._spawn(ntfacName)
+
+    def wait_ready(self, timeout=None):
+        """Returns the names of facilities not ready when timeout"""
+
+        if timeout is None:
+            timeout = self.READY_TIMEOUT
+        with self.readyCond:
+            self.readyCond.wait_for(lambda: self.bWaitCancelled or all([x.readyTime is not None for x in self.procDict.values()]), timeout)
+            return [k for k, v in self.procDict.items() if v.readyTime is None]
+
+    def cancel_wait_ready(self):
+        # wait_ready() returns at once, now and later
+        with self.readyCond:
+            self.bWaitCancelled = True
+            self.readyCond.notify_all()
+
+    def is_wait_cancelled(self):
+        return self.bWaitCancelled
+
+    def set_ready(self, ntfacName):
+        p = self.procDict[ntfacName]
+        with self.readyCond:
+            if p.proc is None or p.readyTime is not None:
+                return
+            p.readyTime = time.monotonic()
+            p.startLatency = p.readyTime - p.spawnTime
+            self.readyCond.notify_all()
+        self.logger.info("Network traffic facility %s is ready in %.3f seconds." % (ntfacName, p.startLatency))
+
+    def stop(self):
+        self.bStopping = True
+
+        runList = []
+        for ntfacName, p in self.procDict.items():
+            if p.restartTimer is not None:
+                GLib.source_remove(p.restartTimer)
+                p.restartTimer = None
+            if p.proc is not None:
+                runList.append((ntfacName, p.proc))
+                p.proc.send_signal(signal.SIGTERM)
+                p.proc = None
+
+        # they are terminating concurrently, so the total time is bounded by TERM_TIMEOUT
+        deadline = time.monotonic() + self.TERM_TIMEOUT
+        for ntfacName, proc in runList:
+            if self.__waitUntil(proc, deadline):
+                self.logger.info("Network traffic facility %s terminated." % (ntfacName))
+            else:
+                proc.force_exit()
+                proc.wait(None)
+                self.logger.warning("Network traffic facility %s killed." % (ntfacName))
+
+    def get_statistics(self):
+        ret = dict()
+        for ntfacName, p in self.procDict.items():
+            ret[ntfacName] = {
+                "running": p.proc is not None,
+                "ready": p.readyTime is not None,
+                "start-latency": int(p.startLatency * 1000) if p.startLatency is not None else None,       # milliseconds
+                "restart": p.restartCount,
+            }
+        return ret
+
+    def _spawn(self, ntfacName):
+        ntfacInfo = self.ntfacDict[ntfacName]
+        p = self.procDict[ntfacName]
+
+        # files left by the previous run are not referenced by anyone
+        ByxUtil.forceDelete(ntfacInfo.runDir)
+        ByxUtil.ensureDir(ntfacInfo.runDir)
+
+        flags = Gio.SubprocessFlags.STDIN_PIPE | Gio.SubprocessFlags.STDOUT_PIPE | Gio.SubprocessFlags.STDERR_PIPE
+        proc = Gio.Subprocess.new([ntfacInfo.execPath] + ntfacInfo.paramList, flags)
+        with self.readyCond:
+            p.proc = proc
+            p.spawnTime = time.monotonic()
+            p.readyTime = None
+
+        stderr = Gio.DataInputStream.new(proc.get_stderr_pipe())
+        stderr.read_line_async(GLib.PRIORITY_DEFAULT, None, self._onStderr, ntfacName)
+        proc.wait_async(None, self._onExit, (ntfacName, proc))
+        self.logger.info("Network traffic facility %s started." % (ntfacName))
+
+        self.startCallback(ntfacName, proc)
+        if not ntfacInfo.bReadyNotify:
+            self.set_ready(ntfacName)
+
+    def _onExit(self, source_object, res, data):
+        ntfacName, proc = data
+        try:
+            proc.wait_finish(res)
+        except GLib.Error:
+            pass
+
+        p = self.procDict[ntfacName]
+        if self.bStopping or p.proc is not proc:
+            return                              # terminated by us
+
+        try:
+            with self.readyCond:
+                p.proc = None
+                p.readyTime = None
+            if proc.get_if_signaled():
+                self.logger.error("Network traffic facility %s killed by signal %d." % (ntfacName, proc.get_term_sig()))
+            else:
+                self.logger.error("Network traffic facility %s exited with status %d." % (ntfacName, proc.get_exit_status()))
+
+            self.exitCallback(ntfacName)
+        except Exception:
+            self.logger.error("Error occured in process exit callback", exc_info=True)
+
+        if time.monotonic() - p.spawnTime >= self.STABLE_TIME:
+            p.restartDelay = self.RESTART_DELAY
+        p.restartTimer = GLib.timeout_add(p.restartDelay, self._restartTimeoutCallback, ntfacName)
+        self.logger.info("Network traffic facility %s will be restarted in %d milliseconds." % (ntfacName, p.restartDelay))
+        p.restartDelay = min(p.restartDelay * 2, self.RESTART_DELAY_MAX)
+
+    def _restartTimeoutCallback(self, ntfacName):
+        p = self.procDict[ntfacName]
+        p.restartTimer = None
+        p.restartCount += 1
+        try:
+            self._spawn(ntfacName)
+        except Exception:
+            self.logger.error("Failed to restart network traffic facility %s." % (ntfacName), exc_info=True)
+            p.restartTimer = GLib.timeout_add(p.restartDelay, self._restartTimeoutCallback, ntfacName)
+            p.restartDelay = min(p.restartDelay * 2, self.RESTART_DELAY_MAX)
+        return False
+
+    def _onStderr(self, source_object, res, ntfacName):
+        try:
+            line, length = source_object.read_line_finish_utf8(res)
+        except GLib.Error:
+            return
+        if line is None:
+            return                              # process exited
+        self.logger.warning("Network traffic facility %s: %s" % (ntfacName, line))
+        source_object.read_line_async(GLib.PRIORITY_DEFAULT, None, self._onStderr, ntfacName)
+
+    def __waitUntil(self, proc, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return proc.get_identifier() is None
+        cancellable = Gio.Cancellable()
+        timer = threading.Timer(remaining, cancellable.cancel)
+        timer.start()
+        try:
+            proc.wait(cancellable)
+            return True
+        except GLib.Error:
+            return False                        # cancelled
+        finally:
+            timer.cancel()
+
+
+class _ProcInfo:
+
+    def __init__(self, restartDelay):
+        self.proc = None
+        self.spawnTime = None
+        self.readyTime = None
+        self.startLatency = None                # seconds, from spawn to ready, of the last start
+        self.restartDelay = restartDelay        # milliseconds
+        self.restartTimer = None
+        self.restartCount = 0
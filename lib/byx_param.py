@@ -20,18 +20,30 @@ class ByxParam:
         self.etcDir = "/etc/bombyx"
         self.etcConnectionDir = os.path.join(self.etcDir, "connections")
         self.etcNtfacDir = os.path.join(self.etcDir, "ntfacs")
+        self.runNtfacDir = os.path.join(self.runDir, "ntfacs")            # runtime directories of ntfacs
 
         self.ownResolvConf = os.path.join(self.tmpDir, "resolv.conf")
         self.pidFile = os.path.join(self.runDir, "bombyx.pid")
         self.logLevel = None
         self.abortOnError = False
+        self.firewallBackend = "iptables"          # "iptables" or "nftables"
+
+        self.ntfacBatchWindow = 0                   # milliseconds, 0 means only coalesce messages already buffered
+        self.dnsBackend = "dnsmasq"                 # "dnsmasq" or "builtin"
+        self.routeMode = "route"                    # "route": one kernel route per prefix, "fwmark": nftables map and policy routing
+        self.routeAggregation = True                # aggregate adjacent and covered prefixes before installing routes
+        self.switchMode = "break-before-make"       # "break-before-make" or "make-before-break": switch to a better connection after it's activated and verified
+        self.standbyMode = "off"                    # "off", "auto": keep a standby connection except time billed ones, "always"
 
         self.callingPointManager = None
         self.pluginManager = None
+        self.portAllocator = None
 
         self.dbusMainObject = None
         self.dbusIpForwardObject = None
         self.config = None
+        self.netlink = None
+        self.firewall = None
         self.trafficManager = None
         self.connectionManager = None
         self.daemon = None
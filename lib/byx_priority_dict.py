@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import bisect
+
+
+class ByxPriorityDict:
+
+    # key-value store where several owners (tfac group names, ntfac entity ids) can set
+    # a value for the same key, the value with the lowest priority number wins, ties are
+    # broken by owner name.
+    #
+    # the winning value of every key is kept up to date, so that:
+    #   1. removing an owner costs O(keys of this owner)
+    #   2. pop_changes() returns only the keys whose winner changed, the winner is the pair of
+    #      priority and value, so that users filtering by priority (get_dict(min_priority))
+    #      see a key whose priority crosses their threshold although its value is unchanged
+
+    def __init__(self):
+        self.keyDict = dict()               # dict<key, (list<(priority, owner)>, dict<owner, value>)>, list is sorted
+        self.ownerDict = dict()             # dict<owner, set<key>>
+        self.winnerDict = dict()            # dict<key, (priority, value)>
+        self.changeDict = dict()            # dict<key, old-winner>, old winner is _NOVALUE if key did not exist
+
+    def __len__(self):
+        return len(self.winnerDict)
+
+    def __contains__(self, key):
+        return key in self.winnerDict
+
+    def set_key_value(self, owner, priority, key, value):
+        if key not in self.keyDict:
+            self.keyDict[key] = ([], dict())
+        orderList, valueDict = self.keyDict[key]
+
+        if owner in valueDict:
+            orderList.remove(self._findOrderItem(orderList, owner))
+        bisect.insort(orderList, (priority, owner))
+        valueDict[owner] = value
+        self.ownerDict.setdefault(owner, set()).add(key)
+
+        self._updateWinner(key)
+
+    def remove_key(self, owner, key):
+        keySet = self.ownerDict.get(owner)
+        if keySet is None or key not in keySet:
+            return
+        keySet.remove(key)
+        if len(keySet) == 0:
+            del self.ownerDict[owner]
+        self._removeOwnerKey(owner, key)
+
+    def remove_by_owner(self, owner):
+        ret = self.ownerDict.pop(owner, set())
+        for key in ret:
+            self._removeOwnerKey(owner, key)
+        return ret
+
+    def get_keys_by_owner(self, owner):
+        return self.ownerDict.get(owner, set())
+
+    def get_value(self, key, default=None):
+        if key in self.winnerDict:
+            return self.winnerDict[key][1]
+        return default
+
+    def get_priority(self, key, default=None):
+        if key in self.winnerDict:
+            return self.winnerDict[key][0]
+        return default
+
+    def get_owner(self, key):
+        # owner of the winning value
+        if key in self.keyDict:
+            return self.keyDict[key][0][0][1]
+        return None
+
+    def get_dict(self, min_priority=0):
+        if min_priority <= 0:
+            return {k: v[1] for k, v in self.winnerDict.items()}
+        return {k: v[1] for k, v in self.winnerDict.items() if v[0] >= min_priority}
+
+    def has_changes(self):
+        return len(self.changeDict) > 0
+
+    def pop_changes(self):
+        """Returns dict<key, new-value>, new-value is None if key is removed"""
+
+        ret = dict()
+        for key, oldWinner in self.changeDict.items():
+            if key in self.winnerDict:
+                newWinner = self.winnerDict[key]
+                if oldWinner is _NOVALUE or newWinner != oldWinner:
+                    ret[key] = newWinner[1]
+            else:
+                if oldWinner is not _NOVALUE:
+                    ret[key] = None
+        self.changeDict = dict()
+        return ret
+
+    def _removeOwnerKey(self, owner, key):
+        orderList, valueDict = self.keyDict[key]
+        orderList.remove(self._findOrderItem(orderList, owner))
+        del valueDict[owner]
+        if len(orderList) == 0:
+            del self.keyDict[key]
+        self._updateWinner(key)
+
+    def _findOrderItem(self, orderList, owner):
+        for item in orderList:
+            if item[1] == owner:
+                return item
+        assert False
+
+    def _updateWinner(self, key):
+        if key in self.keyDict:
+            orderList, valueDict = self.keyDict[key]
+            priority, owner = orderList[0]
+            newWinner = (priority, valueDict[owner])
+        else:
+            newWinner = None
+
+        oldWinner = self.winnerDict.get(key)
+        if newWinner == oldWinner:
+            return
+
+        if key not in self.changeDict:
+            self.changeDict[key] = oldWinner if oldWinner is not None else _NOVALUE
+        if newWinner is not None:
+            self.winnerDict[key] = newWinner
+        else:
+            del self.winnerDict[key]
+
+
+_NOVALUE = object()
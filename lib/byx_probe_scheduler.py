@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import time
+import logging
+import collections
+import concurrent.futures
+from gi.repository import GLib
+
+
+class ByxProbeScheduler:
+
+    # availability tests (plugin.trigger_available_test()) of all the connections:
+    #   1. tests run on a bounded worker pool, never in main loop
+    #   2. connections whose plugins share a key are tested in one task, one after another, so a
+    #      device scans once per round instead of once for every connection concurrently, the
+    #      tests after the first one use the scan result cached by the device. the key is the
+    #      network type, a plugin can have property "available_test_share_key" to override it
+    #   3. a connection with a result younger than TTL is not tested again, the result is the
+    #      end of its last test, or a report of its plugin through the availability callbacks
+    #   4. a round runs every PROBE_INTERVAL, and LINK_EVENT_DELAY after a link is added or removed
+    #      or its carrier changes, which ignores TTL. the other RTM_NEWLINK messages, such as flag
+    #      changes and the wireless events emitted by scans, are ignored, or scans would trigger themselves
+    #
+    # all the methods must be called in main loop, workers report back through GLib.idle_add().
+
+    WORKER_COUNT = 4
+    TTL = 60                            # seconds
+    PROBE_INTERVAL = 30                 # seconds
+    LINK_EVENT_DELAY = 1000             # milliseconds, link events in this window trigger one round
+    LATENCY_SAMPLE_COUNT = 100
+    IFF_LOWER_UP = 0x10000              # carrier flag of a link
+
+    def __init__(self, param, connList):
+        self.param = param
+        self.connList = connList                # list<_Connection>, owned by connection manager
+        self.logger = logging.getLogger(self.__module__ + "." + self.__class__.__name__)
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.WORKER_COUNT)
+        self.resultTimeDict = dict()            # dict<connection-id, time>
+        self.runningKeySet = set()              # set<share-key>, tasks submitted and not finished
+
+        self.probeCount = 0
+        self.hitCount = 0                       # tests saved by fresh results or running tasks
+        self.failCount = 0
+        self.latencyList = collections.deque(maxlen=self.LATENCY_SAMPLE_COUNT)     # seconds
+        self.maxLatency = None
+
+        self.linkCarrierDict = dict()           # dict<ifindex, bool>, carrier of every link
+        for msg in self.param.netlink.get_links():
+            self.linkCarrierDict[msg["index"]] = bool(msg["flags"] & self.IFF_LOWER_UP)
+
+        self.linkTimer = None
+        self.probeTimer = GLib.timeout_add_seconds(self.PROBE_INTERVAL, self._probeTimerCallback)
+        self.param.netlink.add_event_callback(self._onNetlinkEvent)
+
+    def dispose(self):
+        self.param.netlink.remove_event_callback(self._onNetlinkEvent)
+        GLib.source_remove(self.probeTimer)
+        if self.linkTimer is not None:
+            GLib.source_remove(self.linkTimer)
+            self.linkTimer = None
+        self.executor.shutdown(wait=True)       # reports of the running tasks are dropped with main loop
+
+    def probe(self, bForce=False):
+        now = time.monotonic()
+        taskDict = collections.OrderedDict()    # dict<share-key, list<_Connection>>
+        for conn in self.connList:
+            if not bForce and now - self.resultTimeDict.get(conn.id, -self.TTL) < self.TTL:
+                self.hitCount += 1
+                continue
+            key = self._getShareKey(conn)
+            if key in self.runningKeySet:
+                self.hitCount += 1              # it's being tested
+                continue
+            taskDict.setdefault(key, []).append(conn)
+
+        for key, connList in taskDict.items():
+            self.runningKeySet.add(key)
+            self.executor.submit(self._probeTask, key, connList)
+
+    def on_result(self, conn):
+        # called when plugin reports availability by itself
+        self.resultTimeDict[conn.id] = time.monotonic()
+
+    def get_statistics(self):
+        return {
+            "probe": self.probeCount,
+            "hit": self.hitCount,
+            "hit-rate": self.hitCount / (self.hitCount + self.probeCount) if self.hitCount + self.probeCount > 0 else None,
+            "fail": self.failCount,
+            "running": len(self.runningKeySet),
+            "latency-avg": int(sum(self.latencyList) / len(self.latencyList) * 1000) if len(self.latencyList) > 0 else None,     # milliseconds
+            "latency-max": int(self.maxLatency * 1000) if self.maxLatency is not None else None,                               # milliseconds
+        }
+
+    def _getShareKey(self, conn):
+        try:
+            key = conn.plugin.available_test_share_key
+        except AttributeError:
+            key = None
+        if key is None:
+            key = conn.networkType
+        return key
+
+    def _probeTask(self, key, connList):
+        # runs in worker thread
+        resultList = []                         # list<(_Connection, latency, bSuccess)>
+        for conn in connList:
+            startTime = time.monotonic()
+            bSuccess = True
+            try:
+                conn.plugin.trigger_available_test()
+            except Exception:
+                self.logger.error("Availability test of connection %s failed." % (conn.id), exc_info=True)
+                bSuccess = False
+            resultList.append((conn, time.monotonic() - startTime, bSuccess))
+        GLib.idle_add(self._onProbeDone, key, resultList)
+
+    def _onProbeDone(self, key, resultList):
+        self.runningKeySet.discard(key)
+        now = time.monotonic()
+        for conn, latency, bSuccess in resultList:
+            self.probeCount += 1
+            if not bSuccess:
+                self.failCount += 1
+                continue
+            self.resultTimeDict[conn.id] = now
+            self.latencyList.append(latency)
+            if self.maxLatency is None or latency > self.maxLatency:
+                self.maxLatency = latency
+        return False
+
+    def _probeTimerCallback(self):
+        try:
+            self.probe()
+        except Exception:
+            self.logger.error("Error occured in probe timer callback", exc_info=True)
+        return True
+
+    def _linkTimerCallback(self):
+        self.linkTimer = None
+        try:
+            self.probe(bForce=True)
+        except Exception:
+            self.logger.error("Error occured in link timer callback", exc_info=True)
+        return False
+
+    def _onNetlinkEvent(self, msg):
+        if msg["event"] == "RTM_NEWLINK":
+            carrier = bool(msg["flags"] & self.IFF_LOWER_UP)
+            if self.linkCarrierDict.get(msg["index"]) == carrier:
+                return                                  # not a new link, carrier not changed
+            self.linkCarrierDict[msg["index"]] = carrier
+        elif msg["event"] == "RTM_DELLINK":
+            if self.linkCarrierDict.pop(msg["index"], None) is None:
+                return
+        else:
+            return
+        if self.linkTimer is None:
+            self.linkTimer = GLib.timeout_add(self.LINK_EVENT_DELAY, self._linkTimerCallback)
@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import socket
+import struct
+from byx_util import ByxUtil
+
+
+class ByxRouteAggregator:
+
+    # aggregates the winning routes of a ByxPriorityDict<prefix, (nexthop, interface)> before they are
+    # installed into kernel:
+    #   1. a prefix covered by a less specific prefix with the same route is dropped
+    #   2. sibling prefixes with the same route are merged into their parent prefix
+    # the forwarding result of every address covered by our routes is not changed.
+    #
+    # prefixes are stored in a path-compressed binary trie of integer-encoded prefixes, every node
+    # caches its result, only the nodes on the path of a changed prefix are recomputed.
+    #
+    # it has the same pop_changes() and get_value() as ByxPriorityDict, so it can be used by ByxRouteTable directly.
+
+    def __init__(self, srcDict):
+        self.srcDict = srcDict
+        self.root = _Node(0, 0)
+        self.nodeDict = dict()              # dict<prefix, node>, nodes of source prefixes
+        self.outputDict = dict()            # dict<prefix, data>, aggregated routes
+        self.changeDict = dict()            # dict<prefix, old-data>, old data is _NOVALUE if prefix did not exist
+
+    def get_value(self, prefix, default=None):
+        return self.outputDict.get(prefix, default)
+
+    def get_dict(self):
+        return dict(self.outputDict)
+
+    def pop_changes(self):
+        """Returns dict<prefix, new-data>, new-data is None if prefix is removed"""
+
+        srcChanges = self.srcDict.pop_changes()
+        for prefix, data in srcChanges.items():
+            if data is not None:
+                self._trieSet(prefix, data)
+            else:
+                self._trieRemove(prefix)
+        if len(srcChanges) > 0:
+            self._calcUniform(self.root, None)
+            self._calcOutput(self.root, None, False)
+
+        ret = dict()
+        for prefix, oldData in self.changeDict.items():
+            if prefix in self.outputDict:
+                if oldData is _NOVALUE or self.outputDict[prefix] != oldData:
+                    ret[prefix] = self.outputDict[prefix]
+            else:
+                if oldData is not _NOVALUE:
+                    ret[prefix] = None
+        self.changeDict = dict()
+        return ret
+
+    def get_statistics(self):
+        return {
+            "before": len(self.nodeDict),
+            "after": len(self.outputDict),
+        }
+
+    def _trieSet(self, prefix, data):
+        if prefix in self.nodeDict:
+            node = self.nodeDict[prefix]
+        else:
+            net, plen = _Helper.prefixToInt(prefix)
+            node = self._trieInsert(net, plen)
+            self.nodeDict[prefix] = node
+        node.present = True
+        node.data = data
+        self._markDirty(node)
+
+    def _trieRemove(self, prefix):
+        node = self.nodeDict.pop(prefix)
+        node.present = False
+        node.data = None
+        parent = self._trieCompact(node)
+        self._markDirty(parent)
+
+    def _trieInsert(self, net, plen):
+        node = self.root
+        while True:
+            if node.net == net and node.plen == plen:
+                return node
+            bit = _Helper.getBit(net, node.plen)
+            child = node.child[bit]
+
+            if child is None:
+                newNode = _Node(net, plen)
+                self._attach(node, bit, newNode)
+                return newNode
+
+            common = min(_Helper.commonLen(net, child.net), plen, child.plen)
+            if common == child.plen:
+                node = child                                    # child is prefix of the new one, go down
+                continue
+
+            if common == plen:
+                newNode = _Node(net, plen)                      # new one is prefix of child, insert between
+            else:
+                newNode = _Node(net & _Helper.mask(common), common)             # branch node
+            self._attach(node, bit, newNode)
+            self._attach(newNode, _Helper.getBit(child.net, newNode.plen), child)
+            if newNode.plen != plen:
+                leafNode = _Node(net, plen)
+                self._attach(newNode, _Helper.getBit(net, newNode.plen), leafNode)
+                return leafNode
+            return newNode
+
+    def _trieCompact(self, node):
+        # remove node if it is not needed any more, returns the nearest remaining ancestor
+        while node is not self.root and not node.present:
+            childList = [x for x in node.child if x is not None]
+            if len(childList) == 2:
+                break
+            parent = node.parent
+            bit = _Helper.getBit(node.net, parent.plen)
+            if len(childList) == 1:
+                self._attach(parent, bit, childList[0])
+            else:
+                parent.child[bit] = None
+            self._setOutput(node, None)
+            node.parent = None
+            node = parent
+        return node
+
+    def _attach(self, parent, bit, node):
+        parent.child[bit] = node
+        node.parent = parent
+
+    def _markDirty(self, node):
+        while node is not None:
+            node.dirty = True
+            node = node.parent
+
+    def _calcUniform(self, node, inherited):
+        # node.uniform is the route all the addresses in this node resolve to, or _NONUNIFORM
+        if not node.dirty and node.uniformInherited == inherited:
+            return node.uniform
+
+        eff = node.data if node.present else inherited
+        ul = []
+        for child in node.child:
+            if child is None:
+                ul.append(eff)
+                continue
+            u = self._calcUniform(child, eff)
+            if child.plen == node.plen + 1:
+                ul.append(u)
+            else:
+                ul.append(u if u == eff else _NONUNIFORM)          # the addresses skipped by path compression resolve to eff
+
+        if ul[0] is not _NONUNIFORM and ul[1] is not _NONUNIFORM and ul[0] == ul[1]:
+            node.uniform = ul[0]
+        else:
+            node.uniform = _NONUNIFORM
+        node.uniformInherited = inherited
+        return node.uniform
+
+    def _calcOutput(self, node, inherited, swallowed):
+        if not node.dirty and node.outputInherited == inherited and node.outputSwallowed == swallowed:
+            return
+
+        if swallowed:
+            value = None
+            childSwallowed = True
+        elif node.uniform is not _NONUNIFORM and (node.plen > 0 or node.present):
+            value = node.uniform if node.uniform != inherited else None               # merge the whole subtree into this node
+            childSwallowed = True
+        else:
+            value = node.data if node.present and node.data != inherited else None    # drop prefix covered by the same route
+            childSwallowed = False
+        self._setOutput(node, value)
+
+        eff = node.data if node.present else inherited
+        for child in node.child:
+            if child is not None:
+                self._calcOutput(child, eff, childSwallowed)
+
+        node.dirty = False
+        node.outputInherited = inherited
+        node.outputSwallowed = swallowed
+
+    def _setOutput(self, node, value):
+        prefix = _Helper.intToPrefix(node.net, node.plen)
+        oldValue = self.outputDict.get(prefix, _NOVALUE)
+        if value is None:
+            if oldValue is _NOVALUE:
+                return
+            del self.outputDict[prefix]
+        else:
+            if oldValue is not _NOVALUE and oldValue == value:
+                return
+            self.outputDict[prefix] = value
+        if prefix not in self.changeDict:
+            self.changeDict[prefix] = oldValue
+
+
+class _Node:
+
+    def __init__(self, net, plen):
+        self.net = net
+        self.plen = plen
+        self.present = False                # False for branch node
+        self.data = None
+        self.parent = None
+        self.child = [None, None]
+
+        self.dirty = True
+        self.uniform = _NONUNIFORM
+        self.uniformInherited = None
+        self.outputInherited = None
+        self.outputSwallowed = None
+
+
+class _Helper:
+
+    @staticmethod
+    def prefixToInt(prefix):
+        tl = prefix.split("/")
+        plen = ByxUtil.ipMaskToLen(tl[1])
+        net = struct.unpack("!I", socket.inet_aton(tl[0]))[0]
+        return (net & _Helper.mask(plen), plen)
+
+    @staticmethod
+    def intToPrefix(net, plen):
+        return socket.inet_ntoa(struct.pack("!I", net)) + "/" + socket.inet_ntoa(struct.pack("!I", _Helper.mask(plen)))
+
+    @staticmethod
+    def mask(plen):
+        return (0xFFFFFFFF << (32 - plen)) & 0xFFFFFFFF
+
+    @staticmethod
+    def getBit(net, pos):
+        # pos 0 is the most significant bit
+        return (net >> (31 - pos)) & 1
+
+    @staticmethod
+    def commonLen(net1, net2):
+        return 32 - (net1 ^ net2).bit_length()
+
+
+_NONUNIFORM = object()
+_NOVALUE = object()
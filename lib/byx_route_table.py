@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import logging
+from gi.repository import GLib
+from byx_util import ByxUtil
+from byx_route_aggregator import ByxRouteAggregator
+
+
+class ByxRouteTable:
+
+    # routes installed into the kernel main table, reconciled against the winning values of
+    # a ByxPriorityDict<prefix, (nexthop, interface)>, aggregated by ByxRouteAggregator if enabled.
+    # only prefixes whose winning route changed and prefixes affected by netlink events are checked,
+    # all the kernel operations of one refresh are sent as one batch through the shared netlink session.
+
+    def __init__(self, param, routeFullDict):
+        self.param = param
+        self.logger = logging.getLogger(self.__module__ + "." + self.__class__.__name__)
+
+        if self.param.routeAggregation:
+            self.routeFullDict = ByxRouteAggregator(routeFullDict)
+        else:
+            self.routeFullDict = routeFullDict
+        self.routeDict = dict()                 # dict<prefix, data>, routes installed in kernel
+        self.routeDstDict = dict()              # dict<dst/len, (prefix, nexthop, oif)>, routes installed in kernel, indexed by netlink destination
+        self.routeRetryDict = dict()            # dict<interface, set<prefix>>, prefixes failed to be installed, waiting for netlink events
+        self.routeCheckSet = set()              # set<prefix>, prefixes to be checked in next refresh
+
+        self.addCount = 0
+        self.removeCount = 0
+        self.replaceCount = 0                   # routes taken over by another nexthop or interface
+
+        self.refreshIdle = None
+        self.param.netlink.add_event_callback(self._onNetlinkEvent)
+
+    def dispose(self):
+        if self.refreshIdle is not None:
+            GLib.source_remove(self.refreshIdle)
+            self.refreshIdle = None
+        self.param.netlink.remove_event_callback(self._onNetlinkEvent)
+
+    def schedule_refresh(self):
+        if self.refreshIdle is None:
+            self.refreshIdle = GLib.idle_add(self._refreshIdleCallback)
+
+    def refresh(self):
+        # only check prefixes whose winning route changed, and prefixes affected by netlink events
+        prefixSet = set(self.routeFullDict.pop_changes().keys()) | self.routeCheckSet
+        self.routeCheckSet = set()
+
+        opList = []
+        for prefix in prefixSet:
+            data = self.routeFullDict.get_value(prefix)
+
+            # remove route
+            if data is None:
+                if prefix in self.routeDict:
+                    opList.append(("del", prefix, None, None))
+                continue
+
+            # add or change route
+            nexthop, interface = data
+            idx = None
+            if interface is not None:
+                idx = self.param.netlink.get_ifindex(interface)
+                if idx is None:
+                    self.__addRetryRoute(prefix)
+                    continue
+            if prefix not in self.routeDict:
+                opList.append(("add", prefix, nexthop, idx))
+            elif self.routeDstDict[_Helper.prefixConvert(prefix)][1:] != (nexthop, idx):
+                opList.append(("replace", prefix, nexthop, idx))            # atomic, no blackhole between del and add
+
+        try:
+            errList = self.param.netlink.route_batch([(op, _Helper.prefixConvert(prefix), nexthop, idx) for op, prefix, nexthop, idx in opList])
+        except BaseException:
+            for op, prefix, nexthop, idx in opList:
+                self.routeCheckSet.add(prefix)
+            raise
+
+        for (op, prefix, nexthop, idx), err in zip(opList, errList):
+            if op == "del":
+                if err == 0:
+                    pass
+                elif err == 3:                  # message: No such process
+                    pass                        # route does not exist, ignore
+                else:
+                    self.logger.error("Failed to remove route %s, error %d." % (prefix, err))
+                del self.routeDstDict[_Helper.prefixConvert(prefix)]
+                del self.routeDict[prefix]
+                self.removeCount += 1
+            elif op == "add":
+                if err == 0:
+                    self.routeDict[prefix] = self.routeFullDict.get_value(prefix)
+                    self.routeDstDict[_Helper.prefixConvert(prefix)] = (prefix, nexthop, idx)
+                    self.addCount += 1
+                elif err == 17:                 # message: File exists
+                    self.__addRetryRoute(prefix)    # route already exists, retry when interface or address changes
+                elif err == 101:                # message: Network is unreachable
+                    self.__addRetryRoute(prefix)    # nexthop is invalid, retry when interface or address changes
+                else:
+                    self.logger.error("Failed to add route %s, error %d." % (prefix, err))
+                    self.__addRetryRoute(prefix)
+            elif op == "replace":
+                if err == 0:
+                    self.routeDict[prefix] = self.routeFullDict.get_value(prefix)
+                    self.routeDstDict[_Helper.prefixConvert(prefix)] = (prefix, nexthop, idx)
+                    self.replaceCount += 1
+                elif err == 101:                # message: Network is unreachable
+                    self.__addRetryRoute(prefix)    # new nexthop is invalid, old route is kept, retry when interface or address changes
+                else:
+                    self.logger.error("Failed to replace route %s, error %d." % (prefix, err))
+                    self.__addRetryRoute(prefix)
+            else:
+                assert False
+
+    def sweep(self):
+        # full sweep: retry all the failed prefixes, re-install routes that were deleted by others
+        for prefixSet in self.routeRetryDict.values():
+            self.routeCheckSet |= prefixSet
+        self.routeRetryDict = dict()
+
+        kernelDstSet = set()
+        for msg in self.param.netlink.get_routes():
+            kernelDstSet.add(self.__nlRouteDst(msg))
+        for dst, value in list(self.routeDstDict.items()):
+            if dst not in kernelDstSet:
+                del self.routeDstDict[dst]
+                del self.routeDict[value[0]]
+                self.routeCheckSet.add(value[0])
+
+        self.refresh()
+
+    def get_statistics(self):
+        ret = {
+            "installed": len(self.routeDict),
+            "pending": sum([len(x) for x in self.routeRetryDict.values()]),
+            "add": self.addCount,
+            "remove": self.removeCount,
+            "replace": self.replaceCount,
+        }
+        if self.param.routeAggregation:
+            ret["aggregation"] = self.routeFullDict.get_statistics()
+        return ret
+
+    def _refreshIdleCallback(self):
+        self.refreshIdle = None
+        try:
+            self.refresh()
+        except Exception:
+            self.logger.error("Error occured in route refresh idle callback", exc_info=True)
+        return False
+
+    def _onNetlinkEvent(self, msg):
+        if msg["event"] == "RTM_NEWLINK":
+            # interface appears or comes up, pending routes on it may be installable now
+            self.__checkRetryRoutes(msg.get_attr("IFLA_IFNAME"))
+        elif msg["event"] == "RTM_NEWADDR":
+            # address assigned, nexthop in the new subnet may be reachable now
+            self.__checkRetryRoutes(msg.get_attr("IFA_LABEL"))
+        elif msg["event"] in ["RTM_NEWROUTE", "RTM_DELROUTE"]:
+            if msg["table"] != 254:
+                return
+            dst = self.__nlRouteDst(msg)
+            if dst not in self.routeDstDict:
+                return
+            prefix, nexthop, oif = self.routeDstDict[dst]
+            if msg["event"] == "RTM_NEWROUTE":
+                # it is our own route, or our route overwritten by others
+                bOverwritten = False
+                bOverwritten |= (nexthop is not None and msg.get_attr("RTA_GATEWAY") != nexthop)
+                bOverwritten |= (oif is not None and msg.get_attr("RTA_OIF") != oif)
+                if not bOverwritten:
+                    return
+            # our route is deleted or overwritten by others, re-install it
+            del self.routeDstDict[dst]
+            del self.routeDict[prefix]
+            self.routeCheckSet.add(prefix)
+            self.schedule_refresh()
+
+    def __addRetryRoute(self, prefix):
+        data = self.routeFullDict.get_value(prefix)
+        interface = data[1] if data is not None else None
+        self.routeRetryDict.setdefault(interface, set()).add(prefix)
+
+    def __checkRetryRoutes(self, interface):
+        if interface is None:
+            prefixSet = set()
+            for v in self.routeRetryDict.values():
+                prefixSet |= v
+            self.routeRetryDict = dict()
+        else:
+            # routes which have only nexthop may be resolved through this interface
+            prefixSet = self.routeRetryDict.pop(interface, set()) | self.routeRetryDict.pop(None, set())
+        if len(prefixSet) > 0:
+            self.routeCheckSet |= prefixSet
+            self.schedule_refresh()
+
+    def __nlRouteDst(self, msg):
+        dst = msg.get_attr("RTA_DST")
+        if dst is None:
+            dst = "0.0.0.0"
+        return "%s/%d" % (dst, msg["dst_len"])
+
+
+class _Helper:
+
+    @staticmethod
+    def prefixConvert(prefix):
+        tl = prefix.split("/")
+        return tl[0] + "/" + str(ByxUtil.ipMaskToLen(tl[1]))
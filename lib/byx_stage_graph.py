@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import time
+import logging
+import threading
+from gi.repository import GLib
+
+
+class ByxStageGraph:
+
+    # runs stages as a dependency graph. every stage is run in its own thread as soon as all the
+    # stages it depends on are done, so independent stages run concurrently.
+    # when a stage fails or cancel() is called, the stages not started yet are skipped, and the
+    # cancel functions of the running stages are called. run() returns after all the started
+    # stages end, so nothing is left running behind.
+    #
+    # stages can run work on objects owned by main loop with call_in_main_loop().
+
+    class CancelledException(Exception):
+        pass
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__module__ + "." + self.__class__.__name__)
+
+        self.stageDict = dict()                 # dict<name, _Stage>
+        self.cond = threading.Condition()
+        self.bCancelled = False
+        self.error = None                       # exception of the first failed stage
+        self.startTime = None
+        self.endTime = None
+
+    def add_stage(self, name, func, dependList=[], cancelFunc=None):
+        # stages depended on must be added first, so there's no cycle
+        assert name not in self.stageDict
+        assert all([x in self.stageDict for x in dependList])
+        self.stageDict[name] = _Stage(name, func, dependList, cancelFunc)
+
+    def run(self):
+        """Raises the exception of the first failed stage, or CancelledException"""
+
+        with self.cond:
+            self.startTime = time.monotonic()
+            while True:
+                if not self.bCancelled:
+                    for stage in self.stageDict.values():
+                        if stage.state is None and all([self.stageDict[x].state == "done" for x in stage.dependList]):
+                            self._startStage(stage)
+                if not any([x.state == "running" for x in self.stageDict.values()]):
+                    break
+                self.cond.wait()
+            for stage in self.stageDict.values():
+                if stage.state is None:
+                    stage.state = "skipped"
+            self.endTime = time.monotonic()
+
+        if self.error is not None:
+            raise self.error
+        if self.bCancelled:
+            raise self.CancelledException("cancelled")
+
+    def cancel(self):
+        with self.cond:
+            if self.bCancelled:
+                return
+            runList = self._markCancelled()
+        self._callCancelFunctions(runList)
+
+    def is_cancelled(self):
+        return self.bCancelled
+
+    def call_in_main_loop(self, func):
+        """Runs func in main loop and waits for it, returns its result. main loop may be waiting for the stages
+           to end, so the wait is interrupted by cancel(), func is not run then and CancelledException is raised"""
+
+        call = _MainLoopCall(func)
+        GLib.idle_add(self._mainLoopCallback, call)
+        with self.cond:
+            self.cond.wait_for(lambda: call.state == "done" or (call.state is None and self.bCancelled))
+            if call.state is None:
+                call.state = "skipped"
+                raise self.CancelledException("cancelled")
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def get_timing(self):
+        """Returns times in milliseconds, start of stage is relative to start of the graph, stages running are measured until now"""
+
+        with self.cond:
+            now = time.monotonic()
+            ret = {
+                "total": None,
+                "stage": dict(),
+            }
+            if self.startTime is not None:
+                ret["total"] = int(((self.endTime if self.endTime is not None else now) - self.startTime) * 1000)
+            for stage in self.stageDict.values():
+                item = {
+                    "state": stage.state,
+                    "start": None,
+                    "duration": None,
+                }
+                if stage.startTime is not None:
+                    item["start"] = int((stage.startTime - self.startTime) * 1000)
+                    item["duration"] = int(((stage.endTime if stage.endTime is not None else now) - stage.startTime) * 1000)
+                ret["stage"][stage.name] = item
+            return ret
+
+    def _startStage(self, stage):
+        stage.state = "running"
+        stage.startTime = time.monotonic()
+        stage.thread = threading.Thread(target=self._runStage, args=(stage,), name="stage-" + stage.name)
+        stage.thread.start()
+
+    def _runStage(self, stage):
+        runList = []
+        try:
+            stage.func()
+            with self.cond:
+                stage.state = "done"
+        except BaseException as e:
+            with self.cond:
+                if self.bCancelled:
+                    stage.state = "cancelled"
+                else:
+                    # the other stages are cancelled as if cancel() is called
+                    stage.state = "failed"
+                    self.error = e
+                    runList = self._markCancelled()
+            if stage.state == "failed":
+                self.logger.error("Stage %s failed." % (stage.name), exc_info=True)
+        finally:
+            with self.cond:
+                stage.endTime = time.monotonic()
+                self.cond.notify_all()
+        self._callCancelFunctions(runList)
+
+    def _mainLoopCallback(self, call):
+        with self.cond:
+            if call.state is not None:
+                return False                    # skipped
+            call.state = "running"              # the caller waits for it even if cancelled now
+        try:
+            call.result = call.func()
+        except BaseException as e:
+            call.error = e
+        with self.cond:
+            call.state = "done"
+            self.cond.notify_all()
+        return False
+
+    def _markCancelled(self):
+        # called with self.cond held, returns the running stages
+        self.bCancelled = True
+        self.cond.notify_all()
+        return [x for x in self.stageDict.values() if x.state == "running"]
+
+    def _callCancelFunctions(self, runList):
+        for stage in runList:
+            if stage.cancelFunc is not None:
+                try:
+                    stage.cancelFunc()
+                except Exception:
+                    self.logger.error("Error occured in cancel function of stage %s" % (stage.name), exc_info=True)
+
+
+class _Stage:
+
+    def __init__(self, name, func, dependList, cancelFunc):
+        self.name = name
+        self.func = func
+        self.dependList = dependList
+        self.cancelFunc = cancelFunc
+
+        self.state = None                       # None, "running", "done", "failed", "cancelled", "skipped"
+        self.thread = None
+        self.startTime = None
+        self.endTime = None
+
+
+class _MainLoopCall:
+
+    def __init__(self, func):
+        self.func = func
+        self.state = None                       # None, "running", "done", "skipped"
+        self.result = None
+        self.error = None
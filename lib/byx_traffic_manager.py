@@ -3,20 +3,23 @@
 
 import os
 import logging
-import pyroute2
-import subprocess
 import iptc
 from gi.repository import GLib
 from gi.repository import GObject
 from byx_util import ByxUtil
+from byx_dnsmasq import ByxDnsmasq
+from byx_dns_forwarder import ByxDnsForwarder
+from byx_domain_index import ByxDomainIndex
+from byx_priority_dict import ByxPriorityDict
+from byx_route_table import ByxRouteTable
+from byx_fwmark_route_table import ByxFwmarkRouteTable
+from byx_domain_route import ByxDomainRoute
 
 
 class ByxTrafficManager:
 
     def __init__(self, param):
         self.param = param
-        self.cfgFile = os.path.join(self.param.tmpDir, "l2-dnsmasq.conf")
-        self.pidFile = os.path.join(self.param.tmpDir, "l2-dnsmasq.pid")
         self.hostsDir = os.path.join(self.param.tmpDir, "l2-dnsmasq.hosts.d")
         self.logger = logging.getLogger(self.__module__ + "." + self.__class__.__name__)
 
@@ -24,22 +27,33 @@ class ByxTrafficManager:
 
         self.tfacGroupDict = dict()             # dict<name, priority>
 
-        self.routeFullDict = _NamePriorityKeyValueDict()
-        self.routeDict = dict()                 # dict<prefix, data>
+        self.routeFullDict = ByxPriorityDict()
+        if self.param.routeMode == "fwmark":
+            self.routeTable = ByxFwmarkRouteTable(self.param, self.routeFullDict)
+        else:
+            self.routeTable = ByxRouteTable(self.param, self.routeFullDict)
         self.gatewayDict = dict()               # dict<name, set<interface>>
 
-        self.domainNameserverFullDict = _NamePriorityKeyValueDict()
+        self.domainNameserverFullDict = ByxPriorityDict()
         self.domainNameserverDict = dict()
+        self.domainIndex = ByxDomainIndex([], dict())          # updated by the changes of self.domainNameserverFullDict
 
-        self.domainIpFullDict = _NamePriorityKeyValueDict()
+        self.domainIpFullDict = ByxPriorityDict()
+        self.domainRoute = None                 # created when the first gateway with "domain-list" appears, it needs nftables
+        self.nftsetCfg = ""                     # "nftset=" lines of dnsmasq
+        self.nftsetRestartCount = 0             # dnsmasq restarts caused by changed "nftset=" lines
 
-        self.routeRefreshInterval = 10               # 10 seconds
+        # routes are refreshed on route table changes and netlink events, the periodic full sweep is only a safety net
+        self.routeRefreshInterval = 300              # 5 minutes
         self.routeRefreshTimer = GObject.timeout_add_seconds(self.routeRefreshInterval, self._routeRefreshTimerCallback)
 
-        self.dnsPort = ByxUtil.getFreeSocketPort("tcp")
-        self.dnsmasqProc = None
+        if self.param.dnsBackend == "builtin":
+            self.dnsmasq = ByxDnsForwarder(self.param, "l2-dnsmasq")
+        else:
+            self.dnsmasq = ByxDnsmasq(self.param, "l2-dnsmasq")
         try:
-            self._runDnsmasq()
+            os.mkdir(self.hostsDir)
+            self.dnsmasq.start(self._generateDnsmasqBaseCfg(), self.domainIndex)
             self.logger.info("Level 2 nameserver started.")
         except BaseException:
             self._dispose()
@@ -50,7 +64,8 @@ class ByxTrafficManager:
         self.logger.info("Terminated.")
 
     def get_l2_nameserver_port(self):
-        return self.dnsPort
+        # the port may change when the nameserver is restarted
+        return self.dnsmasq.get_port()
 
     def has_wan_service(self, name):
         return name in self.wanServDict
@@ -70,55 +85,50 @@ class ByxTrafficManager:
 
         self.tfacGroupDict[name] = priority
 
-        ret = self._trafficFacilityListToRouteFullDict(name, priority, facility_list)
-        if len(ret) > 0:
-            GLib.source_remove(self.routeRefreshTimer)
-            self.routeRefreshTimer = GObject.timeout_add_seconds(0, self._routeRefreshTimerCallback)
+        self._trafficFacilityListToRouteFullDict(name, priority, facility_list)
+        if self.routeFullDict.has_changes():
+            self.routeTable.schedule_refresh()
 
         gatewaySet = self._getGatewaySetFromTrafficFacilityList(facility_list)
-        self._addGatewayFwRules(gatewaySet)
+        self.param.firewall.add_gateways(gatewaySet)
         self.gatewayDict[name] = gatewaySet
 
-        ret = self._trafficFacilityListToDomainNameserverFullDict(name, priority, facility_list)
-        if len(ret) > 0:
-            self._stopDnsmasq()
-            self._runDnsmasq()
+        self._trafficFacilityListToDomainNameserverFullDict(name, priority, facility_list)
+        self._trafficFacilityListToDomainIpFullDict(name, priority, facility_list)
+        self._domainChanged()
 
     def change_tfac_group(self, name, facility_list):
         assert name in self.tfacGroupDict
 
-        ret1 = self.routeFullDict.remove_by_name(name)
-        ret2 = self._trafficFacilityListToRouteFullDict(name, self.tfacGroupDict[name], facility_list)
-        if ret1 != ret2:
-            GLib.source_remove(self.routeRefreshTimer)
-            self.routeRefreshTimer = GObject.timeout_add_seconds(0, self._routeRefreshTimerCallback)
+        self.routeFullDict.remove_by_owner(name)
+        self._trafficFacilityListToRouteFullDict(name, self.tfacGroupDict[name], facility_list)
+        if self.routeFullDict.has_changes():
+            self.routeTable.schedule_refresh()
 
         gatewaySet = self._getGatewaySetFromTrafficFacilityList(facility_list)
-        self._removeGatewayFwRules(self.gatewayDict[name] - gatewaySet)
-        self._addGatewayFwRules(gatewaySet - self.gatewayDict[name])
+        self.param.firewall.remove_gateways(self.gatewayDict[name] - gatewaySet)
+        self.param.firewall.add_gateways(gatewaySet - self.gatewayDict[name])
         self.gatewayDict[name] = gatewaySet
 
-        ret1 = self.domainNameserverFullDict.remove_by_name(name)
-        ret2 = self._trafficFacilityListToDomainNameserverFullDict(name, self.tfacGroupDict[name], facility_list)
-        if ret1 != ret2:
-            self._stopDnsmasq()
-            self._runDnsmasq()
+        self.domainNameserverFullDict.remove_by_owner(name)
+        self._trafficFacilityListToDomainNameserverFullDict(name, self.tfacGroupDict[name], facility_list)
+        self.domainIpFullDict.remove_by_owner(name)
+        self._trafficFacilityListToDomainIpFullDict(name, self.tfacGroupDict[name], facility_list)
+        self._domainChanged()
 
     def remove_tfac_group(self, name):
         del self.tfacGroupDict[name]
 
-        ret = self.routeFullDict.remove_by_name(name)
-        if len(ret) > 0:
-            GLib.source_remove(self.routeRefreshTimer)
-            self.routeRefreshTimer = GObject.timeout_add_seconds(0, self._routeRefreshTimerCallback)
+        self.routeFullDict.remove_by_owner(name)
+        if self.routeFullDict.has_changes():
+            self.routeTable.schedule_refresh()
 
-        self._removeGatewayFwRules(self.gatewayDict[name])
+        self.param.firewall.remove_gateways(self.gatewayDict[name])
         del self.gatewayDict[name]
 
-        ret = self.domainNameserverFullDict.remove_by_name(name)
-        if len(ret) > 0:
-            self._stopDnsmasq()
-            self._runDnsmasq()
+        self.domainNameserverFullDict.remove_by_owner(name)
+        self.domainIpFullDict.remove_by_owner(name)
+        self._domainChanged()
 
     def on_wan_conn_up(self):
         rule = iptc.Rule()
@@ -130,14 +140,24 @@ class ByxTrafficManager:
         # ByxUtil.shell('/sbin/nft add rule wrtd fw iifname %s ip protocol icmp accept' % (intf))
         # ByxUtil.shell('/sbin/nft add rule wrtd fw iifname %s drop' % (intf))
 
-    def _dispose(self):
-        self._stopDnsmasq()
+    def get_statistics(self):
+        return {
+            "route": self.routeTable.get_statistics(),
+            "dnsmasq": self.dnsmasq.get_statistics(),
+            "domain-route": self.domainRoute.get_statistics() if self.domainRoute is not None else None,
+            "nftset-restart": self.nftsetRestartCount,
+        }
 
-    def _runDnsmasq(self):
-        # make hosts directory
-        os.mkdir(self.hostsDir)
+    def _dispose(self):
+        GLib.source_remove(self.routeRefreshTimer)
+        self.routeTable.dispose()
+        self.dnsmasq.stop()
+        if self.domainRoute is not None:
+            self.domainRoute.dispose()
+            self.domainRoute = None
+        ByxUtil.forceDelete(self.hostsDir)
 
-        # generate dnsmasq config file
+    def _generateDnsmasqBaseCfg(self):
         buf = ""
         buf += "strict-order\n"
         buf += "bind-interfaces\n"                            # don't listen on 0.0.0.0
@@ -152,29 +172,39 @@ class ByxTrafficManager:
         buf += "addn-hosts=%s\n" % (self.hostsDir)                       # "hostsdir=" only adds record, no deletion, so not usable
         buf += "\n"
         buf += "resolv-file=%s\n" % (self.param.ownResolvConf)
-        for domain, nsList in self.domainNameserverFullDict.get_dict().items():
-            for ns in nsList:
-                buf += "server=/%s/%s\n" % (domain, ns.replace(":", "#"))
         buf += "\n"
-        with open(self.cfgFile, "w") as f:
-            f.write(buf)
-
-        # run dnsmasq process
-        cmd = "/usr/sbin/dnsmasq"
-        cmd += " --keep-in-foreground"
-        cmd += " --port=%d" % (self.dnsPort)
-        cmd += " --conf-file=\"%s\"" % (self.cfgFile)
-        cmd += " --pid-file=%s" % (self.pidFile)
-        self.dnsmasqProc = subprocess.Popen(cmd, shell=True, universal_newlines=True)
-
-    def _stopDnsmasq(self):
-        if self.dnsmasqProc is not None:
-            self.dnsmasqProc.terminate()
-            self.dnsmasqProc.wait()
-            self.dnsmasqProc = None
-        ByxUtil.forceDelete(self.hostsDir)
-        ByxUtil.forceDelete(self.pidFile)
-        ByxUtil.forceDelete(self.cfgFile)
+        # dnsmasq can't change "nftset=" while running, it has no D-Bus method for them and doesn't re-read
+        # them on SIGHUP, so a domain-list change of gateways restarts it and drops its cache. these restarts
+        # are counted separately, the built-in forwarder reports answers by callback and never restarts.
+        buf += self.nftsetCfg
+        return buf
+
+    def _domainChanged(self):
+        bChanged = False
+        if len(self.domainIpFullDict.pop_changes()) > 0:
+            if self.domainRoute is None:
+                self.domainRoute = ByxDomainRoute(self.param)
+                if self.param.dnsBackend == "builtin":
+                    self.dnsmasq.add_answer_callback(self.domainRoute.on_dns_answer, self.domainRoute.flush)
+            self.domainRoute.set_domain_dict(self.domainIpFullDict.get_dict())
+            if self.param.dnsBackend != "builtin":
+                cfg = self.domainRoute.get_dnsmasq_cfg()
+                if cfg != self.nftsetCfg:
+                    self.nftsetCfg = cfg
+                    self.nftsetRestartCount += 1
+                    bChanged = True
+        changeDict = self.domainNameserverFullDict.pop_changes()
+        if len(changeDict) > 0:
+            domainDict = dict()
+            for domain, nsList in changeDict.items():
+                domainDict[domain] = [ns.replace(":", "#") for ns in nsList] if nsList is not None else None
+            self.domainIndex.update(domainDict)
+            bChanged = True
+        if bChanged:
+            self._updateDnsmasq()
+
+    def _updateDnsmasq(self):
+        self.dnsmasq.set_config(self._generateDnsmasqBaseCfg(), self.domainIndex)
 
     def _getGatewaySetFromTrafficFacilityList(self, facility_list):
         ret = set()
@@ -189,7 +219,7 @@ class ByxTrafficManager:
         ret = set()
         for item in facility_list:
             if item["facility-type"] == "gateway":
-                for prefix in item["network-list"]:
+                for prefix in item.get("network-list", []):
                     self.routeFullDict.set_key_value(name, priority, prefix, item["target"])
                     ret.add(prefix)
         return ret
@@ -204,164 +234,20 @@ class ByxTrafficManager:
         return ret
 
     def _trafficFacilityListToDomainIpFullDict(self, name, priority, facility_list):
-        assert False
-        return False
+        # gateway with "domain-list", addresses of these domains are learned from DNS answers
+        ret = set()
+        for item in facility_list:
+            if item["facility-type"] == "gateway":
+                for domain in item.get("domain-list", []):
+                    self.domainIpFullDict.set_key_value(name, priority, domain, item["target"])
+                    ret.add(domain)
+        return ret
 
     def _routeRefreshTimerCallback(self):
         try:
-            newRouteDict = self.routeFullDict.get_dict()
-
-            with pyroute2.IPRoute() as ipp:
-                # remove routes
-                for prefix in self.routeDict:
-                    if prefix not in newRouteDict:
-                        try:
-                            ipp.route("del", dst=_Helper.prefixConvert(prefix))
-                        except pyroute2.netlink.exceptions.NetlinkError as e:
-                            if e.code == 3:     # message: No such process
-                                pass            # route does not exist, ignore
-                            else:
-                                raise
-
-                # add or change routes
-                for prefix, data in list(newRouteDict.items()):
-                    nexthop, interface = data
-                    if interface is not None:
-                        idx_list = ipp.link_lookup(ifname=interface)
-                        if idx_list == []:
-                            del newRouteDict[prefix]
-                            continue
-                        assert len(idx_list) == 1
-                        idx = idx_list[0]
-
-                    try:
-                        if prefix not in self.routeDict:                                    # add
-                            if nexthop is not None and interface is not None:
-                                ipp.route("add", dst=_Helper.prefixConvert(prefix), gateway=nexthop, oif=idx)
-                            elif nexthop is not None and interface is None:
-                                ipp.route("add", dst=_Helper.prefixConvert(prefix), gateway=nexthop)
-                            elif nexthop is None and interface is not None:
-                                ipp.route("add", dst=_Helper.prefixConvert(prefix), oif=idx)
-                            else:
-                                assert False
-                        else:                                                               # change
-                            pass        # fixme
-                    except pyroute2.netlink.exceptions.NetlinkError as e:
-                        if e.code == 17:                    # message: File exists
-                            del newRouteDict[prefix]        # route already exists, retry in next cycle
-                        elif e.code == 101:                 # message: Network is unreachable
-                            del newRouteDict[prefix]        # nexthop is invalid, retry in next cycle
-                        else:
-                            raise
-            self.routeDict = newRouteDict
+            self.routeTable.sweep()
         except Exception:
             self.logger.error("Error occured in route refresh timer callback", exc_info=True)
         finally:
             self.routeRefreshTimer = GObject.timeout_add_seconds(self.routeRefreshInterval, self._routeRefreshTimerCallback)
             return False
-
-    def _addGatewayFwRules(self, gatewaySet):
-        filterTable = iptc.Table(iptc.Table.FILTER)
-        natTable = iptc.Table(iptc.Table.NAT)
-        filterTable.autocommit = False
-        natTable.autocommit = False
-        try:
-            for gateway in gatewaySet:
-                for rule in self.__generateGatewayFwRulesFilterInputChain(gateway):
-                    iptc.Chain(filterTable, "INPUT").append_rule(rule)
-                for rule in self.__generateGatewayFwRulesNatPostChain(gateway):
-                    iptc.Chain(natTable, "POSTROUTING").append_rule(rule)
-            filterTable.commit()
-            natTable.commit()
-        finally:
-            filterTable.autocommit = True
-            natTable.autocommit = True
-
-    def _removeGatewayFwRules(self, gatewaySet):
-        filterTable = iptc.Table(iptc.Table.FILTER)
-        natTable = iptc.Table(iptc.Table.NAT)
-        filterTable.autocommit = False
-        natTable.autocommit = False
-        try:
-            for gateway in gatewaySet:
-                for rule in self.__generateGatewayFwRulesFilterInputChain(gateway):
-                    iptc.Chain(filterTable, "INPUT").delete_rule(rule)
-                for rule in self.__generateGatewayFwRulesNatPostChain(gateway):
-                    iptc.Chain(natTable, "POSTROUTING").delete_rule(rule)
-            filterTable.commit()
-            natTable.commit()
-        finally:
-            filterTable.autocommit = True
-            natTable.autocommit = True
-
-    def __generateGatewayFwRulesFilterInputChain(self, gateway):
-        ret = []
-
-        rule = iptc.Rule()
-        rule.in_interface = gateway
-        rule.protocol = "icmp"
-        rule.create_target("ACCEPT")
-        ret.append(rule)
-
-        rule = iptc.Rule()
-        rule.in_interface = gateway
-        match = iptc.Match(rule, "state")
-        match.state = "ESTABLISHED,RELATED"
-        rule.add_match(match)
-        rule.create_target("ACCEPT")
-        ret.append(rule)
-
-        rule = iptc.Rule()
-        rule.in_interface = gateway
-        rule.create_target("DROP")
-        ret.append(rule)
-
-        return ret
-
-    def __generateGatewayFwRulesNatPostChain(self, gateway):
-        rule = iptc.Rule()
-        rule.out_interface = gateway
-        rule.create_target("MASQUERADE")
-        return [rule]
-
-
-class _NamePriorityKeyValueDict:
-
-    def __init__(self):
-        self.dictImpl = dict()
-
-    def set_key_value(self, name, priority, key, value):
-        if key not in self.dictImpl:
-            self.dictImpl[key] = dict()
-        if priority not in self.dictImpl[key]:
-            self.dictImpl[key][priority] = dict()
-        self.dictImpl[key][priority][name] = value
-
-    def remove_by_name(self, name):
-        ret = set()
-        for key in list(self.dictImpl.keys()):
-            for priority in list(self.dictImpl[key].keys()):
-                if name in self.dictImpl[key][priority]:
-                    del self.dictImpl[key][priority][name]
-                    ret.add(key)
-                    if len(self.dictImpl[key][priority]) == 0:
-                        del self.dictImpl[key][priority]
-                        if len(self.dictImpl[key]) == 0:
-                            del self.dictImpl[key]
-        return ret
-
-    def get_dict(self):
-        ret = dict()
-        for key, data in self.dictImpl.items():
-            priority = sorted(list(data.keys()))[0]
-            name = sorted(list(data[priority].keys()))[0]
-            ret[key] = data[priority][name]
-        return ret
-
-
-class _Helper:
-
-    @staticmethod
-    def prefixConvert(prefix):
-        tl = prefix.split("/")
-        return tl[0] + "/" + str(ByxUtil.ipMaskToLen(tl[1]))
@@ -4,6 +4,8 @@ import os
 import iptc
 import socket
 import shutil
+import threading
+import subprocess
 import libxml2
 import logging
 
@@ -46,30 +48,19 @@ class ByxUtil:
         return True
 
     @staticmethod
-    def getFreeSocketPort(portType):
-        if portType == "tcp":
-            stlist = [socket.SOCK_STREAM]
-        elif portType == "udp":
-            stlist = [socket.SOCK_DGRAM]
-        elif portType == "tcp+udp":
-            stlist = [socket.SOCK_STREAM, socket.SOCK_DGRAM]
-        else:
-            assert False
+    def nftablesIsEmpty():
+        out = subprocess.check_output(["/sbin/nft", "list", "ruleset"], universal_newlines=True)
+        return out.strip() == ""
+
+    @staticmethod
+    def nftablesSetEmpty():
+        subprocess.run(["/sbin/nft", "flush", "ruleset"], check=True)
+        return True
 
-        for port in range(10000, 65536):
-            bFound = True
-            for sType in stlist:
-                s = socket.socket(socket.AF_INET, sType)
-                try:
-                    s.bind((('', port)))
-                except socket.error:
-                    bFound = False
-                finally:
-                    s.close()
-            if bFound:
-                return port
-
-        raise Exception("no valid port")
+    @staticmethod
+    def nftablesApply(script):
+        # "nft -f" applies the whole script in one transaction
+        subprocess.run(["/sbin/nft", "-f", "-"], input=script, universal_newlines=True, check=True)
 
     @staticmethod
     def forceDelete(filename):
@@ -136,6 +127,71 @@ class CallingPointManager:
         del self.cpDict[key]
 
 
+class PortAllocator:
+
+    # allocates TCP+UDP port pairs on all addresses for child processes (dnsmasq):
+    #   1. the port is assigned by kernel, the last port of the same name is tried first, so that restarts reuse it
+    #   2. the port is held by our own sockets until release() is called after the child owns it,
+    #      our sockets have SO_REUSEADDR and never listen, so a child with SO_REUSEADDR can bind the
+    #      port while others can't
+    #
+    # it can be called in several threads.
+
+    RETRY = 16
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.lastPortDict = dict()          # dict<name, port>
+        self.heldDict = dict()              # dict<name, (port, tcp-socket, udp-socket)>
+
+    def reserve(self, name, port=None):
+        """Returns a free port, port can be specified if the caller must get that port"""
+
+        with self.lock:
+            assert name not in self.heldDict
+
+            if port is not None:
+                ret = self._tryBind(port)
+                if ret is None:
+                    raise Exception("port %d for %s is not available" % (port, name))
+            else:
+                ret = None
+                if name in self.lastPortDict:
+                    ret = self._tryBind(self.lastPortDict[name])
+                for i in range(0, self.RETRY):
+                    if ret is not None:
+                        break
+                    ret = self._tryBind(0)              # UDP port may be used by others, try another one
+                if ret is None:
+                    raise Exception("no valid port")
+
+            self.heldDict[name] = ret
+            self.lastPortDict[name] = ret[0]
+            return ret[0]
+
+    def release(self, name):
+        with self.lock:
+            if name in self.heldDict:
+                port, tcpSock, udpSock = self.heldDict.pop(name)
+                tcpSock.close()
+                udpSock.close()
+
+    def _tryBind(self, port):
+        tcpSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        udpSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            tcpSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            udpSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            tcpSock.bind(('', port))
+            port = tcpSock.getsockname()[1]
+            udpSock.bind(('', port))
+            return (port, tcpSock, udpSock)
+        except socket.error:
+            tcpSock.close()
+            udpSock.close()
+            return None
+
+
 class PluginManager:
 
     class LoadPluginException(Exception):
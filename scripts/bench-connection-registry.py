@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+# benchmark and randomized check of ByxConnectionRegistry against a linear scan
+# usage: scripts/bench-connection-registry.py [connection-count]
+
+import os
+import sys
+import time
+import random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from byx_connection_registry import ByxConnectionRegistry
+
+
+NETWORK_TYPE_LIST = ["wired", "wireless", "mobile"]
+
+
+class _Connection:
+
+    def __init__(self, i):
+        self.id = "conn%05d" % (i)
+        self.priority = random.randint(0, 10)
+        self.networkType = random.choice(NETWORK_TYPE_LIST)
+        self.autoActivate = random.random() < 0.9
+        self.isAvailable = random.random() < 0.5
+
+
+def linearBest(connList, networkType, filterFunc=None):
+    candList = [x for x in connList if x.networkType == networkType and x.isAvailable and x.autoActivate]
+    if filterFunc is not None:
+        candList = [x for x in candList if filterFunc(x)]
+    return min(candList, key=lambda x: (-x.priority, x.id)) if len(candList) > 0 else None
+
+
+def measure(name, count, func):
+    startTime = time.perf_counter()
+    for i in range(0, count):
+        func(i)
+    print("%-24s x%-7d %10.3f ms" % (name, count, (time.perf_counter() - startTime) * 1000))
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    random.seed(0)
+    connList = [_Connection(i) for i in range(0, n)]
+    registry = ByxConnectionRegistry()
+
+    def _toggle(i):
+        conn = random.choice(connList)
+        conn.isAvailable = not conn.isAvailable
+        registry.update(conn)
+
+    measure("add", n, lambda i: registry.add(connList[i]))
+    measure("update", 100000, _toggle)
+    measure("get_best", 1000, lambda i: registry.get_best("wired"))
+    measure("linear scan", 1000, lambda i: linearBest(connList, "wired"))
+    measure("get", 100000, lambda i: registry.get(connList[i % n].id))
+
+    for i in range(0, 2000):
+        _toggle(i)
+        networkType = random.choice(NETWORK_TYPE_LIST)
+        filterFunc = (lambda x: x.priority % 3 != 0)
+        assert registry.get_best(networkType, filterFunc) is linearBest(connList, networkType, filterFunc)
+    print("get_best agrees with linear scan in 2000 randomized checks")
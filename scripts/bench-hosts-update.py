@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+# throughput of host updates of the level 2 ntfac nameserver, the fragments of the changed ids are
+# read again (hostsdir, built-in forwarder), or all the fragments are read again ("addn-hosts" and SIGHUP)
+# usage: scripts/bench-hosts-update.py [host-count]
+
+import os
+import sys
+import time
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+import byx_ntfac_group
+import byx_dns_forwarder
+
+
+class _Param:
+
+    def __init__(self, tmpDir):
+        self.tmpDir = tmpDir
+
+
+class _DnsServ:
+
+    def __init__(self, hostsDir, bFullReload):
+        self.hostsDir = hostsDir
+        self.bFullReload = bFullReload
+        self.hostsTable = byx_dns_forwarder._HostsTable(hostsDir)
+
+    def reload_hosts(self, fileList):
+        if self.bFullReload:
+            self.hostsTable = byx_dns_forwarder._HostsTable(self.hostsDir)
+            self.hostsTable.refresh()
+        else:
+            self.hostsTable.refresh(fileList)
+
+
+def measure(name, count, func, hostCount=None):
+    # hostCount is the number of hosts changed by all the calls, the same as count by default
+    startTime = time.perf_counter()
+    for i in range(0, count):
+        func(i)
+    totalTime = time.perf_counter() - startTime
+    print("%-44s x%-6d %10.1f ms %10.0f hosts/s" % (name, count, totalTime * 1000, (hostCount or count) / totalTime))
+
+
+def run(hostCount, bFullReload, updateCount):
+    with tempfile.TemporaryDirectory() as tmpDir:
+        dnsServ = _DnsServ(os.path.join(tmpDir, "hosts.d"), bFullReload)
+        os.mkdir(dnsServ.hostsDir)
+        hostManager = byx_ntfac_group._HostManager(_Param(tmpDir), dnsServ)
+        hostManager.start()
+
+        mode = "full reload" if bFullReload else "changed fragments"
+        hostManager.begin_batch()
+        for i in range(0, hostCount):
+            hostManager.hostNew("id%05d" % (i), 1, "host%05d.lan" % (i), "10.0.%d.%d" % (i // 256, i % 256))
+        measure("add %d hosts in a batch, %s" % (hostCount, mode), 1, lambda i: hostManager.end_batch(), hostCount)
+        measure("update one host, %s" % (mode), updateCount, lambda i: hostManager.hostUpdate("id%05d" % (i), "10.1.%d.%d" % (i // 256, i % 256)))
+        assert dnsServ.hostsTable.lookup("host00000.lan") == ["10.1.0.0"]
+
+
+if __name__ == "__main__":
+    hostCount = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    run(hostCount, False, hostCount)
+    run(hostCount, True, 100)
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+# memory and main loop latency of reading a ntfac list file, in one call and by _ListFileReader
+# usage: scripts/bench-list-file.py [line-count]
+
+import os
+import sys
+import time
+import tempfile
+import subprocess
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from gi.repository import GLib
+import byx_ntfac_group
+
+
+def getRss():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])         # KiB
+    assert False
+
+
+def readAtOnce(fn):
+    ret = []
+    with open(fn, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line != "" and not line.startswith("#"):
+                ret.append(line)
+    return ret
+
+
+def runMode(mode, fn):
+    rss = getRss()
+    data = dict()
+    maxCall = 0
+    startTime = time.perf_counter()
+    if mode == "at-once":
+        data["network-list"] = readAtOnce(fn)
+        maxCall = time.perf_counter() - startTime
+    else:
+        resultList = []
+        reader = byx_ntfac_group._ListFileReader([(data, "network-list", fn)], resultList.append)
+        reader.start()
+        ctx = GLib.MainContext.default()
+        while len(resultList) == 0:
+            callTime = time.perf_counter()
+            ctx.iteration(True)
+            maxCall = max(maxCall, time.perf_counter() - callTime)
+        assert resultList == [True]
+    totalTime = time.perf_counter() - startTime
+    print("%-10s %8d items %10.1f ms total %10.1f ms longest main loop call %8d KiB rss" % (mode, len(data["network-list"]), totalTime * 1000, maxCall * 1000, getRss() - rss))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        runMode(sys.argv[1], sys.argv[2])
+        sys.exit(0)
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    with tempfile.TemporaryDirectory() as tmpDir:
+        for mode in ["at-once", "chunked"]:
+            fn = os.path.join(tmpDir, "list")
+            with open(fn, "w") as f:
+                for i in range(0, count):
+                    f.write("10.%d.%d.%d/32\n" % ((i >> 16) & 0xFF, (i >> 8) & 0xFF, i & 0xFF))
+            # every mode runs in its own process, so that the rss is not reused memory
+            subprocess.run([sys.executable, __file__, mode, fn], check=True)